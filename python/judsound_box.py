@@ -2,9 +2,42 @@
 
 import gpiozero
 from gpiozero.tools import scaled
+import os
 import time
+import socket
+import queue
+import concurrent.futures
+import threading
+import logging
+import judsound_log
 import judsound_player
+import judsound_playlist
+import judsound_loudness
+import judsound_modes
+import judsound_control
 import judsound_clock
+import judsound_speech
+import judsound_sound
+
+log = logging.getLogger(__name__)
+
+
+def notify_systemd(message):
+    """Send a message to systemd (does nothing unless run as a service of Type=notify)
+
+    Keyword arguments:
+    message -- a string such as "READY=1", "WATCHDOG=1" or "STOPPING=1"
+    """
+
+    path = os.environ.get("NOTIFY_SOCKET")
+    if not path:
+        return
+    if path.startswith("@"):
+        path = "\0" + path[1:] # abstract socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.connect(path)
+        sock.sendall(message.encode())
+
 
 class Box:
     """Define class which handle the physical box
@@ -19,7 +52,7 @@ class Box:
     path_music_day -- a string specifying the path to the directory where the audio files for the day playlist are stored
     path_system_sound -- a string specifying the path to the directory where the audio files for clock and system sounds are stored
     file_to_alarms -- a string specifying the file (including its paths) where alarms are written and read
-    possible_modes -- an array of strings specifying the possible mode for the player (default = ["player_night", "alarm", "player_day"])
+    possible_modes -- an array of strings specifying the modes gone through by holding the mode button (default = ["player_night", "alarm", "player_day"])
     vol_min -- an integer specifying the minimum volume allowed
     vol_max -- an integer specifying the maximum volume allowed
     vol_music_day -- an integer specifying the baseline volume for the day player
@@ -33,6 +66,28 @@ class Box:
     night_day_h -- an integer specifying at what time the day period starts
     day_night_h -- an integer specifying at what time the night period starts
     tracks_system -- a dictionary for system sounds other than hours and minutes
+    speech_cache_size -- an integer specifying how many pre-rendered time announcements to keep (0 = no cache)
+    path_speech_cache -- a string specifying the directory where pre-rendered time announcements are stored
+                         (default = None: stored in memory, so they do not survive reboots)
+    system_sound_sink -- a string specifying where system sounds are played without VLC, from memory:
+                         "alsa" (sound card), "null" (nowhere), or the path to a raw PCM file
+                         (default = None: system sounds are played with VLC)
+    file_to_positions -- a string specifying the file (including its path) where the position reached in each playlist
+                         is saved, so that playlists resume where they were left after a restart (default = None: not saved)
+    alarm_fade_in -- the time in sec for the alarm to go from silent to vol_alarm (0 = at once)
+    alarm_duration -- the maximum time in sec for which the alarm rings if no button is pressed to dismiss it
+    fade_time -- the time in sec over which music fades out when the mode changes, and volumes follow day/night changes
+    path_control_socket -- a string specifying the UNIX socket through which local programs can drive the box
+                           (default = None: no socket, see judsound_control)
+    modes -- a dictionary describing what each mode does (default = judsound_modes.MODES; new modes can be added
+             from existing actions, and need a system sound of their name)
+    file_to_loudness -- a string specifying the file (including its path) where the loudness of audio files is kept, so that
+                        all files are played equally loud (default = None: files are played as they are)
+    idle_time -- the time in sec of silence after which the box releases the audio output and only wakes up
+                 for inputs and scheduled events (default = 300, None = never)
+    file_to_sound_pack -- a string specifying the file (including its path) where system sounds are kept decoded, so that
+                          they are not decoded at each start (default = None: decoded at each start; the pack is
+                          built on first start, and rebuilt when a system sound changes; only used with system_sound_sink)
     """
 
     def __init__(self,
@@ -72,9 +127,23 @@ class Box:
                     "alarm_validation": None,
                     "alarms_list": None,
                     "alarms_deleted": None,
-                    "volume": None}):
+                    "volume": None},
+                 speech_cache_size = 0,
+                 path_speech_cache = None,
+                 system_sound_sink = None,
+                 file_to_positions = None,
+                 alarm_fade_in = 30,
+                 alarm_duration = 300,
+                 fade_time = 1.5,
+                 file_to_loudness = None,
+                 modes = judsound_modes.MODES,
+                 path_control_socket = None,
+                 idle_time = 300,
+                 file_to_sound_pack = None):
         "Initialize the box"
 
+        time_init = time.monotonic()
+
         # setting volumes
         self.volume_min = vol_min
         self.volume_max = vol_max
@@ -82,9 +151,11 @@ class Box:
         self.volume_music_night = vol_music_night
         self.volume_system_day = vol_system_day
         self.volume_system_night = vol_system_night
+        self.fade_time = fade_time
 
         # setting the mapping for all physical inputs
         gpiozero.Button.was_held = False
+        gpiozero.Button.mode_at_press = None # mode in which the current press started
 
         self.push_buttons = [gpiozero.Button(btn, bounce_time = 0.1) for btn in gpio_push_buttons]
 
@@ -101,37 +172,119 @@ class Box:
         self.max_steps = gpio_button_rotary_max_steps
 
         # adjust settings for the rotary encoder
-        self.button_rotary_push.when_pressed = self.push_mode_button
+        self.hold_time = hold_time
+        self.button_rotary_push.hold_time = hold_time
+        # (the actions of buttons are queued and run by a single dispatcher thread, see submit)
+        self.commands = queue.Queue()
+        self.busy = False # True while the dispatcher runs an action
+        # after idle_time of silence, the audio output is released (see enter_idle)
+        self.idle_time = idle_time
+        self.idle = False
+        self.lock_idle = threading.Lock() # the box can be woken up by the dispatcher and by the volume thread
+        self.time_active = time.monotonic() # when the last action ended (or the box was last found playing)
+        self.time_idle = None # when the box last became idle
+        self.idle_seconds = 0 # total time spent idle (before the current idle period)
+        self.idle_wakeups = 0 # number of times the main loop woke up while idle
+        self.time_woken = None # time of the input which woke the box up (None once a sound has been played since)
+        self.button_rotary_push.when_pressed = lambda: self.submit(self.push_mode_button, barge_in = True)
+        self.button_rotary_push.when_held = lambda: self.submit(self.hold_mode_button)
+        self.button_rotary_push.when_released = lambda: self.submit(self.release_mode_button)
         self.button_rotary_turn.when_rotated = self.change_volume
+        self.volume_request = threading.Event() # set by the encoder, handled by apply_volume()
+        self.volume_update_interval = 0.05 # minimum time in sec between two volume updates
+        self.volume_feedback_interval = 0.3 # minimum time in sec between two feedback sounds
 
         # adjust settings for the push buttons
-        self.hold_time = hold_time
-
+        # (holding is detected by gpiozero itself, so no busy loop is needed while a button is down)
         for btn_index, btn in enumerate(self.push_buttons):
-            btn.when_pressed = lambda i = btn_index: self.push_top_button(button_index = i) 
+            btn.hold_time = hold_time
+            btn.when_pressed = lambda i = btn_index: self.submit(self.push_top_button, barge_in = True, button_index = i)
+            btn.when_held = lambda i = btn_index: self.submit(self.hold_top_button, button_index = i)
+            btn.when_released = lambda i = btn_index: self.submit(self.release_top_button, button_index = i)
             # note: i = btn_index is required for lambda to work using the right scope (specific to using for loops)
             # (i.e. don't pass argument(s) directly to push_top_button call)
 
         # filling dictionary for system sounds
-        for m in range(60):
-            key = f'{m:02d}'
-            tracks_system[key] = key + '.mp3' # add minutes/hours to dictionary
-        print("loaded dictionary for system sounds:")
-        print(tracks_system)
+        tracks_system = self.complete_tracks(tracks_system = tracks_system)
+        log.debug("loaded dictionary for system sounds: %s", tracks_system)
+
+        # system sounds decoded once, in a memory-mapped pack used by the engine and the speech cache
+        # (only with the engine, which needs its sounds decoded before it starts: without it, the speech
+        # cache decodes the clips it needs when it needs them, so that the box is not slower to start)
+        if file_to_sound_pack is not None and system_sound_sink is None:
+            log.info("sound pack %s not used, as system sounds are played with VLC", file_to_sound_pack)
+            sound_pack = None
+        elif file_to_sound_pack is not None:
+            sound_pack = judsound_sound.Pack(
+                file_pack = file_to_sound_pack,
+                path_sound = path_system_sound,
+                files = [file for file in tracks_system.values() if file is not None])
+        else:
+            sound_pack = None
+
+        # creating low latency engine for system sounds
+        if system_sound_sink is None:
+            engine = None
+        else:
+            if system_sound_sink == "alsa":
+                sink = judsound_sound.SinkAlsa()
+            elif system_sound_sink == "null":
+                sink = judsound_sound.SinkFile()
+            else:
+                sink = judsound_sound.SinkFile(path = system_sound_sink)
+            engine = judsound_sound.Engine(
+                path_sound = path_system_sound,
+                files = tracks_system.values(),
+                sink = sink,
+                pack = sound_pack)
+
+        # loudness of audio files, measured in the background (see start)
+        if file_to_loudness is not None:
+            self.loudness = judsound_loudness.Loudness(file_index = file_to_loudness)
+        else:
+            self.loudness = None
+        self.paths_sound = [path_system_sound, path_music_day, path_music_night]
 
         # creating players (volume is set to day, waiting for clock to be created)
+        # (all players share the VLC instance of the system player)
         self.player_system = judsound_player.Player(
             path_music = path_system_sound,
             tracks_dictionary = tracks_system,
-            vol = vol_system_day)
+            vol = vol_system_day,
+            prewarm = [tracks_system["start"], tracks_system["volume"]],
+            engine = engine,
+            loudness = self.loudness)
+
+        # positions reached in playlists are checkpointed in batches (see judsound_playlist.Positions)
+        if file_to_positions is not None:
+            self.positions = judsound_playlist.Positions(file_to_positions = file_to_positions)
+        else:
+            self.positions = None
 
         self.player_music_day = judsound_player.Player(
             path_music = path_music_day,
-            vol = vol_music_day)
+            vol = vol_music_day,
+            instance_vlc = self.player_system.instance_vlc,
+            positions = self.positions,
+            loudness = self.loudness)
         
         self.player_music_night = judsound_player.Player(
             path_music = path_music_night,
-            vol = vol_music_day)
+            vol = vol_music_day,
+            instance_vlc = self.player_system.instance_vlc,
+            positions = self.positions,
+            loudness = self.loudness)
+
+        # setting cache for time announcements
+        if speech_cache_size > 0:
+            speech_cache = judsound_speech.SpeechCache(
+                path_system_sound = path_system_sound,
+                tracks_dictionary = tracks_system,
+                size = speech_cache_size,
+                path_cache = path_speech_cache,
+                pack = sound_pack)
+        else:
+            speech_cache = None
 
         # setting clock (must happened before creating players)
         self.clock = judsound_clock.Clock(
@@ -140,7 +293,10 @@ class Box:
             night_day_h = night_day_h,
             day_night_h = day_night_h,
             vol_alarm = vol_alarm,
-            vol_diff_hours = vol_diff_hours)
+            vol_diff_hours = vol_diff_hours,
+            speech_cache = speech_cache,
+            alarm_fade_in = alarm_fade_in,
+            alarm_duration = alarm_duration)
 
         # adjusting initial volume for players now that clock is available
         self.player_system.change_volume(
@@ -164,154 +320,548 @@ class Box:
                 vol_night = vol_system_night))
 
 
+        self.volume_startup_msg = vol_startup_msg
+
+        # setting current and fallback modes (fallback = mode when leaving the alarm mode)
+        self.machine = judsound_modes.Machine(handler = self, modes = modes, cycle = possible_modes)
+        self.machine.fallback = "player_day" if self.clock.is_day() else "player_night"
+
+        # changes of state are reported to listeners (see notify)
+        self.listeners = []
+        self.machine.listeners.append(self.notify)
+        self.clock.listeners.append(self.notify)
+        self.path_control_socket = path_control_socket
+        self.control = None
+        self.change_mode(mode = self.machine.fallback, speak = False)
+
+        self.time_init = time_init
+        self.running = False
+
+        # watchdog of systemd (the main loop must notify systemd at least every WATCHDOG_USEC)
+        watchdog_usec = os.environ.get("WATCHDOG_USEC")
+        self.watchdog_interval = int(watchdog_usec) / 2e6 if watchdog_usec else None
+
+
+    def start(self):
+        "Play the welcome message and start the threads handling inputs (buttons respond from then on)"
+
+        self.running = True # set before sounds are played, so that stop() can be called during start()
+
         # initialisation (note: if initialisation skipped, first time sound played do not work... not sure why)
-        self.clock.speak(vol_override = 1) ## tell current time once for initialisation
-        self.player_system.play_sound(track_name = "start", vol_override = 1)  ## tell start message once for initialisation
-        
+        self.player_system.preroll(file = self.player_system.tracks_dictionary["start"]) ## play start message silently once for initialisation
+
         # welcome message
         self.player_system.play_sound(track_name = "start",
-                                      vol_override = vol_startup_msg)
+                                      vol_override = self.volume_startup_msg)
 
-        # setting current and fallback modes
-        self.mode_list = possible_modes
-        if self.clock.is_day():
-            self.mode_fallback = "player_day" # fallback = mode when leaving the alarm mode
-            self.mode_current = "player_day"    
-        else:
-            self.mode_fallback = "player_night"
-            self.mode_current = "player_night"
-        self.change_mode(mode = self.mode_current, speak = False)
+        # applying volume changes from the rotary encoder in a single worker thread
+        self.thread_volume = threading.Thread(target = self.apply_volume, daemon = True)
+        self.thread_volume.start()
+
+        # running the actions of buttons and main loop one at a time
+        self.time_action_started = time.monotonic()
+        self.thread_dispatch = threading.Thread(target = self.dispatch, daemon = True)
+        self.thread_dispatch.start()
+
+        if self.positions is not None:
+            self.positions.start_checkpoints()
+
+        # setting when the main loop must wake up
+        self.scheduler = judsound_clock.Scheduler(clock = self.clock)
+        notify_systemd("READY=1")
+
+        # letting local programs drive the box
+        if self.path_control_socket is not None:
+            self.control = judsound_control.Server(box = self, path_socket = self.path_control_socket)
+            self.listeners.append(self.control.notify)
+            self.control.start()
+
+        # measuring new or changed audio files (at low priority, once the box is ready)
+        if self.loudness is not None:
+            self.loudness.analyse_all(directories = self.paths_sound)
+
+        # boot latency (buttons respond from now on)
+        time_responsive = time.monotonic() - self.time_init
+        judsound_log.metrics.observe("boot_to_responsive", time_responsive)
+        log.info("box responsive %.2f s after initialisation started (%.2f s after boot)",
+                 time_responsive, time.clock_gettime(time.CLOCK_BOOTTIME))
+
+
+    def run(self):
+        "Run the main loop till stop() is called, then release everything (start() must have been called)"
 
         # main loop: running alarm and automatic mode change (which happens if not playing)
         # FIXME? it still change mode if a music is paused, good behaviour?
         #        could be checked with get_state() in vlc as it should return the status "Paused"
-        while(True):
-            self.clock.ring_alarm()
-            if self.clock.is_day() and not self.player_music_day.player.is_playing() and not self.player_music_night.player.is_playing() and not self.player_system.player.is_playing() and not self.mode_current == "alarm":
-                self.mode_fallback = "player_day"
-                self.change_mode(mode = "player_day", speak = False)
-                self.player_system.change_volume(vol = self.volume_system_day)
-                self.player_music_day.change_volume(vol = self.volume_music_day)
-                self.player_music_night.change_volume(vol = self.volume_music_day)
-            elif not self.clock.is_day() and not self.player_music_day.player.is_playing() and not self.player_music_night.player.is_playing() and not self.player_system.player.is_playing() and not self.mode_current == "alarm":
-                self.mode_fallback = "player_night"
-                self.change_mode(mode = "player_night", speak = False)
-                self.player_system.change_volume(vol = self.volume_system_night)
-                self.player_music_day.change_volume(vol = self.volume_music_night)
-                self.player_music_night.change_volume(vol = self.volume_music_night)
-            time.sleep(60) # we check things every 60 secs
+        # the loop sleeps until the next alarm or day/night switch (or until alarms are modified)
+        # (when idle, it only wakes up for these and for the watchdog, inputs being handled by other threads)
+        while self.running:
+            max_wait = self.watchdog_interval
+            if self.idle_time is not None and not self.idle:
+                wait_idle = self.time_active + self.idle_time - time.monotonic()
+                max_wait = wait_idle if max_wait is None else min(max_wait, wait_idle)
+            due = self.scheduler.wait(max_wait = max_wait)
+            if not self.running:
+                break
+            if self.idle:
+                self.idle_wakeups += 1
+                judsound_log.metrics.count("idle_wakeups")
+            if self.watchdog_interval is not None and not self.stuck():
+                notify_systemd("WATCHDOG=1") # not sent if an action is stuck, so that systemd restarts the box
+            if "alarm" in due:
+                self.submit(self.clock.ring_alarm, from_input = False)
+            if "day_night" in due:
+                # (after idle_time without input, the alarm mode has been left by the user, so it does not delay the switch)
+                if self.busy or self.player_music_day.is_playing() or self.player_music_night.is_playing() or self.player_system.is_playing() or (self.mode_current == "alarm" and not self.idle):
+                    self.scheduler.retry_in(60) # we check things again in 60 secs
+                else:
+                    self.submit(self.switch_day_night, from_input = False)
+            if self.idle_time is not None and not self.idle and time.monotonic() - self.time_active >= self.idle_time:
+                if self.busy or self.player_music_day.is_active() or self.player_music_night.is_active() or self.player_system.is_playing():
+                    self.time_active = time.monotonic() # checked again after idle_time
+                else:
+                    self.time_active = time.monotonic()
+                    self.submit(self.enter_idle, from_input = False, since = self.time_active)
+        self.close()
+
+
+    def stuck(self):
+        """Tell whether the current action seems stuck (for the watchdog)
+
+        An action making progress plays sounds: a ringing alarm lasts up to alarm_duration, but
+        plays the alarm sound again and again, so it is only stuck if no sound started or played
+        for longer than the watchdog period.
+        """
+        if not self.busy:
+            return False
+        time_progress = max(self.time_action_started, self.player_system.time_started or 0)
+        return time.monotonic() - time_progress > 2 * self.watchdog_interval and not self.player_system.is_playing()
+
+
+    def stop(self):
+        """Ask the main loop to stop (it then releases everything)
+
+        This can be called from a signal handler or from another thread.
+        """
+        log.info("stopping")
+        self.running = False
+        self.clock.alarms_changed.set() # wake up the main loop
+
+
+    def close(self):
+        "Wait for the current action to complete, then stop players and release hardware and VLC"
+        notify_systemd("STOPPING=1")
+        if self.control is not None:
+            self.control.stop()
+        # alarms are written to file (atomically) as soon as they change, so letting the
+        # current action complete is enough for the alarm file to be up to date
+        # (its sounds are cut short, e.g. a ringing alarm, and the actions still queued run silently)
+        self.player_system.interrupt()
+        self.commands.put((None, {}, time.monotonic(), False, None))
+        self.thread_dispatch.join(timeout = 10)
+        self.volume_request.set() # wake up the volume thread so that it ends
+        self.thread_volume.join(timeout = 1)
+        for btn in self.push_buttons + [self.button_rotary_push, self.button_rotary_turn]:
+            btn.close()
+        if self.positions is not None:
+            self.positions.close() # last checkpoint, while players can still tell where they are
+        # the system player owns the VLC instance shared by all players, so it is released last
+        if self.thread_dispatch.is_alive():
+            # VLC must not be released while the dispatcher may still use it (it is freed when the process ends)
+            log.warning("current action still running after 10 s, players not released")
+        else:
+            for player in (self.player_music_day, self.player_music_night, self.player_system):
+                player.release()
+        if self.loudness is not None:
+            self.loudness.close()
+        log.info("stopped")
+
+
+    def submit(self, action, barge_in = False, from_input = True, **kwargs):
+        """Queue an action to be run by the dispatcher thread
+
+        This is called from gpiozero callback threads and from the main loop, so that these
+        never block on sounds and the state of the box is only changed by one thread.
+
+        Keyword arguments:
+        action -- the function to run
+        barge_in -- a boolean indicating whether or not to cut short the announcement in progress
+        from_input -- a boolean indicating whether the action answers an input (only then is the
+                      latency from input to sound measured)
+        kwargs -- the arguments to pass to action
+
+        Return a concurrent.futures.Future giving the result of the action once it has run.
+        """
+        if barge_in and self.busy:
+            log.info("barge-in: interrupting current action")
+            judsound_log.metrics.count("barge_ins")
+            self.player_system.interrupt()
+        future = concurrent.futures.Future()
+        self.commands.put((action, kwargs, time.monotonic(), from_input, future))
+        return future
+
+
+    def dispatch(self):
+        "Run queued actions one after the other (run in its own thread)"
+        while True:
+            action, kwargs, time_submit, from_input, future = self.commands.get()
+            if action is None: # sent by close()
+                break
+            if not future.set_running_or_notify_cancel():
+                continue # cancelled while queued (e.g. a control command which timed out)
+            if self.idle:
+                self.leave_idle(time_input = time_submit if from_input else None)
+            players = (self.player_system, self.player_music_day, self.player_music_night)
+            for player in players:
+                player.mark()
+            self.time_action_started = time.monotonic()
+            self.busy = True
+            if self.running: # sounds stay interrupted once the box is stopping (see close)
+                self.player_system.resume()
+            judsound_log.metrics.count("actions")
+            try:
+                result = action(**kwargs)
+            except Exception as error:
+                log.exception("action %s failed", action.__name__) # the dispatcher must survive a failing action
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+            finally:
+                self.busy = False
+                self.time_active = time.monotonic()
+            times_started = [player.time_first_started for player in players if player.time_first_started is not None]
+            if from_input and times_started:
+                latency = min(times_started) - time_submit
+                judsound_log.metrics.observe("input_to_sound", latency)
+                log.debug("%s: %.0f ms from input to first sound", action.__name__, 1000 * latency)
+                if self.time_woken is not None: # first sound since the box woke up
+                    self.time_woken = None
+                    judsound_log.metrics.observe("resume_to_sound", latency)
+
+
+    def enter_idle(self, since):
+        """Release the audio output after idle_time of silence (queued by the main loop)
+
+        Paused music is stopped (it resumes from where it was), the sound engine closes its output
+        and positions are no longer checkpointed. The next action, or turn of the rotary encoder,
+        wakes the box up again (see leave_idle), the audio output being opened by the first sound.
+
+        Keyword arguments:
+        since -- the timestamp (time.monotonic) of the check for silence (nothing is done if an action ran since)
+        """
+        players = (self.player_system, self.player_music_day, self.player_music_night)
+        if self.idle or self.time_active > since or any(player.is_active() for player in players):
+            return
+        for player in players:
+            player.release_output()
+        if self.positions is not None:
+            self.positions.suspend()
+        with self.lock_idle:
+            self.idle = True
+            self.time_idle = time.monotonic()
+        log.info("idle after %.0f s of silence: audio output released", self.idle_time)
+        self.notify("idle", state = True)
+
+
+    def leave_idle(self, time_input):
+        """Get ready to play again after enter_idle (called before the first action or volume change)
+
+        Keyword arguments:
+        time_input -- the timestamp (time.monotonic) of the input which wakes the box up (None if it is not an input)
+
+        The latency of the first sound played afterwards is reported as resume_to_sound.
+        """
+        with self.lock_idle:
+            if not self.idle:
+                return
+            self.idle = False
+            self.time_active = time.monotonic()
+            self.idle_seconds += self.time_active - self.time_idle
+            self.time_woken = time_input
+        if self.positions is not None:
+            self.positions.wake()
+        self.clock.alarms_changed.set() # wake up the main loop, so that it checks for silence again
+        log.info("waking up after %.0f s idle", self.time_active - self.time_idle)
+        self.notify("idle", state = False)
+
+
+    def idle_stats(self):
+        "Get the time spent idle, and how often the main loop woke up meanwhile"
+        with self.lock_idle:
+            seconds = self.idle_seconds + (time.monotonic() - self.time_idle if self.idle else 0)
+        return {"idle": self.idle,
+                "hours": seconds / 3600,
+                "wakeups": self.idle_wakeups,
+                "wakeups_per_hour": self.idle_wakeups * 3600 / seconds if seconds > 0 else 0}
+
+
+    @staticmethod
+    def complete_tracks(tracks_system):
+        "Get the dictionary for system sounds, with the sounds of hours and minutes added"
+        tracks_system = dict(tracks_system)
+        for m in range(60):
+            key = f'{m:02d}'
+            tracks_system[key] = key + '.mp3' # add minutes/hours to dictionary
+        return tracks_system
+
+
+    def reconfigure(self, **settings):
+        """Apply new values of settings (arguments of the box) while running (see judsound_config)
+
+        Only the parts of the box affected are updated: volumes, clock (alarm, day/night hours),
+        hold time, system sounds, fades and idle time. Other settings need a restart.
+
+        Keyword arguments:
+        settings -- the settings which changed, with their new values
+        """
+
+        volumes = {"vol_min": "volume_min", "vol_max": "volume_max",
+                   "vol_music_day": "volume_music_day", "vol_music_night": "volume_music_night",
+                   "vol_system_day": "volume_system_day", "vol_system_night": "volume_system_night",
+                   "vol_startup_msg": "volume_startup_msg"}
+        clock = {"vol_alarm": "volume_alarm", "vol_diff_hours": "extra_volume_hours",
+                 "alarm_fade_in": "alarm_fade_in", "alarm_duration": "alarm_duration",
+                 "night_day_h": "night_day_h", "day_night_h": "day_night_h"}
+        box = {"fade_time": "fade_time", "idle_time": "idle_time", "hold_time": "hold_time"}
+        unknown = settings.keys() - volumes.keys() - clock.keys() - box.keys() - {"tracks_system"}
+        if unknown:
+            raise ValueError(f"Settings not applied while running: {sorted(unknown)}")
+        if "tracks_system" in settings:
+            tracks_system = self.complete_tracks(tracks_system = settings["tracks_system"])
+            missing = self.player_system.tracks_dictionary.keys() - tracks_system.keys()
+            if missing:
+                raise ValueError(f"System sounds missing from tracks_system: {sorted(missing)}")
+        for names, target in ((volumes, self), (clock, self.clock), (box, self)):
+            for name, attribute in names.items():
+                if name in settings:
+                    setattr(target, attribute, settings[name])
+
+        if "night_day_h" in settings or "day_night_h" in settings:
+            # day/night boundaries: the cached period of the day and the wake-ups of the main loop are recomputed
+            self.clock.day_valid_until = 0
+            self.machine.fallback = "player_day" if self.clock.is_day() else "player_night"
+        if volumes.keys() & settings.keys() or "night_day_h" in settings or "day_night_h" in settings:
+            # volume tables: baseline volumes of the time of the day, and range of the rotary encoder
+            self.set_music_volume()
+            vol_system = self.select_volume(vol_day = self.volume_system_day, vol_night = self.volume_system_night)
+            self.player_system.change_volume(vol = vol_system, duration = self.fade_time)
+            self.set_steps_rotary(vol = vol_system)
+            self.notify("volume", volume = self.volume_current())
+        if "hold_time" in settings:
+            for btn in self.push_buttons + [self.button_rotary_push]:
+                btn.hold_time = self.hold_time
+        if "tracks_system" in settings:
+            # sound map: sounds missing from the engine (or from its pack) are played with VLC
+            self.player_system.set_tracks_dictionary(tracks_dictionary = tracks_system)
+            if self.clock.speech_cache is not None:
+                self.clock.speech_cache.tracks_dictionary = self.player_system.tracks_dictionary
+                self.clock.speech_cache.clear() # announcements may be made of other clips
+        self.clock.alarms_changed.set() # wake up the main loop, so that it recomputes when to wake up
+        log.info("settings applied: %s", ", ".join(sorted(settings)))
+        self.notify("settings", names = sorted(settings))
+
+
+    def switch_day_night(self):
+        "Switch mode and volumes according to time of the day"
+        if self.clock.is_day():
+            self.machine.fallback = "player_day"
+            self.change_mode(mode = "player_day", speak = False)
+            self.player_system.change_volume(vol = self.volume_system_day, duration = self.fade_time)
+            self.player_music_day.change_volume(vol = self.volume_music_day)
+            self.player_music_night.change_volume(vol = self.volume_music_day)
+        else:
+            self.machine.fallback = "player_night"
+            self.change_mode(mode = "player_night", speak = False)
+            self.player_system.change_volume(vol = self.volume_system_night, duration = self.fade_time)
+            self.player_music_day.change_volume(vol = self.volume_music_night)
+            self.player_music_night.change_volume(vol = self.volume_music_night)
 
 
     def push_top_button(self, button_index):
-        "Decide what to do when a push button is pressed"
+        """Decide what to do when a push button is pressed
+
+        Modes in which holding a button has a meaning (player modes and alarm setting) have no
+        rule for presses: the action happens either in hold_top_button() or in
+        release_top_button(), depending on how long the button stays pressed.
+        """
 
         btn = self.push_buttons[button_index]
-        if self.mode_current == "player_night":
-            while btn.is_pressed:
-                if btn.active_time > self.hold_time:
-                    print(f"button {button_index} was held")
-                    self.player_music_night.stop()
-                    return
-            print(f"button {button_index} was pressed")
-            self.player_music_night.play_music(track_index = button_index)
-
-        elif self.mode_current == "player_day":
-            while btn.is_pressed:
-                if btn.active_time > self.hold_time:
-                    print(f"button {button_index} was held")
-                    self.player_music_day.stop()
-                    return
-            print(f"button {button_index} was pressed")
-            self.player_music_day.play_music(track_index = button_index)
-
-        elif self.mode_current == "alarm":
-            # go to alarm setting
-            if button_index == 0:
-                print(f"entering alarm setting")
-                self.clock.reset_soft(speak = False)
-                self.change_mode(mode = "alarm_setting")
-            # list all alarms
-            elif button_index == 1:
-                print(f"listing alarms")
-                self.clock.list_alarms()
-                self.change_mode(mode = "alarm")
-            # delete all alarms
-            elif button_index == 2:
-                print(f"deleting alarm")
-                self.clock.reset_hard()
-                self.change_mode(mode = "alarm")
-            # quit and return to fallback mode
-            elif button_index == 3:
-                self.change_mode(mode = self.mode_fallback)
-
-        elif self.mode_current == "alarm_setting":
-            while btn.is_pressed:
-                if btn.active_time > self.hold_time:
-                    if self.clock.check_unregistered_alarm():
-                        self.change_mode(mode = "alarm_validation")
-                    else:
-                        self.change_mode(mode = "alarm_setting")
-                    return
-            self.clock.alarm[button_index] = (self.clock.alarm[button_index] + 1) % [3, 10, 6, 10][button_index]
-            # nb: that time is correct and not e.g. 26:30 is checked in Clock.check_unregistered_alarm()
-            print(f"alarm value updated to {self.clock.alarm}")
-
-        elif self.mode_current == "alarm_validation":
-            # validate and return to fallback mode
-            print(f"validate alarm")
-            if button_index == 0:
-                self.clock.register_alarm()
-                self.change_mode(mode = self.mode_fallback)
-            # redo
-            elif button_index == 1:
-                print(f"validate setting reset")
-                self.clock.reset_soft()
-                self.change_mode(mode = "alarm_setting")
-            # listen again
-            elif button_index == 2:
-                print(f"recheck alarm")
-                self.clock.speak(time_to_read = self.clock.alarm)
-                self.change_mode(mode = "alarm_validation")
-            # quit and return to fallback mode
-            elif button_index == 3:
-                print(f"quit alarm setting")
-                self.change_mode(mode = self.mode_fallback)
-
-
-    def change_mode(self, mode, speak = True, update_volume = False):
-        if mode == "alarm":
-            self.clock.reset_soft(speak = False)
-        elif mode not in ["alarm_validation", "alarm_setting", "player_night", "player_day"]:
-            raise ValueError('Unknown mode: '+mode)
-        self.player_music_day.player.stop()
-        self.player_music_night.player.stop()
-        self.player_music_day.change_volume(
-            vol = self.select_volume(
-                vol_day = self.volume_music_day,
-                vol_night = self.volume_music_night))
-        self.player_music_night.change_volume(
-            vol = self.select_volume(
-                vol_day = self.volume_music_day,
-                vol_night = self.volume_music_night))
-        self.mode_current = mode
-        if speak:
-            self.player_system.play_sound(track_name = mode,
-                                          wait_till_completion = False)
-        print(self.mode_current)
+        btn.was_held = False
+        btn.mode_at_press = self.mode_current
+        self.machine.handle(event = "press", button_index = button_index)
+
+
+    def hold_top_button(self, button_index):
+        "Decide what to do when a push button has been pressed for longer than hold_time"
+
+        btn = self.push_buttons[button_index]
+        if btn.mode_at_press != self.mode_current:
+            return # mode changed since the press started (e.g. press used to enter alarm setting)
+        btn.was_held = True
+        log.debug("button %s was held", button_index)
+        self.machine.handle(event = "hold", button_index = button_index)
+
 
+    def release_top_button(self, button_index):
+        "Decide what to do when a push button is released before hold_time"
+
+        btn = self.push_buttons[button_index]
+        if btn.was_held or btn.mode_at_press != self.mode_current:
+            return
+        log.debug("button %s was pressed", button_index)
+        self.machine.handle(event = "release", button_index = button_index)
+
+
+    @property
+    def mode_current(self):
+        "Get the current mode"
+        return self.machine.mode
+
+
+    def change_mode(self, mode, speak = True):
+        """Go to a mode (see judsound_modes)
+
+        Keyword arguments:
+        mode -- the name of the mode, or "fallback"
+        speak -- a boolean indicating whether or not to announce the mode
+        """
+        self.machine.goto(mode = mode, announce = speak)
+
+
+    ## ACTIONS OF MODES (see judsound_modes.MODES)
+
+    def announce(self, mode):
+        "Play the sound of a mode"
+        self.player_system.play_sound(track_name = mode,
+                                      wait_till_completion = False)
+
+
+    def music_player(self):
+        "Get the music player of the current mode (the day player in modes without music)"
+        if self.machine.option("music") == "night":
+            return self.player_music_night
+        return self.player_music_day
+
+
+    def fade_out_music(self):
+        "Fade out music (positions are recorded when it stops, so that playlists resume where they were)"
+        self.player_music_day.fade_out(duration = self.fade_time)
+        self.player_music_night.fade_out(duration = self.fade_time)
+
+
+    def set_music_volume(self):
+        "Set the volume of music players according to the time of the day"
+        vol = self.select_volume(vol_day = self.volume_music_day, vol_night = self.volume_music_night)
+        self.player_music_day.change_volume(vol = vol)
+        self.player_music_night.change_volume(vol = vol)
+
+
+    def play_music(self, button_index):
+        "Play, pause or resume the playlist of a push button"
+        self.music_player().play_music(track_index = button_index)
+
+
+    def hold_music(self, button_index):
+        "Skip to the next track if the playlist of the button is playing (and has one), or stop the music"
+        player = self.music_player()
+        if (player.track_current == button_index and player.player.is_playing()
+                and player.playlist.following() is not None):
+            player.next_track()
+        else:
+            player.stop()
+
+
+    def skip_track(self, step = 1):
+        """Move within the playlist of the music player of the current mode
+
+        Keyword arguments:
+        step -- 1 to go to the next track, -1 to go back to the previous one
+        """
+
+        if step > 0:
+            self.music_player().next_track()
+        else:
+            self.music_player().previous_track()
+
+
+    def reset_alarm(self):
+        "Forget the alarm being set"
+        self.clock.reset_soft(speak = False)
+
+
+    def enter_alarm_setting(self, button_index = None):
+        "Start setting an alarm"
+        log.info("entering alarm setting")
+        self.clock.reset_soft(speak = False)
+
+
+    def list_alarms(self, button_index = None):
+        "Tell all alarms"
+        log.info("listing alarms")
+        self.clock.list_alarms()
+
+
+    def delete_alarms(self, button_index = None):
+        "Delete all alarms"
+        log.info("deleting alarm")
+        self.clock.reset_hard()
+
+
+    def increment_alarm_digit(self, button_index):
+        "Increase the digit of the alarm being set which matches a push button"
+        self.clock.alarm[button_index] = (self.clock.alarm[button_index] + 1) % [3, 10, 6, 10][button_index]
+        # nb: that time is correct and not e.g. 26:30 is checked in Clock.check_unregistered_alarm()
+        log.info("alarm value updated to %s", self.clock.alarm)
+
+
+    def check_alarm(self, button_index = None):
+        "Go to validation if the alarm being set is a correct new one, or start setting it again"
+        if self.clock.check_unregistered_alarm():
+            return "alarm_validation"
+        return "alarm_setting"
+
+
+    def register_alarm(self, button_index = None):
+        "Save the alarm being set"
+        log.info("validate alarm")
+        self.clock.register_alarm()
+
+
+    def reset_alarm_setting(self, button_index = None):
+        "Start setting the alarm again"
+        log.info("validate setting reset")
+        self.clock.reset_soft()
+
+
+    def speak_alarm(self, button_index = None):
+        "Tell the alarm being set again"
+        log.info("recheck alarm")
+        self.clock.speak(time_to_read = self.clock.alarm)
+
+
+    def quit_alarm_setting(self, button_index = None):
+        "Leave alarm setting without saving the alarm"
+        log.info("quit alarm setting")
+
+
+    ## MODE BUTTON
 
     def push_mode_button(self):
+        "Record the press of the mode button (the action depends on how long it is pressed)"
+        self.button_rotary_push.was_held = False
+
+
+    def hold_mode_button(self):
         "Change the mode to the next one"
-        while self.button_rotary_push.is_pressed:
-            if self.button_rotary_push.active_time > self.hold_time:
-                print(f"button mode was active for more than {self.hold_time} sec")
-                if self.mode_current.startswith("alarm_"): # as alarm submodes have no index
-                    self.mode_current = "alarm"
-                i = self.mode_list.index(self.mode_current)
-                i = i + 1 if i + 1 < len(self.mode_list) else 0
-                self.change_mode(mode = self.mode_list[i])
-                return
-        self.clock.speak() ## tell current time
+        log.debug("button mode was active for more than %s sec", self.hold_time)
+        self.button_rotary_push.was_held = True
+        self.machine.cycle()
+
+
+    def release_mode_button(self):
+        "Tell the current time if the mode button was not held"
+        if not self.button_rotary_push.was_held:
+            self.clock.speak() ## tell current time
 
 
     @staticmethod
@@ -329,44 +879,94 @@ class Box:
 
 
     def change_volume(self):
-        "Update the volume"
-        if self.clock.is_day():
-            volume_system = self.volume_system_day
-            volume_music = self.volume_music_day
-        else:
-            volume_system = self.volume_system_night
-            volume_music = self.volume_music_night
-
-        if not self.player_music_day.player.is_playing() and not self.player_music_night.player.is_playing():
-            # update system volume when music is not playing 
-                volume_system = self.steps_to_volume(
-                    steps = self.button_rotary_turn.steps,
-                    vol_min = self.volume_min,
-                    vol_max = self.volume_max,
-                    max_steps = self.max_steps)
-                self.player_system.change_volume(vol = volume_system)
-                if not self.player_system.player.is_playing():
-                    # feedback for sound change when no sound is playing
-                    self.player_system.play_sound(
-                        track_name = "volume",
-                        wait_till_completion = False,
-                        sleep = 0.1)
-        else:
-            # update music volume as music is playing
-            volume_music = self.steps_to_volume(
+        """Request a volume update (called by the rotary encoder for each step)
+
+        The update itself is done by apply_volume(), which only considers the latest position
+        of the encoder, so that fast turns do not pile up callbacks.
+        """
+        self.volume_request.set()
+
+
+    def apply_volume(self):
+        "Update the volume whenever requested, at a bounded rate (run in its own thread)"
+        time_feedback = 0
+        while True:
+            self.volume_request.wait()
+            self.volume_request.clear()
+            if not self.running:
+                break
+            time_request = time.monotonic()
+            if self.idle:
+                self.leave_idle(time_input = time_request)
+            self.time_active = time_request
+
+            day = self.clock.is_day()
+            if day:
+                volume_system = self.volume_system_day
+                volume_music = self.volume_music_day
+            else:
+                volume_system = self.volume_system_night
+                volume_music = self.volume_music_night
+
+            volume = self.steps_to_volume(
                 steps = self.button_rotary_turn.steps,
                 vol_min = self.volume_min,
                 vol_max = self.volume_max,
                 max_steps = self.max_steps)
-            self.player_music_day.change_volume(vol = volume_music)
-            self.player_music_night.change_volume(vol = volume_music)
 
-        if self.clock.is_day():
-            self.volume_system_day = volume_system
-            self.volume_music_day = volume_music
-        else:
-            self.volume_system_night = volume_system
-            self.volume_music_night = volume_music
+            if not self.player_music_day.is_playing() and not self.player_music_night.is_playing():
+                # update system volume when music is not playing 
+                volume_system = volume
+                self.player_system.change_volume(vol = volume_system)
+                if (not self.busy and not self.player_system.is_playing()
+                        and time.monotonic() - time_feedback > self.volume_feedback_interval):
+                    # feedback for sound change when no sound is playing (played by the dispatcher, like all sounds)
+                    time_feedback = time.monotonic()
+                    self.submit(self.volume_feedback)
+            else:
+                # update music volume as music is playing
+                volume_music = volume
+                self.player_music_day.change_volume(vol = volume_music)
+                self.player_music_night.change_volume(vol = volume_music)
+
+            if day:
+                self.volume_system_day = volume_system
+                self.volume_music_day = volume_music
+            else:
+                self.volume_system_night = volume_system
+                self.volume_music_night = volume_music
+            self.notify("volume", volume = volume)
+
+            time.sleep(self.volume_update_interval) # steps arriving meanwhile are merged into the next update
+
+
+    def volume_feedback(self):
+        "Play the feedback sound of a volume change, unless a sound started meanwhile (queued by apply_volume)"
+        if not self.player_system.is_playing():
+            self.player_system.play_sound(
+                track_name = "volume",
+                wait_till_completion = False,
+                sleep = 0)
+
+
+    def set_volume(self, vol):
+        "Set the volume as if the rotary encoder had been turned to it (within vol_min and vol_max)"
+        self.set_steps_rotary(vol = max(self.volume_min, min(self.volume_max, vol)))
+        self.change_volume()
+
+
+    def volume_current(self):
+        "Get the volume matching the position of the rotary encoder"
+        return self.steps_to_volume(steps = self.button_rotary_turn.steps,
+                                    vol_min = self.volume_min,
+                                    vol_max = self.volume_max,
+                                    max_steps = self.max_steps)
+
+
+    def notify(self, event, **data):
+        "Tell the listeners (e.g. the control server) about a change of state"
+        for listener in self.listeners:
+            listener(event, **data)
 
 
     def select_volume(self, vol_day, vol_night):
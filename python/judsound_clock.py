@@ -1,6 +1,115 @@
 #!/usr/bin/python3
 
+import os
 import time
+import datetime
+import heapq
+import logging
+import threading
+import judsound_log
+
+log = logging.getLogger(__name__)
+
+
+class Alarm:
+    """Define the class which describes an alarm: a time of the day, the days on which it rings and the dates it skips
+
+    An alarm is written as a line of the alarms file: "HHMM" for an alarm which rings once (as in older
+    files), optionally followed by the days on which it rings again and again ("daily", "weekdays",
+    "weekends" or days such as "mon,wed,fri") and by dates to skip once, e.g. "0730 weekdays skip=2024-12-25".
+    """
+
+    days_names = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+    days_groups = {"daily": frozenset(range(7)), "weekdays": frozenset(range(5)), "weekends": frozenset((5, 6))}
+
+    def __init__(self, digits, days = (), skip = ()):
+        """Initialize the alarm
+
+        Keyword arguments:
+        digits -- the time as [h, h, m, m]
+        days -- the days of the week on which it rings (0 = Monday), default = (): rings once
+        skip -- the dates (datetime.date) on which it does not ring
+        """
+
+        self.digits = list(digits)
+        self.days = frozenset(days)
+        self.skip = frozenset(skip)
+
+    @classmethod
+    def parse(cls, text):
+        "Get an alarm from its text, with the time as HHMM or HH:MM (raise ValueError if it is not valid)"
+        words = text.split()
+        if not words:
+            raise ValueError("Empty alarm")
+        digits = [int(digit) for digit in words[0].replace(":", "")]
+        if len(digits) != 4 or digits[0] * 10 + digits[1] > 23 or digits[2] > 5:
+            raise ValueError(f"Invalid time: {words[0]}")
+        days, skip = set(), set()
+        for word in words[1:]:
+            if word.startswith("skip="):
+                skip.update(datetime.date.fromisoformat(date) for date in word[5:].split(","))
+            elif word in cls.days_groups:
+                days.update(cls.days_groups[word])
+            else:
+                for name in word.split(","):
+                    if name not in cls.days_names:
+                        raise ValueError(f"Invalid day: {name}")
+                    days.add(cls.days_names.index(name))
+        return cls(digits = digits, days = days, skip = skip)
+
+    def text_days(self):
+        "Get the days on which the alarm rings, as written in the alarms file (empty if it rings once)"
+        for name, days in self.days_groups.items():
+            if self.days == days:
+                return name
+        return ",".join(self.days_names[day] for day in sorted(self.days))
+
+    def text(self, separator = ""):
+        "Get the text of the alarm, as written in the alarms file (with separator between hours and minutes)"
+        words = [separator.join(Clock.convert_hhmm_to_hm(time = self.digits)), self.text_days()]
+        if self.skip:
+            words.append("skip=" + ",".join(date.isoformat() for date in sorted(self.skip)))
+        return " ".join(word for word in words if word)
+
+    def key(self):
+        "Get what identifies the alarm (alarms are sorted on it)"
+        return (self.digits, sorted(self.days), sorted(self.skip))
+
+    def __eq__(self, other):
+        return isinstance(other, Alarm) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash((tuple(self.digits), self.days, self.skip))
+
+    def __repr__(self):
+        return f"Alarm({self.text()!r})"
+
+    def next_occurrence(self, after):
+        "Get the timestamp at which the alarm next rings strictly after the timestamp after"
+        start = datetime.datetime.fromtimestamp(after).date()
+        at = datetime.time(hour = self.digits[0] * 10 + self.digits[1], minute = self.digits[2] * 10 + self.digits[3])
+        for offset in range(8 + len(self.skip)): # a week (and a day, for today's time already passed) is enough
+            date = start + datetime.timedelta(days = offset)
+            if self.days and date.weekday() not in self.days or date in self.skip:
+                continue
+            occurrence = datetime.datetime.combine(date, at).timestamp()
+            if occurrence > after:
+                return occurrence
+        return None # only if all days are skipped
+
+    def skip_next(self, after):
+        "Get the alarm which skips the next occurrence of this one after the timestamp after"
+        occurrence = self.next_occurrence(after)
+        if occurrence is None:
+            return self
+        return Alarm(digits = self.digits, days = self.days,
+                     skip = self.skip | {datetime.datetime.fromtimestamp(occurrence).date()})
+
+    def expire(self, now):
+        "Get the alarm without the dates to skip which are past"
+        today = datetime.datetime.fromtimestamp(now).date()
+        return Alarm(digits = self.digits, days = self.days, skip = (date for date in self.skip if date >= today))
+
 
 class Clock:
     "Define the class which handles the alarm-clock"
@@ -12,7 +121,10 @@ class Clock:
         night_day_h = 6,
         day_night_h = 20,
         vol_alarm = 50,
-        vol_diff_hours = 1):
+        vol_diff_hours = 1,
+        speech_cache = None,
+        alarm_fade_in = 30,
+        alarm_duration = 300):
        """Initialize the clock
 
        Keyword arguments:
@@ -22,57 +134,175 @@ class Clock:
         day_night_h -- an integer specifying at what time the night period starts
         vol_alarm -- an integer specifying the volume level for the alarm
         vol_diff_hours -- an integer specifying how much more than the baseline volume to speak the hours
+        speech_cache -- an object of class SpeechCache used to tell the time in a single sound (default = None: no cache)
+        alarm_fade_in -- the time in sec for the alarm to go from silent to vol_alarm (0 = at once)
+        alarm_duration -- the maximum time in sec for which the alarm rings again and again if it is not dismissed
        """
 
        self.volume_alarm = vol_alarm
        self.extra_volume_hours = vol_diff_hours
        self.player_system = player_system
+       self.speech_cache = speech_cache
+       self.alarm_fade_in = alarm_fade_in
+       self.alarm_duration = alarm_duration
        self.file_to_alarms = file_to_alarms
        self.alarm = [0, 0, 0, 0] # a given alarm being set
-       self.alarms = [] # the list of alarms
+       self.alarms = [] # the list of alarms, as objects of class Alarm (in memory copy, source of truth once read)
+       self.index = [] # heap of (timestamp of next occurrence, position, alarm): the next alarm due is first
+       self.lock_index = threading.Lock() # the index is read by the main loop and updated by the dispatcher
+       self.alarms_file_id = None # (inode, mtime, size) of the text file when last read or written
+       self.count_reads = 0 # number of times the text file has been parsed
+       self.count_writes = 0 # number of times the text file has been written
        self.night_day_h = night_day_h
        self.day_night_h = day_night_h
+       self.alarms_changed = threading.Event() # set whenever the alarms are modified
+       self.day = None # cached result of is_day()
+       self.day_checked_at = 0 # timestamp at which self.day was computed
+       self.day_valid_until = 0 # timestamp of the next day/night boundary after self.day_checked_at
+       self.listeners = [] # functions called as listener(event, **data) when alarms change or ring
 
     @staticmethod
     def time():
         "Get hours and minutes from current time"
-        hours = time.strftime("%H", time.localtime())
-        minutes = time.strftime("%M", time.localtime())
-        return [hours, minutes]
+        now = time.localtime() # single snapshot, so that hours and minutes are consistent
+        return [f"{now.tm_hour:02d}", f"{now.tm_min:02d}"]
 
     def is_day(self):
-        "Figure out if it is currently the day or the night"
-        time = self.time()
-        if int(time[0]) >= self.night_day_h and int(time[0]) < self.day_night_h:
-            return True
-        return False
+        """Figure out if it is currently the day or the night
+
+        The result is cached until the next day/night boundary, so that calling this often is cheap.
+        """
+        now = time.time()
+        if not self.day_checked_at <= now < self.day_valid_until: # also recomputed if system time went backwards
+            hour = time.localtime(now).tm_hour
+            self.day = hour >= self.night_day_h and hour < self.day_night_h
+            self.day_checked_at = now
+            self.day_valid_until = min(
+                self.next_occurrence([self.night_day_h // 10, self.night_day_h % 10, 0, 0], now),
+                self.next_occurrence([self.day_night_h // 10, self.day_night_h % 10, 0, 0], now))
+        return self.day
 
     @staticmethod
     def convert_hhmm_to_hm(time):
         return [f"{time[0]}{time[1]}", f"{time[2]}{time[3]}"]
 
-    def read_alarms(self):
-        "Read the alarms from the text file"
+    @staticmethod
+    def next_occurrence(alarm, after):
+        "Get the timestamp at which a time given as [h, h, m, m] next occurs strictly after the timestamp after"
+        start = datetime.datetime.fromtimestamp(after)
+        target = start.replace(hour = alarm[0] * 10 + alarm[1],
+                               minute = alarm[2] * 10 + alarm[3],
+                               second = 0,
+                               microsecond = 0)
+        if target.timestamp() <= after:
+            target += datetime.timedelta(days = 1)
+        return target.timestamp()
+
+    def file_id(self):
+        "Get what identifies the current version of the text file (None if it does not exist)"
+        try:
+            stat = os.stat(self.file_to_alarms)
+        except FileNotFoundError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def read_alarms(self, force = False):
+        """Read the alarms from the text file if it has changed since last read or write
+
+        Return True if the alarms have been (re)loaded.
+        """
+        file_id = self.file_id()
+        if not force and file_id == self.alarms_file_id:
+            return False
         with open(self.file_to_alarms, "r") as file:
-            self.alarms = []
+            alarms = []
             for line in file:
-                digits = [int(digit) for digit in line.strip()]
-                assert len(digits) == 4, f"Size mismatch: { len(digits) } characters instead of 4"
-                self.alarms.append(digits)
+                if not line.strip():
+                    continue
+                try:
+                    alarms.append(Alarm.parse(line))
+                except ValueError as error:
+                    log.warning("alarm %r ignored (%s)", line.strip(), error)
+        self.alarms = alarms
+        self.alarms_file_id = file_id
+        self.count_reads += 1
+        self.index_alarms()
+        self.alarms_changed.set()
+        self.notify("alarms", alarms = self.alarms_text())
+        return True
 
     def write_alarms(self):
-        "Write the alarms into the text file"
-        self.alarms.sort() # sort the alarms
-        with open(self.file_to_alarms, "w") as file:
+        "Write the alarms into the text file (atomically, so that a power loss cannot truncate it)"
+        self.alarms.sort(key = Alarm.key) # sort the alarms
+        file_tmp = self.file_to_alarms + ".tmp"
+        with open(file_tmp, "w") as file:
             for alarm in self.alarms:
-                file.writelines(self.convert_hhmm_to_hm(time = alarm))
-                file.write("\n")
-            file.truncate()
+                file.write(alarm.text() + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file_tmp, self.file_to_alarms)
+        self.alarms_file_id = self.file_id()
+        self.count_writes += 1
+        self.index_alarms()
+        self.alarms_changed.set()
+        self.notify("alarms", alarms = self.alarms_text())
+
+    def index_alarms(self):
+        """Rebuild the index of the next occurrences of the alarms (after they changed)
+
+        Alarms already in the index keep their occurrence, so that an alarm due but not rung yet still rings;
+        new alarms get their next occurrence from now.
+        """
+        now = time.time()
+        with self.lock_index:
+            indexed = {alarm: occurrence for occurrence, _, alarm in self.index}
+            index = []
+            for i, alarm in enumerate(self.alarms):
+                occurrence = indexed.get(alarm) or alarm.next_occurrence(now)
+                if occurrence is not None:
+                    index.append((occurrence, i, alarm))
+            heapq.heapify(index)
+            self.index = index
+
+    def next_alarm(self):
+        "Get the timestamp at which the next alarm is due (None if there is no alarm)"
+        with self.lock_index:
+            return self.index[0][0] if self.index else None
+
+    def due_alarms(self, now):
+        """Take the alarms due at the timestamp now out of the index
+
+        Return a list of (timestamp of occurrence, alarm). Recurring alarms are put back into the
+        index at their next occurrence; one-time alarms are left for the caller to delete.
+        """
+        due = []
+        with self.lock_index:
+            while self.index and self.index[0][0] <= now:
+                occurrence, i, alarm = heapq.heappop(self.index)
+                due.append((occurrence, alarm))
+                if alarm.days:
+                    occurrence = alarm.next_occurrence(now)
+                    if occurrence is not None:
+                        heapq.heappush(self.index, (occurrence, i, alarm))
+        if due:
+            self.alarms_changed.set() # the next alarm is a new one
+        return due
+
+    def notify(self, event, **data):
+        "Tell the listeners about a change"
+        for listener in self.listeners:
+            listener(event, **data)
+
+    def alarms_text(self):
+        "Get the alarms written as HH:MM (followed by their days and the dates they skip, if any)"
+        return [alarm.text(separator = ":") for alarm in self.alarms]
 
     def delete_alarms(self):
         "Delete all alarms from the text file"
-        with open(self.file_to_alarms, "w"):
-            pass # does nothing but erase content of file since in write mode
+        file_id = self.file_id()
+        if self.alarms or file_id is None or file_id[2] > 0:
+            self.alarms = []
+            self.write_alarms()
 
     def speak(self, time_to_read = None, vol_override = 0):
         "Tell either current time or alarm time"
@@ -85,13 +315,21 @@ class Clock:
         hours = time_to_read[0]
         minutes = time_to_read[1]
 
-        print(f"{prefix} ({hours}:{minutes})")
+        log.info("%s (%s:%s)", prefix, hours, minutes)
         
         if vol_override > 0:
             vol = vol_override
         else:
             vol = self.player_system.volume
 
+        if self.speech_cache is not None:
+            file = self.speech_cache.get(hours = hours,
+                                         minutes = minutes,
+                                         gain_hours = (vol + self.extra_volume_hours) / max(vol, 1))
+            if file is not None:
+                self.player_system.play_file(path = file, vol_override = vol)
+                return
+
         self.player_system.play_sound(track_name = hours, vol_override = vol + self.extra_volume_hours)
         if minutes < "10":
             self.player_system.play_sound(track_name = "00", vol_override = vol) # for "o" before min < 10.
@@ -118,37 +356,186 @@ class Clock:
         self.speak(time_to_read = self.alarm)
         return True
 
+    @staticmethod
+    def as_alarm(alarm):
+        "Get an object of class Alarm from an alarm given either as such or as [h, h, m, m] (rings once)"
+        return alarm if isinstance(alarm, Alarm) else Alarm(digits = alarm)
+
     def register_alarm(self):
-        print("saving alarm to file")
-        if self.alarm not in self.alarms: # prevent duplicates
-            self.alarms.append(self.alarm) # add alarm to in-memory list
-        self.write_alarms() # update text file
+        log.info("saving alarm to file")
+        self.add_alarm(alarm = self.alarm)
         self.player_system.play_sound(track_name = "alarm_set")
 
+    def add_alarm(self, alarm):
+        "Add an alarm given as an Alarm or as [h, h, m, m] (the text file is only written if the alarm is new)"
+        alarm = self.as_alarm(alarm)
+        self.read_alarms() # in case the text file was edited by hand
+        if alarm not in self.alarms: # prevent duplicates
+            self.alarms.append(alarm) # add alarm to in-memory list
+            self.write_alarms() # update text file
+
+    def remove_alarm(self, alarm):
+        """Remove an alarm given as an Alarm or as [h, h, m, m] (the text file is only written if the alarm existed)
+
+        The dates an alarm skips do not matter: "0730 weekdays" removes "0730 weekdays skip=2024-12-25".
+        """
+        alarm = self.as_alarm(alarm)
+        self.read_alarms()
+        alarms = [other for other in self.alarms if (other.digits, other.days) != (alarm.digits, alarm.days)]
+        if len(alarms) < len(self.alarms):
+            self.alarms = alarms
+            self.write_alarms()
+
+    def skip_alarm(self, alarm):
+        """Skip the next occurrence of an alarm given as an Alarm or as [h, h, m, m] (of the alarms at that time)
+
+        Return True if an alarm has been found.
+        """
+        alarm = self.as_alarm(alarm)
+        self.read_alarms()
+        now = time.time()
+        found = False
+        for i, other in enumerate(self.alarms):
+            if other.digits == alarm.digits and (other.days == alarm.days or not alarm.days):
+                self.alarms[i] = other.expire(now).skip_next(now)
+                found = True
+        if found:
+            self.write_alarms()
+        return found
+
     def list_alarms(self, update = True):
         if update:
             self.read_alarms()
         if self.alarms:
             self.player_system.play_sound(track_name = "alarms_list")
             for alarm in self.alarms:
-                self.speak(time_to_read = alarm)
+                self.speak(time_to_read = alarm.digits)
         else:
             self.player_system.play_sound(track_name = "alarm_none")
         self.player_system.play_sound(track_name = "alarm_validation",
                                       wait_till_completion = False)
 
     def ring_alarm(self, update = True):
+        """Ring the alarms due (every alarm whose occurrence is past and has not rung yet, so that
+        no alarm is skipped if the check is late)
+
+        Keyword arguments:
+        update -- a boolean indicating whether or not to reload the alarms if the text file has changed
+        """
         if update:
             self.read_alarms()
-        now = self.time()
-        #print(f"checking if an alarm is set for current time ({now[0]}:{now[1]})")
-        new_alarms = []
-        for alarm in self.alarms:
-            target = self.convert_hhmm_to_hm(alarm)
-            if target == now:
-                print("ALARM RINGING!")
-                self.player_system.play_sound(track_name = "alarm_sound", vol_override = self.volume_alarm)
-            else:
-                new_alarms.append(alarm) # only keep alarms that did not trigger (used alarms are discarded)
-        self.alarms = new_alarms # update in memory alarms
-        self.write_alarms() # update text file
+        now = time.time()
+        due = self.due_alarms(now)
+        if not due:
+            return
+        used = set()
+        for occurrence, alarm in due:
+            log.info("ALARM RINGING! (%s)", alarm.text(separator = ":"))
+            judsound_log.metrics.count("alarms_rung")
+            judsound_log.metrics.observe("alarm_fire_skew", now - occurrence)
+            if not alarm.days:
+                used.add(alarm) # alarms which ring once are discarded
+        # recurring alarms are only written if they skipped a date which is now past
+        alarms = [alarm.expire(now) for alarm in self.alarms if alarm not in used]
+        if used or alarms != self.alarms:
+            self.alarms = alarms # update in memory alarms
+            self.write_alarms() # update text file (before ringing)
+        self.ring()
+
+    def ring(self):
+        """Play the alarm sound again and again, fading in, till it is dismissed or alarm_duration has elapsed
+
+        Pressing any button dismisses the alarm, as presses interrupt the system player (see Box.submit).
+        """
+
+        player = self.player_system
+        self.notify("alarm", state = "ringing")
+        if self.alarm_fade_in > 0:
+            player.fade(vol = self.volume_alarm, duration = self.alarm_fade_in, curve = "log", vol_from = 1)
+        time_end = time.monotonic() + self.alarm_duration
+        while time.monotonic() < time_end:
+            if not player.play_sound(track_name = "alarm_sound",
+                                     vol_override = self.volume_alarm,
+                                     timeout = time_end - time.monotonic()):
+                break # dismissed (or no alarm sound)
+        if player.interrupted:
+            log.info("alarm dismissed")
+        player.cancel_fade()
+        player.update_volume(vol = player.volume, verbose = False)
+        self.notify("alarm", state = "stopped")
+
+
+class Scheduler:
+    """Define the class which tells the main loop when to wake up (next alarm or next day/night switch)
+
+    Alarms are not put in the heap one by one: only the next one due (the first of the index of the clock) is.
+    """
+
+    def __init__(self, clock):
+        """Initialize the scheduler
+
+        Keyword arguments:
+        clock -- an object of class Clock
+        """
+
+        self.clock = clock
+        self.last_check = time.time() # timestamp up to which events have been handled
+        self.events = [] # heap of (timestamp, kind, is_retry) for upcoming events
+        self.clock.read_alarms()
+        self.rebuild()
+
+    def rebuild(self):
+        "Recompute the heap of upcoming events from the next alarm and the day/night boundaries"
+        retries = [event for event in self.events if event[2]] # retries are not derived from alarms so they are kept
+        self.events = []
+        next_alarm = self.clock.next_alarm()
+        if next_alarm is not None:
+            self.events.append((next_alarm, "alarm", False))
+        self.events.extend(self.boundaries(after = self.last_check))
+        self.events.extend(retries)
+        heapq.heapify(self.events)
+
+    def boundaries(self, after):
+        "Get the events of the next day/night switches strictly after the timestamp after"
+        events = []
+        for hour in (self.clock.night_day_h, self.clock.day_night_h):
+            boundary = [hour // 10, hour % 10, 0, 0]
+            events.append((self.clock.next_occurrence(boundary, after), "day_night", False))
+        return events
+
+    def retry_in(self, delay, kind = "day_night"):
+        "Schedule an event to be handled again after delay seconds (e.g. when mode cannot change yet)"
+        heapq.heappush(self.events, (time.time() + delay, kind, True))
+
+    def wait(self, max_wait = None):
+        """Sleep until the next event is due or until the alarms change
+
+        Return the (possibly empty) set of the kinds of events due.
+
+        Keyword arguments:
+        max_wait -- the maximum time in sec to sleep (default = None: no limit)
+        """
+        if not self.clock.alarms_changed.is_set():
+            timeout = self.events[0][0] - time.time() if self.events else None
+            if max_wait is not None:
+                timeout = max_wait if timeout is None else min(timeout, max_wait)
+            if timeout is None or timeout > 0:
+                self.clock.alarms_changed.wait(timeout = timeout)
+        self.clock.read_alarms() # only parses the text file if it changed (e.g. edited by hand)
+        if self.clock.alarms_changed.is_set():
+            self.clock.alarms_changed.clear()
+            self.rebuild()
+        now = time.time()
+        due = set()
+        switched = False
+        while self.events and self.events[0][0] <= now:
+            _, kind, is_retry = heapq.heappop(self.events)
+            due.add(kind)
+            switched = switched or (kind == "day_night" and not is_retry)
+        if switched:
+            # the boundaries are only derived again from the clock by rebuild(), so the next ones are put back here
+            self.events = [event for event in self.events if event[1] != "day_night" or event[2]]
+            self.events.extend(self.boundaries(after = now))
+            heapq.heapify(self.events)
+        self.last_check = now
+        return due
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+
+import os
+import json
+import logging
+import threading
+import judsound_playlist
+
+log = logging.getLogger(__name__)
+
+
+## CHECKS (each returns an error message, or None if the value is valid)
+
+def integer(low, high = None):
+    "Check for an integer within [low, high]"
+    def check(value):
+        if not isinstance(value, int) or isinstance(value, bool) or value < low or (high is not None and value > high):
+            return f"must be an integer from {low}" + (f" to {high}" if high is not None else "")
+    return check
+
+
+def number(low, high = None):
+    "Check for a number within [low, high]"
+    def check(value):
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value < low or (high is not None and value > high):
+            return f"must be a number from {low}" + (f" to {high}" if high is not None else "")
+    return check
+
+
+def string(value):
+    "Check for a non-empty string"
+    if not isinstance(value, str) or not value:
+        return "must be a non-empty string"
+
+
+def optional(check):
+    "Check for null or a value passing another check"
+    def check_optional(value):
+        return None if value is None else check(value)
+    return check_optional
+
+
+def listing(check, length = None):
+    "Check for a list of values passing another check (and of a given length)"
+    def check_list(value):
+        if not isinstance(value, list) or (length is not None and len(value) != length):
+            return "must be a list" + (f" of {length} values" if length is not None else "")
+        for item in value:
+            error = check(item)
+            if error is not None:
+                return f"{item!r} {error}"
+    return check_list
+
+
+def sounds(value):
+    "Check for a dictionary from the names of system sounds to file names (or null)"
+    if not isinstance(value, dict):
+        return "must be a dictionary from names of sounds to file names"
+    for name, file in value.items():
+        if file is not None and string(file) is not None:
+            return f"the file of {name} must be a non-empty string or null"
+
+
+pin = integer(0, 27)
+volume = integer(0, 100)
+
+# the settings of the box (the arguments of judsound_box.Box), as name -> (check, required, applied while running)
+# (other settings need a restart, see Config.reload)
+SETTINGS = {
+    "gpio_push_buttons": (listing(pin, length = 4), True, False),
+    "gpio_button_rotary_push": (pin, True, False),
+    "gpio_button_rotary_CLK": (pin, True, False),
+    "gpio_button_rotary_DT": (pin, True, False),
+    "gpio_button_rotary_max_steps": (integer(1), True, False),
+    "path_music_night": (string, True, False),
+    "path_music_day": (string, True, False),
+    "path_system_sound": (string, True, False),
+    "file_to_alarms": (string, True, False),
+    "possible_modes": (listing(string), False, False),
+    "vol_min": (volume, False, True),
+    "vol_max": (volume, False, True),
+    "vol_music_day": (volume, False, True),
+    "vol_music_night": (volume, False, True),
+    "vol_system_day": (volume, False, True),
+    "vol_system_night": (volume, False, True),
+    "vol_startup_msg": (volume, False, True),
+    "vol_alarm": (volume, False, True),
+    "vol_diff_hours": (volume, False, True),
+    "hold_time": (number(0.1, 60), False, True),
+    "night_day_h": (integer(0, 23), False, True),
+    "day_night_h": (integer(0, 23), False, True),
+    "tracks_system": (sounds, False, True),
+    "speech_cache_size": (integer(0), False, False),
+    "path_speech_cache": (optional(string), False, False),
+    "system_sound_sink": (optional(string), False, False),
+    "file_to_positions": (optional(string), False, False),
+    "alarm_fade_in": (number(0), False, True),
+    "alarm_duration": (number(1), False, True),
+    "fade_time": (number(0, 60), False, True),
+    "file_to_loudness": (optional(string), False, False),
+    "path_control_socket": (optional(string), False, False),
+    "idle_time": (optional(number(1)), False, True),
+    "file_to_sound_pack": (optional(string), False, False),
+}
+
+# the settings which are checked together, as (lower setting, higher setting, relation)
+PAIRS = [
+    ("vol_min", "vol_max", "lower than"),
+    ("night_day_h", "day_night_h", "earlier than"),
+]
+
+
+def validate(settings):
+    "Check settings (raise ValueError listing all the errors found)"
+    if not isinstance(settings, dict):
+        raise ValueError("the settings must be a JSON object")
+    errors = [f"unknown setting {name}" for name in settings if name not in SETTINGS]
+    errors += [f"missing setting {name}" for name, (_, required, _) in SETTINGS.items()
+               if required and name not in settings]
+    for name, value in settings.items():
+        if name in SETTINGS:
+            error = SETTINGS[name][0](value)
+            if error is not None:
+                errors.append(f"{name} {error}")
+    # both settings of a pair must be set if either is, as a single one would be compared with a default of the box
+    for low, high, relation in PAIRS:
+        if (low in settings) != (high in settings):
+            errors.append(f"{low} and {high} must be set together")
+        elif low in settings and not errors and settings[low] >= settings[high]:
+            errors.append(f"{low} must be {relation} {high}")
+    if errors:
+        raise ValueError("; ".join(errors))
+
+
+def load(file_config):
+    "Read and check the settings of a JSON file (raise OSError if it cannot be read, ValueError if it is not valid)"
+    with open(file_config, "r") as file:
+        settings = json.load(file) # json.JSONDecodeError is a ValueError
+    validate(settings)
+    return settings
+
+
+class Config:
+    """Define the class which holds the settings of the box, read from a JSON file whose keys are the arguments
+    of judsound_box.Box, and applies the changes of the file while the box runs (see reload)
+    """
+
+    def __init__(self, file_config):
+        """Load the settings (raise OSError or ValueError if the file cannot be used)
+
+        Keyword arguments:
+        file_config -- a string specifying the JSON file (including its path)
+        """
+
+        self.file_config = os.path.abspath(file_config)
+        self.file_id_loaded = self.file_id()
+        self.settings = load(self.file_config)
+        self.box = None
+        self.watcher = None
+        self.lock = threading.Lock() # the file can be reloaded on SIGHUP and by the watcher at the same time
+
+    def file_id(self):
+        "Get what identifies the current version of the file (None if it does not exist)"
+        try:
+            stat = os.stat(self.file_config)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def watch(self, box):
+        """Apply the changes of the file to a box from now on, when reload() is called (e.g. on SIGHUP)
+        and when the file is written (if inotify is available)
+
+        Keyword arguments:
+        box -- an object of class judsound_box.Box, created with self.settings
+        """
+
+        self.box = box
+        try:
+            self.watcher = judsound_playlist.Inotify(callback = self.changed)
+            self.watcher.add(os.path.dirname(self.file_config)) # the directory, as editors often replace the file
+        except (OSError, AttributeError) as error:
+            log.info("inotify not available, the settings are only reloaded on SIGHUP (%s)", error)
+
+    def changed(self, directory):
+        "Reload the file if it changed (called by the watcher for any change in its directory)"
+        if self.file_id() != self.file_id_loaded:
+            self.reload()
+
+    def reload(self):
+        """Read the file again and apply the settings which changed
+
+        Settings applied while running are passed to Box.reconfigure (run by the dispatcher, like the
+        actions of buttons), which only updates the parts of the box they affect. Other settings are
+        applied at the next restart. If the file is not valid, the settings in use are kept.
+        """
+
+        with self.lock:
+            self.file_id_loaded = self.file_id()
+            try:
+                settings = load(self.file_config)
+            except (OSError, ValueError) as error:
+                log.error("settings of %s not applied (%s)", self.file_config, error)
+                return
+            changed = sorted(name for name in SETTINGS if settings.get(name) != self.settings.get(name))
+            self.settings = settings
+        if not changed:
+            return
+        restart = [name for name in changed if not SETTINGS[name][2] or name not in settings]
+        if restart:
+            log.warning("settings %s changed: applied at the next restart", ", ".join(restart))
+        live = {name: settings[name] for name in changed if name not in restart}
+        if live and self.box is not None:
+            log.info("applying settings %s", ", ".join(live))
+            self.box.submit(self.box.reconfigure, from_input = False, **live)
@@ -0,0 +1,326 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+import collections
+import concurrent.futures
+import judsound_log
+import judsound_clock
+
+log = logging.getLogger(__name__)
+
+
+def parse_alarm(time, days = None):
+    """Get an alarm from its time written as HH:MM (or HHMM) and the days on which it rings again
+    (e.g. "weekdays" or "mon,wed"; default = None: rings once). Raise ValueError if it is not valid."""
+    if not isinstance(time, str) or days is not None and not isinstance(days, str):
+        raise ValueError("Time and days must be strings")
+    return judsound_clock.Alarm.parse(time if days is None else time + " " + days)
+
+
+class Server:
+    """Define the class which lets local programs drive the box through a UNIX socket
+
+    Clients send commands as JSON objects, one per line (or a JSON list of commands, run in order
+    and answered by a list), e.g. {"id": 1, "cmd": "press", "button": 0}. Each command is answered
+    with {"id": ..., "ok": true, "result": ...} or {"id": ..., "ok": false, "error": ...}.
+    Commands which act on the box are queued like button actions and answered once queued,
+    or once run if the command has "wait": true. Changes of state (mode, volume, alarms, ringing)
+    are pushed to all clients as {"event": ..., ...}.
+    """
+
+    def __init__(self, box, path_socket, budget = 0.02, timeout = 10):
+        """Initialize the server (start() starts it)
+
+        Keyword arguments:
+        box -- an object of class Box
+        path_socket -- a string specifying the UNIX socket to create
+        budget -- the time in sec within which 99% of commands should be answered (a warning is logged otherwise)
+        timeout -- the maximum time in sec to wait for a command with "wait": true to be run
+        """
+
+        self.box = box
+        self.path_socket = path_socket
+        self.budget = budget
+        self.timeout = timeout
+        self.commands = {"press": self.command_press,
+                         "hold": self.command_hold,
+                         "mode": self.command_mode,
+                         "volume": self.command_volume,
+                         "next": self.command_next,
+                         "previous": self.command_previous,
+                         "speak": self.command_speak,
+                         "alarm_add": self.command_alarm_add,
+                         "alarm_delete": self.command_alarm_delete,
+                         "alarm_skip": self.command_alarm_skip,
+                         "alarms": self.command_alarms,
+                         "state": self.command_state,
+                         "stats": self.command_stats}
+        self.latencies = collections.deque(maxlen = 1000) # most recent command latencies in sec
+        self.count = 0 # number of commands answered
+        self.writers = set() # connected clients
+        self.clients = set() # tasks answering the clients (cancelled when the server stops)
+        self.loop = None
+        self.stopped = None
+        self.ready = threading.Event()
+        self.thread = None
+
+    ## COMMANDS (each returns a result, or a future for the actions queued)
+
+    def command_press(self, button):
+        "Press and release a push button (0-3) or the mode button (mode)"
+        if button == "mode":
+            self.box.submit(self.box.push_mode_button, barge_in = True)
+            return self.box.submit(self.box.release_mode_button)
+        button = self.check_button(button)
+        self.box.submit(self.box.push_top_button, barge_in = True, button_index = button)
+        return self.box.submit(self.box.release_top_button, button_index = button)
+
+    def command_hold(self, button):
+        "Press a push button (0-3) or the mode button (mode) for longer than hold_time"
+        if button == "mode":
+            self.box.submit(self.box.push_mode_button, barge_in = True)
+            self.box.submit(self.box.hold_mode_button)
+            return self.box.submit(self.box.release_mode_button)
+        button = self.check_button(button)
+        self.box.submit(self.box.push_top_button, barge_in = True, button_index = button)
+        self.box.submit(self.box.hold_top_button, button_index = button)
+        return self.box.submit(self.box.release_top_button, button_index = button)
+
+    def command_mode(self, mode):
+        "Go to a mode"
+        self.box.machine.check(mode)
+        return self.box.submit(self.box.change_mode, mode = mode)
+
+    def command_volume(self, volume):
+        "Set the volume (as if the rotary encoder had been turned)"
+        self.box.set_volume(vol = int(volume))
+        return self.box.volume_current()
+
+    def command_next(self):
+        "Skip to the next track of the playlist being played"
+        return self.box.submit(self.box.skip_track, step = 1)
+
+    def command_previous(self):
+        "Go back to the previous track of the playlist being played"
+        return self.box.submit(self.box.skip_track, step = -1)
+
+    def command_speak(self):
+        "Tell the time"
+        return self.box.submit(self.box.clock.speak)
+
+    def command_alarm_add(self, time, days = None):
+        "Add an alarm (time as HH:MM, days on which it rings again if it recurs)"
+        return self.box.submit(self.box.clock.add_alarm, alarm = parse_alarm(time, days))
+
+    def command_alarm_delete(self, time = None, days = None):
+        "Delete an alarm (time as HH:MM, days if it recurs), or all alarms if no time is given"
+        if time is None:
+            return self.box.submit(self.box.clock.delete_alarms)
+        return self.box.submit(self.box.clock.remove_alarm, alarm = parse_alarm(time, days))
+
+    def command_alarm_skip(self, time, days = None):
+        "Skip the next occurrence of the alarms at a time (time as HH:MM, days to only skip the alarm recurring on them)"
+        return self.box.submit(self.box.clock.skip_alarm, alarm = parse_alarm(time, days))
+
+    def command_alarms(self):
+        "List the alarms"
+        return self.box.clock.alarms_text()
+
+    def command_state(self):
+        "Describe the state of the box"
+        return {"mode": self.box.mode_current,
+                "volume": self.box.volume_current(),
+                "playing": any(player.is_playing() for player in (self.box.player_music_day,
+                                                                  self.box.player_music_night,
+                                                                  self.box.player_system)),
+                "busy": self.box.busy,
+                "idle": self.box.idle,
+                "alarms": self.box.clock.alarms_text()}
+
+    def command_stats(self):
+        "Get the latency percentiles (in ms) of the most recent commands, and the time spent idle"
+        return {"count": self.count,
+                "p50": 1000 * self.percentile(0.5),
+                "p99": 1000 * self.percentile(0.99),
+                "budget": 1000 * self.budget,
+                "idle": self.box.idle_stats()}
+
+    @staticmethod
+    def check_button(button):
+        "Check the index of a push button"
+        if button not in (0, 1, 2, 3):
+            raise ValueError(f"Unknown button: {button}")
+        return button
+
+    ## SERVER
+
+    def percentile(self, fraction):
+        "Get a percentile of the most recent command latencies (0 if there is none)"
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return 0
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+    async def execute(self, request):
+        "Run a command and build its answer"
+        answer = {"id": request.get("id")} if isinstance(request, dict) else {"id": None}
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("A command must be a JSON object")
+            arguments = {key: value for key, value in request.items() if key not in ("id", "cmd", "wait")}
+            command = self.commands.get(request.get("cmd"))
+            if command is None:
+                raise ValueError(f"Unknown command: {request.get('cmd')}")
+            result = command(**arguments)
+            if isinstance(result, concurrent.futures.Future):
+                if request.get("wait"):
+                    # shielded: on timeout, the action is still run (e.g. the release queued after a press)
+                    result = await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(result)), timeout = self.timeout)
+                else:
+                    result = "queued"
+            answer.update(ok = True, result = result)
+        except Exception as error: # wrong command, or action which failed or timed out (the server must survive)
+            answer.update(ok = False, error = str(error) or type(error).__name__)
+        return answer
+
+    async def client(self, reader, writer):
+        "Answer the commands of a client till it disconnects (or the server stops)"
+        self.writers.add(writer)
+        self.clients.add(asyncio.current_task())
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                time_received = time.monotonic()
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    answer = {"id": None, "ok": False, "error": "Invalid JSON"}
+                else:
+                    if isinstance(request, list):
+                        # commands run in order (a command with "wait": true is run before the next one starts)
+                        answer = [await self.execute(command) for command in request]
+                    else:
+                        answer = await self.execute(request)
+                writer.write((json.dumps(answer) + "\n").encode())
+                await writer.drain()
+                self.observe(time.monotonic() - time_received, n = len(request) if isinstance(request, list) else 1)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            pass # the server stops (asyncio would log the cancellation of the task as an error)
+        finally:
+            self.clients.discard(asyncio.current_task())
+            self.writers.discard(writer)
+            writer.close()
+
+    def observe(self, latency, n = 1):
+        "Record the latency of answered commands and warn when the budget is exceeded"
+        judsound_log.metrics.observe("control_latency", latency)
+        for _ in range(n):
+            self.latencies.append(latency)
+            self.count += 1
+            if self.count % 100 == 0 and self.percentile(0.99) > self.budget:
+                judsound_log.metrics.count("control_over_budget")
+                log.warning("control p99 latency %.1f ms over budget of %.1f ms",
+                            1000 * self.percentile(0.99), 1000 * self.budget)
+
+    def notify(self, event, **data):
+        "Push an event to all clients (can be called from any thread)"
+        if self.loop is None:
+            return
+        line = (json.dumps(dict(event = event, **data)) + "\n").encode()
+        self.loop.call_soon_threadsafe(self.broadcast, line)
+
+    def broadcast(self, line):
+        "Write a line to all clients (run by the event loop)"
+        for writer in list(self.writers):
+            if writer.is_closing():
+                continue
+            if writer.transport.get_write_buffer_size() > 65536:
+                continue # client not reading: events are dropped rather than piling up
+            writer.write(line)
+
+    async def serve(self):
+        "Accept clients till stop() is called"
+        if os.path.exists(self.path_socket):
+            os.remove(self.path_socket)
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        server = await asyncio.start_unix_server(self.client, path = self.path_socket)
+        self.ready.set()
+        async with server:
+            await self.stopped.wait()
+            # clients are disconnected before the server is closed, which waits for them (Python 3.12)
+            clients = list(self.clients)
+            for task in clients:
+                task.cancel()
+            await asyncio.gather(*clients, return_exceptions = True)
+
+    def start(self):
+        "Start the server in its own thread (returns once it accepts clients)"
+        self.thread = threading.Thread(target = asyncio.run, args = (self.serve(),), daemon = True)
+        self.thread.start()
+        self.ready.wait(timeout = 5)
+
+    def stop(self):
+        "Stop the server"
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            self.thread.join(timeout = 5)
+            self.loop = None
+        if os.path.exists(self.path_socket):
+            os.remove(self.path_socket)
+
+
+async def load_test(path_socket, count = 2000, batch = 5, connections = 4):
+    """Send commands to a box from several clients at once and measure how long answers take
+
+    Return the latencies (in sec) seen by clients for each request, and the statistics of the server.
+
+    Keyword arguments:
+    path_socket -- a string specifying the UNIX socket of the server
+    count -- an integer specifying the number of requests sent by each client
+    batch -- an integer specifying the number of commands in every tenth request (others have one)
+    connections -- an integer specifying the number of clients
+    """
+
+    def request(i):
+        "Mostly queries, with some volume changes and presses of the mode button (which tells the time)"
+        kind = random.random()
+        if kind < 0.8:
+            return {"id": i, "cmd": "state"}
+        if kind < 0.95:
+            return {"id": i, "cmd": "volume", "volume": random.randint(10, 40)}
+        return {"id": i, "cmd": "press", "button": "mode"}
+
+    async def client():
+        reader, writer = await asyncio.open_unix_connection(path_socket)
+        latencies = []
+        for i in range(count):
+            message = [request(i) for _ in range(batch)] if i % 10 == 0 else request(i)
+            time_start = time.monotonic()
+            writer.write((json.dumps(message) + "\n").encode())
+            while True:
+                answer = json.loads(await reader.readline())
+                if isinstance(answer, list) or "event" not in answer: # events are pushed in between
+                    break
+            latencies.append(time.monotonic() - time_start)
+        writer.write((json.dumps({"cmd": "stats"}) + "\n").encode())
+        while True:
+            answer = json.loads(await reader.readline())
+            if "event" not in answer:
+                break
+        writer.close()
+        return latencies, answer["result"]
+
+    results = await asyncio.gather(*(client() for _ in range(connections)))
+    latencies = sorted(latency for latencies, _ in results for latency in latencies)
+    return latencies, results[-1][1]
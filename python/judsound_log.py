@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import time
+import bisect
+import socket
+import signal
+import logging
+import threading
+import collections
+
+class RingHandler(logging.Handler):
+    "Define the class which keeps the most recent log messages in memory (instead of writing them to the SD card)"
+
+    def __init__(self, capacity = 1000):
+        """Initialize the handler
+
+        Keyword arguments:
+        capacity -- an integer specifying how many messages are kept
+        """
+
+        super().__init__()
+        self.records = collections.deque(maxlen = capacity)
+
+    def emit(self, record):
+        self.records.append(self.format(record))
+
+
+class RateLimit(logging.Filter):
+    "Define the class which drops messages repeated too often (messages are compared before formatting)"
+
+    def __init__(self, interval = 10, burst = 20):
+        """Initialize the filter
+
+        Keyword arguments:
+        interval -- the duration in sec of the window over which messages are counted
+        burst -- an integer specifying how many identical messages are let through per window
+        """
+
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {} # (logger, message) -> [start of window, count]
+        self.dropped = 0
+
+    def filter(self, record):
+        if hasattr(record, "rate_limited"): # record already seen by another handler
+            return not record.rate_limited
+        now = time.monotonic()
+        window = self.windows.setdefault((record.name, record.msg), [now, 0])
+        if now - window[0] > self.interval:
+            window[0], window[1] = now, 0
+        window[1] += 1
+        record.rate_limited = window[1] > self.burst
+        if record.rate_limited:
+            self.dropped += 1
+        return not record.rate_limited
+
+
+class Metrics:
+    "Define the class which keeps counters and latency histograms"
+
+    buckets = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5, 10, 60) # upper bounds (in sec) of histogram bins
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histograms = {} # name -> [count per bin (last bin = above all bounds), number of values, sum of values]
+
+    def count(self, name, n = 1):
+        "Increase a counter"
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, name, value):
+        "Add a value (in sec) to a histogram"
+        with self.lock:
+            histogram = self.histograms.setdefault(name, [[0] * (len(self.buckets) + 1), 0, 0])
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def dump(self):
+        "Format all counters and histograms as text"
+        lines = []
+        with self.lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"{name} {value}")
+            for name, (bins, n, total) in sorted(self.histograms.items()):
+                lines.append(f"{name} count={n} mean={1000 * total / max(n, 1):.1f}ms")
+                for bound, count in zip(self.buckets + (float("inf"),), bins):
+                    if count:
+                        lines.append(f"  <= {1000 * bound:.0f}ms: {count}")
+        return "\n".join(lines)
+
+
+metrics = Metrics() # shared by all modules
+ring = RingHandler()
+rate_limit = RateLimit()
+
+
+def dump():
+    "Format metrics and recent log messages as text"
+    return (f"*** metrics ***\n{metrics.dump()}\n"
+            f"log messages dropped by rate limit {rate_limit.dropped}\n"
+            f"*** last {len(ring.records)} log messages ***\n" + "\n".join(ring.records) + "\n")
+
+
+def serve(path_socket):
+    "Write the dump to each client connecting to a UNIX socket (run in its own thread)"
+    if os.path.exists(path_socket):
+        os.remove(path_socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path_socket)
+    server.listen(1)
+    while True:
+        connection, _ = server.accept()
+        with connection:
+            connection.sendall(dump().encode())
+
+
+def write_dumps(requested):
+    """Write the dump to the console each time an event is set (run in its own thread, as writing from the
+    signal handler could interrupt a write to the console of the main thread)"""
+    while True:
+        requested.wait()
+        requested.clear()
+        sys.stderr.write(dump())
+        sys.stderr.flush()
+
+
+def setup(level = logging.INFO, level_console = logging.WARNING, capacity = 1000, path_socket = None):
+    """Configure logging for the whole program
+
+    Messages of at least level are kept in memory, and only messages of at least level_console
+    are also written to the console (which systemd redirects to a file).
+    Metrics and recent messages are written to the console on SIGUSR1, and to any client of the
+    UNIX socket path_socket (e.g. using `socat - UNIX-CONNECT:path_socket`).
+
+    Keyword arguments:
+    level -- the minimum level of messages kept in memory
+    level_console -- the minimum level of messages written to the console
+    capacity -- an integer specifying how many messages are kept in memory
+    path_socket -- a string specifying the UNIX socket to create (default = None: no socket)
+    """
+
+    formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
+    ring.records = collections.deque(ring.records, maxlen = capacity)
+    ring.setFormatter(formatter)
+    ring.addFilter(rate_limit)
+    console = logging.StreamHandler()
+    console.setLevel(level_console)
+    console.setFormatter(formatter)
+    console.addFilter(rate_limit)
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    logger.addHandler(ring)
+    logger.addHandler(console)
+
+    requested = threading.Event() # set on SIGUSR1
+    threading.Thread(target = write_dumps, args = (requested,), daemon = True).start()
+    signal.signal(signal.SIGUSR1, lambda signum, frame: requested.set())
+    if path_socket is not None:
+        threading.Thread(target = serve, args = (path_socket,), daemon = True).start()
@@ -0,0 +1,215 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import re
+import json
+import math
+import wave
+import shutil
+import logging
+import threading
+import subprocess
+import concurrent.futures
+import judsound_sound
+import judsound_playlist
+
+log = logging.getLogger(__name__)
+
+
+def command_low_priority():
+    "Get the command prefix which runs a program at the lowest CPU and disk priority (empty if not available)"
+    prefix = []
+    if shutil.which("nice") is not None:
+        prefix += ["nice", "-n", "19"]
+    if shutil.which("ionice") is not None:
+        prefix += ["ionice", "-c", "3"] # idle class: disk access only when no one else needs it
+    return prefix
+
+
+def measure(file):
+    """Measure the integrated loudness of an audio file in LUFS (None if it cannot be measured)
+
+    The measure is done by ffmpeg (EBU R128) at low priority. Without ffmpeg, wav files in the format
+    of the sound engine are measured in Python (see measure_samples), also in a process at low priority,
+    so that the measure never holds the interpreter lock against playback.
+
+    Keyword arguments:
+    file -- a string specifying the audio file (including its path)
+    """
+
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is not None:
+        for filter_loudness in ("ebur128=framelog=verbose", "ebur128"): # framelog is missing in old versions
+            result = subprocess.run(command_low_priority() + [ffmpeg, "-nostats", "-hide_banner", "-i", file,
+                                                              "-vn", "-af", filter_loudness, "-f", "null", "-"],
+                                    stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, text = True)
+            if result.returncode == 0:
+                found = re.findall(r"I:\s+(-?[\d.]+) LUFS", result.stderr)
+                return float(found[-1]) if found else None
+        return None
+    result = subprocess.run(command_low_priority() + [sys.executable, os.path.abspath(__file__), file],
+                            stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, text = True)
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout)
+
+
+def measure_samples(file):
+    """Measure the loudness of a wav file in the format of the sound engine in LUFS (None if it cannot be measured)
+
+    This is the gated mean power of EBU R128, without the K-weighting filter (run by measure in its own process).
+
+    Keyword arguments:
+    file -- a string specifying the audio file (including its path)
+    """
+
+    try:
+        samples = judsound_sound.decode(file)
+    except (OSError, EOFError, wave.Error, subprocess.CalledProcessError):
+        return None
+    block = judsound_sound.rate * 4 // 10 # 400 ms, as in EBU R128
+    powers = [sum(sample * sample for sample in samples[i:i + block]) / block / 32768 ** 2
+              for i in range(0, len(samples) - block + 1, block)]
+    powers = [power for power in powers if power > 1e-7] # absolute gate (-70 dB)
+    if not powers:
+        return None
+    threshold = sum(powers) / len(powers) / 10 # relative gate (-10 dB)
+    powers = [power for power in powers if power > threshold]
+    return 10 * math.log10(sum(powers) / len(powers))
+
+
+class Loudness:
+    "Define the class which knows the loudness of audio files, measured in the background and kept in an index file"
+
+    def __init__(self, file_index, target = -20, gain_min = -12, gain_max = 6, workers = 1, batch = 20):
+        """Load the index
+
+        Keyword arguments:
+        file_index -- a string specifying the index file (including its path)
+        target -- the loudness in LUFS which all files are brought to
+        gain_min -- the minimum gain in dB applied to a file
+        gain_max -- the maximum gain in dB applied to a file
+        workers -- an integer specifying how many files are measured at the same time
+        batch -- an integer specifying after how many measures the index file is written
+        """
+
+        self.file_index = file_index
+        self.target = target
+        self.gain_min = gain_min
+        self.gain_max = gain_max
+        self.batch = batch
+        self.index = {} # path -> [mtime in ns, size, loudness in LUFS (None if it cannot be measured)]
+        try:
+            with open(file_index, "r") as file:
+                self.index = json.load(file)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            log.warning("loudness index %s is corrupted, files are measured again", file_index)
+        self.lock = threading.Lock()
+        self.lock_write = threading.Lock() # the index can be written by a worker and by close() at the same time
+        self.pending = set() # files being measured
+        self.measured = 0 # number of files measured since the index was last written
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers = workers,
+                                                              thread_name_prefix = "loudness")
+
+    @staticmethod
+    def key(file):
+        "Get what identifies a version of a file: [mtime in ns, size] (None if the file does not exist)"
+        try:
+            stat = os.stat(file)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def gain(self, file):
+        """Get the gain in dB to apply to a file (0 if it has not been measured yet, in which case it is measured)
+
+        Keyword arguments:
+        file -- a string specifying the audio file (including its path)
+        """
+
+        key = self.key(file)
+        entry = self.index.get(file)
+        if entry is None or entry[:2] != key:
+            if key is not None:
+                self.submit(file = file)
+            return 0
+        if entry[2] is None:
+            return 0
+        return max(self.gain_min, min(self.gain_max, self.target - entry[2]))
+
+    @staticmethod
+    def scale(vol, gain):
+        "Apply a gain in dB to a volume (the result stays within the range of the sound card, 0-100)"
+        return max(0, min(100, round(vol * 10 ** (gain / 20))))
+
+    def submit(self, file):
+        "Measure a file in the background (does nothing if it is already being measured)"
+        with self.lock:
+            if file in self.pending:
+                return
+            self.pending.add(file)
+        self.executor.submit(self.analyse, file)
+
+    def analyse(self, file):
+        "Measure a file and record the result (run by the workers)"
+        key = self.key(file)
+        try:
+            loudness = measure(file) if key is not None else None
+        except Exception:
+            log.exception("cannot measure the loudness of %s", file)
+            loudness = None
+        with self.lock:
+            self.pending.discard(file)
+            if key is not None:
+                self.index[file] = key + [loudness]
+            self.measured += 1
+            write = self.measured >= self.batch or not self.pending
+        log.debug("loudness of %s: %s LUFS", file, loudness)
+        if write:
+            self.write_index()
+
+    def analyse_all(self, directories):
+        """Measure, in the background, the files of some directories (and their sub-directories) which are new or changed
+
+        Keyword arguments:
+        directories -- a list of strings specifying the directories
+        """
+
+        def scan():
+            for directory in directories:
+                for path, _, files in os.walk(os.path.normpath(directory)):
+                    for file in sorted(files):
+                        if judsound_playlist.is_audio(file):
+                            self.gain(file = os.path.join(path, file)) # submits the file if needed
+        self.executor.submit(scan)
+
+    def write_index(self):
+        "Write the index file (atomically, so that a power loss cannot truncate it)"
+        with self.lock:
+            index = json.dumps(self.index)
+            self.measured = 0
+        file_tmp = self.file_index + ".tmp"
+        with self.lock_write:
+            with open(file_tmp, "w") as file:
+                file.write(index)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(file_tmp, self.file_index)
+
+    def close(self):
+        "Stop measuring (files not measured yet are measured at the next start) and write the index"
+        self.executor.shutdown(wait = False, cancel_futures = True)
+        if self.measured:
+            self.write_index()
+
+
+def main():
+    "Print the loudness of a wav file measured in Python, as JSON (run by measure without ffmpeg)"
+    print(json.dumps(measure_samples(file = sys.argv[1])))
+
+
+if __name__ == "__main__":
+    main()
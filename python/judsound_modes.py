@@ -0,0 +1,158 @@
+#!/usr/bin/python3
+
+import time
+import logging
+import judsound_log
+
+log = logging.getLogger(__name__)
+
+# The modes of the box, as a table:
+# - "entry" and "exit" list the actions run when the box enters or leaves the mode,
+# - "press", "hold" and "release" map a push button (0-3, or "*" for any) to a rule
+#   (actions, next mode) applied when the button is pressed, held, or released before being held;
+#   next mode None stays in the mode, "fallback" goes to the player mode of the time of the day,
+#   and an action may return the name of the next mode instead,
+# - "parent" is the mode from which holding the mode button goes on (for modes not in the cycle),
+# - other keys are options read by actions (e.g. "music", the music player used).
+# Actions are names of methods of the box: entry and exit actions get no argument,
+# button actions get the index of the button. Each mode is announced by the system sound of its name.
+MODES = {
+    "player_night": {
+        "music": "night",
+        "entry": ("set_music_volume",),
+        "exit": ("fade_out_music",),
+        "release": {"*": (("play_music",), None)},
+        "hold": {"*": (("hold_music",), None)},
+    },
+    "player_day": {
+        "music": "day",
+        "entry": ("set_music_volume",),
+        "exit": ("fade_out_music",),
+        "release": {"*": (("play_music",), None)},
+        "hold": {"*": (("hold_music",), None)},
+    },
+    "alarm": {
+        "entry": ("reset_alarm", "set_music_volume"),
+        "press": {0: (("enter_alarm_setting",), "alarm_setting"),
+                  1: (("list_alarms",), "alarm"),
+                  2: (("delete_alarms",), "alarm"),
+                  3: ((), "fallback")},
+    },
+    "alarm_setting": {
+        "parent": "alarm",
+        "entry": ("set_music_volume",),
+        "release": {"*": (("increment_alarm_digit",), None)},
+        "hold": {"*": (("check_alarm",), None)},
+    },
+    "alarm_validation": {
+        "parent": "alarm",
+        "entry": ("set_music_volume",),
+        "press": {0: (("register_alarm",), "fallback"),
+                  1: (("reset_alarm_setting",), "alarm_setting"),
+                  2: (("speak_alarm",), "alarm_validation"),
+                  3: (("quit_alarm_setting",), "fallback")},
+    },
+}
+
+
+class Machine:
+    "Define the class which runs the modes of the box from a table (see MODES)"
+
+    events = ("press", "hold", "release")
+
+    def __init__(self, handler, modes = MODES, cycle = ("player_night", "alarm", "player_day")):
+        """Compile the table into a dispatch table of bound methods (raise ValueError if the table is wrong)
+
+        Keyword arguments:
+        handler -- the object whose methods are the actions (i.e. the box)
+        modes -- a dictionary describing the modes (see MODES)
+        cycle -- a list of the modes gone through by holding the mode button
+        """
+
+        self.handler = handler
+        self.modes = modes
+        self.cycle_modes = list(cycle)
+        self.mode = None # current mode
+        self.fallback = None # player mode of the time of the day (see Box.switch_day_night)
+        self.listeners = [] # functions called as listener("mode", mode = mode) after each transition
+        self.table = {} # mode -> {"entry"/"exit": [actions], event: {button: ([actions], next mode)}}
+        for mode, description in modes.items():
+            compiled = {"entry": [self.bind(name) for name in description.get("entry", ())],
+                        "exit": [self.bind(name) for name in description.get("exit", ())]}
+            for event in self.events:
+                compiled[event] = {button: ([self.bind(name) for name in actions], self.check(target))
+                                   for button, (actions, target) in description.get(event, {}).items()}
+            compiled["parent"] = self.check(description.get("parent", mode))
+            self.table[mode] = compiled
+        for mode in self.cycle_modes:
+            self.check(mode)
+
+    def bind(self, name):
+        "Get the method of the handler which runs an action"
+        action = getattr(self.handler, name, None)
+        if not callable(action):
+            raise ValueError(f"Unknown action: {name}")
+        return action
+
+    def check(self, mode):
+        "Check that a mode exists (None and fallback are accepted as next modes)"
+        if mode is not None and mode != "fallback" and mode not in self.modes:
+            raise ValueError('Unknown mode: ' + mode)
+        return mode
+
+    def option(self, name, default = None):
+        "Get an option of the current mode"
+        return self.modes[self.mode].get(name, default)
+
+    def goto(self, mode, announce = True):
+        """Leave the current mode (running its exit actions) and enter another one (running its entry actions)
+
+        Going to the current mode leaves it and enters it again.
+
+        Keyword arguments:
+        mode -- the name of the mode, or "fallback"
+        announce -- a boolean indicating whether or not to play the sound of the mode
+        """
+
+        if mode == "fallback":
+            mode = self.fallback
+        self.check(mode)
+        time_start = time.monotonic()
+        if self.mode is not None:
+            for action in self.table[self.mode]["exit"]:
+                action()
+        mode_previous, self.mode = self.mode, mode
+        for action in self.table[mode]["entry"]:
+            action()
+        if announce:
+            self.handler.announce(mode = mode)
+        judsound_log.metrics.observe("mode_transition", time.monotonic() - time_start)
+        log.info("mode %s (from %s)", mode, mode_previous)
+        for listener in self.listeners:
+            listener("mode", mode = mode)
+
+    def handle(self, event, button_index):
+        """Apply the rule of the current mode for an event of a push button (does nothing if there is none)
+
+        Keyword arguments:
+        event -- "press", "hold" or "release"
+        button_index -- an integer specifying the push button
+        """
+
+        rules = self.table[self.mode][event]
+        rule = rules.get(button_index, rules.get("*"))
+        if rule is None:
+            return
+        actions, target = rule
+        for action in actions:
+            result = action(button_index = button_index)
+            if isinstance(result, str):
+                target = result
+        if target is not None:
+            self.goto(mode = target)
+
+    def cycle(self):
+        "Go to the mode after the current one (or after its parent) in the cycle"
+        i = self.cycle_modes.index(self.table[self.mode]["parent"])
+        i = i + 1 if i + 1 < len(self.cycle_modes) else 0
+        self.goto(mode = self.cycle_modes[i])
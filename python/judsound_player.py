@@ -3,83 +3,356 @@
 import os
 import vlc
 import time
+import logging
+import threading
+import judsound_log
+import judsound_playlist
+
+log = logging.getLogger(__name__)
+
+def wait_audio_ready(timeout = 30, path_cards = "/proc/asound/cards"):
+    """Wait till ALSA lists at least one sound card (polling with an increasing delay)
+
+    Return the time in sec spent waiting, or None if no card showed up before the timeout.
+
+    Keyword arguments:
+    timeout -- the maximum time in sec to wait for a sound card
+    path_cards -- a string specifying the file where ALSA lists the sound cards
+    """
+
+    time_start = time.monotonic()
+    delay = 0.05
+    while True:
+        try:
+            with open(path_cards, "r") as file:
+                if "no soundcards" not in file.read():
+                    return time.monotonic() - time_start
+        except FileNotFoundError:
+            pass # ALSA not loaded yet
+        if time.monotonic() - time_start + delay > timeout:
+            return None
+        time.sleep(delay)
+        delay = min(2 * delay, 1)
+
+
+class Fader:
+    "Define the class which changes the volume of players progressively (a single thread drives all fades)"
+
+    def __init__(self, tick = 0.05):
+        """Initialize the fader (its thread starts with the first fade)
+
+        Keyword arguments:
+        tick -- the time in sec between two volume updates during fades
+        """
+
+        self.tick = tick
+        self.fades = {} # player -> [vol_from, vol_to, time_start, duration, curve, done, then]
+        self.lock = threading.Lock()
+        self.wake = threading.Event() # set when a fade is added, so that the thread sleeps while no fade runs
+        self.thread = None
+
+    @staticmethod
+    def level(vol_from, vol_to, progress, curve):
+        """Compute the volume reached at some point of a fade
+
+        Keyword arguments:
+        vol_from -- the volume at the start of the fade
+        vol_to -- the volume at the end of the fade
+        progress -- a number between 0 (start) and 1 (end)
+        curve -- "linear" (same volume change at each tick) or "log" (same change in dB at each tick, which sounds even)
+        """
+
+        if curve == "log":
+            vol_from, vol_to = max(vol_from, 1), max(vol_to, 1)
+            return vol_from * (vol_to / vol_from) ** progress
+        return vol_from + (vol_to - vol_from) * progress
+
+    def start(self, player, vol_from, vol_to, duration, curve = "linear", then = None):
+        """Start a fade on a player (replacing its fade in progress, if any) and return a threading.Event set at its end
+
+        Keyword arguments:
+        player -- an object of class Player
+        vol_from -- the volume at the start of the fade
+        vol_to -- the volume at the end of the fade
+        duration -- the duration of the fade in sec
+        curve -- "linear" or "log" (see level)
+        then -- a function called (by the thread of the fader) when the fade completes (default = None)
+        """
+
+        done = threading.Event()
+        with self.lock:
+            previous = self.fades.pop(player, None)
+            self.fades[player] = [vol_from, vol_to, time.monotonic(), duration, curve, done, then]
+            if self.thread is None:
+                self.thread = threading.Thread(target = self.run, daemon = True)
+                self.thread.start()
+        if previous is not None:
+            previous[5].set()
+        player.set_output_volume(vol = round(vol_from))
+        self.wake.set()
+        return done
+
+    def cancel(self, player):
+        "Stop the fade of a player where it is (its end function is not called)"
+        with self.lock:
+            fade = self.fades.pop(player, None)
+        if fade is not None:
+            fade[5].set()
+
+    def active(self, player):
+        "Check whether a player is fading"
+        return player in self.fades
+
+    def run(self):
+        "Update the volume of all fading players at each tick, and sleep while there is no fade (run in its own thread)"
+        while True:
+            with self.lock:
+                fades = list(self.fades.items())
+            if not fades:
+                self.wake.wait()
+                self.wake.clear()
+                continue
+            now = time.monotonic()
+            for player, fade in fades:
+                vol_from, vol_to, time_start, duration, curve, done, then = fade
+                progress = min((now - time_start) / duration, 1) if duration > 0 else 1
+                player.set_output_volume(vol = round(self.level(vol_from, vol_to, progress, curve)))
+                if progress < 1:
+                    continue
+                with self.lock:
+                    if self.fades.get(player) is not fade:
+                        continue # replaced or cancelled meanwhile
+                    del self.fades[player]
+                done.set()
+                if then is not None:
+                    try:
+                        then()
+                    except Exception:
+                        log.exception("error at the end of a fade")
+            time.sleep(self.tick)
+
+
+fader = Fader() # shared by all players
+
 
 class Player:
     "Define class which handles the music (VLC) player"
 
-    def __init__(self, path_music, tracks_dictionary = None, vol = 0):
+    def __init__(self, path_music, tracks_dictionary = None, vol = 0, instance_vlc = None, prewarm = None, engine = None, positions = None, loudness = None):
         """Initialize a VLC player
 
         Keyword arguments:
         path_music -- a string specifying the path to the directory where the audio files are stored 
         tracks_dictionary -- a dictionary for the system sounds
         vol -- an integer specifying the baseline volume for the player
+        instance_vlc -- a VLC instance to share between players (default = None: a new instance is created)
+        prewarm -- a list of file names for which VLC media are created at startup (others are created on first use)
+        engine -- an object of class judsound_sound.Engine used to play sounds without VLC (default = None: only VLC is used)
+        positions -- an object of class judsound_playlist.Positions used to resume playlists where they were left (default = None)
+        loudness -- an object of class judsound_loudness.Loudness used to play all files equally loud (default = None: no gain)
         """
 
-        print("Creation of VLC instance")
-        instance_vlc = vlc.Instance()
+        self.owns_instance = instance_vlc is None # only the player which created the instance releases it
+        if instance_vlc is None:
+            log.debug("Creation of VLC instance")
+            instance_vlc = vlc.Instance()
+        self.instance_vlc = instance_vlc
 
-        print("Creation of VLC Player")
+        log.debug("Creation of VLC Player")
         self.player = instance_vlc.media_player_new()
 
+        # completion of sounds is signalled by VLC events (instead of polling the player)
+        self.done = threading.Event()
+        self.done.set() # nothing is playing yet
+        self.playing = threading.Event() # set when VLC starts playing a media (its audio output is then open)
+        events = self.player.event_manager()
+        events.event_attach(vlc.EventType.MediaPlayerEndReached, self.on_end)
+        events.event_attach(vlc.EventType.MediaPlayerEncounteredError, self.on_done)
+        events.event_attach(vlc.EventType.MediaPlayerPlaying, self.on_playing)
+        self.time_requested = None # time (monotonic) at which a sound was requested, till it actually plays
+
+        self.volume_output = vol # volume currently set on the output (differs from self.volume during fades)
+        self.loudness = loudness
+        self.gain_current = 0 # loudness gain in dB of the file being played (applied to all volumes set)
         self.volume = self.change_volume(vol = vol)
 
-        # fetching music tracks and adding them to the player
+        # fetching tracks
         path_music = os.path.normpath(path_music)
-        files_in_path_music = sorted(os.listdir(path_music)) # extract and sort files 
-                                                             # (since max # should be < 10,
-                                                             # simple sorting should work)
-        self.tracks_files = [file for file in files_in_path_music if file.endswith('mp3') or file.endswith('wav')]
-
-        tracks_paths = [path_music + '/' + s 
-                          for s in self.tracks_files] # add path to file names
-
-        print("Adding tracks to VLC instance")     
-        self.tracks = [instance_vlc.media_new(tracks_paths[i]) 
-                          for i in range(len(tracks_paths))] # register all tracks to VLC 
-                                                             # (although only 4 are accessible 
-                                                             # via the top push buttons)
+        if tracks_dictionary is None:
+            # music: each file or folder of the directory is a playlist, only scanned when played
+            self.library = judsound_playlist.Library(path_music = path_music)
+            self.tracks_files = []
+        else:
+            # system sounds: a flat directory listed once
+            self.library = None
+            self.tracks_files = sorted(file for file in os.listdir(path_music) if judsound_playlist.is_audio(file))
+
+        self.tracks_index = {file: path_music + '/' + file
+                             for file in self.tracks_files} # to find tracks from their file name
+        self.tracks = {} # VLC media registered so far (created on first use, see get_media)
+        self.track_current = None # index of the playlist loaded in the player (None if not a music track)
+        self.playlist = None # object of class judsound_playlist.Playlist loaded in the player
+        self.media_current = None # VLC media of the music track loaded in the player
+        self.media_transient = None # VLC media of the file loaded by play_file (released when another media is loaded)
+        self.media_next = None # (file, VLC media) of the track following the current one, prepared in advance
+        self.track_serial = 0 # increased each time a music track is (re)started, to drop outdated track ends
+        self.lock = threading.Lock() # music tracks are changed both by button actions and at the end of tracks
+        self.positions = positions
+        if positions is not None:
+            positions.sources.append(self.remember)
+        self.engine = engine
+        self.time_started = None # time (monotonic) at which the player last started playing something
+        self.time_first_started = None # time (monotonic) at which it first started playing since mark()
+        self.interrupted = False # when True, sounds are skipped (see interrupt)
+
+        if prewarm:
+            log.debug("Adding tracks to VLC instance")
+            for file in prewarm:
+                if file in self.tracks_index:
+                    self.get_media(file = file)
+
+        self.tracks_dictionary = None
+        if tracks_dictionary is not None:
+            self.set_tracks_dictionary(tracks_dictionary = tracks_dictionary)
+
+    def set_tracks_dictionary(self, tracks_dictionary):
+        "Set the dictionary for the system sounds (missing sounds are reported once, they are then skipped when played)"
+        missing = sorted({file for file in tracks_dictionary.values() if file not in self.tracks_index})
+        if missing:
+            log.warning("missing system sounds: %s", missing)
         self.tracks_dictionary = tracks_dictionary
 
     def play_music(self, track_index):
-        """Play an audio file based on its number and handle pause/resume/stop
-        
+        """Play the playlist of a push button and handle pause/resume/stop
+
         This is the function called when a push button has been pressed (in playlist mode).
 
         Keyword arguments:
-        track_index -- an integer specifying the number of the track to play
+        track_index -- an integer specifying the number of the playlist to play
         """
 
-        print("Play music")
-        if self.player.get_media() is None or os.path.basename(
-                self.player.get_media().get_mrl()) != self.tracks_files[track_index]:
-            # case no track playing or other track playing 
-            # -> we start playing the good track
-            self.player.stop()
-            self.player.set_media(self.tracks[track_index])
-            print("start playing new track")
-            self.player.play()
+        log.debug("Play music")
+        playlist = self.library.playlist(index = track_index)
+        if playlist is None or playlist.current() is None:
+            log.info("no track number %s", track_index)
+            return
+        fader.cancel(self) # e.g. music fading out after a change of mode
+        with self.lock:
+            if self.track_current != track_index:
+                # case no track playing or other playlist playing
+                # -> we start playing the good playlist from where it was left
+                self.save_position()
+                self.track_current = track_index
+                self.playlist = playlist
+                if self.positions is not None:
+                    playlist.select(file = self.positions.file(playlist = playlist.path))
+                self.play_track()
+            else:
+                # case correct playlist already loaded -> we pause or resume
+                # (the state of the player is updated by VLC events, so no need to wait for a change)
+                state = self.player.get_state()
+                if state == vlc.State.Ended and playlist.following() is None:
+                    log.info("start replaying playlist from first track")
+                    playlist.position = 0
+                    self.play_track()
+                elif state in (vlc.State.Ended, vlc.State.Error):
+                    log.info("start replaying track from beginning")
+                    # case track played till end -> play (with a new media, as the
+                    # previous one may have been set to start from a saved position)
+                    if self.positions is not None:
+                        self.positions.set(playlist = playlist.path, file = playlist.current(), seconds = 0)
+                    self.play_track()
+                elif state in (vlc.State.Stopped, vlc.State.NothingSpecial):
+                    log.info("start playing track from where it was stopped")
+                    # case track stopped (e.g. by a change of mode) or never started -> play
+                    # from the saved position (from the beginning without saved positions)
+                    self.play_track()
+                else:
+                    log.info("pause or resume playing track from where it was")
+                    self.player.pause()
+            self.update_volume(vol = self.volume)
+
+    def play_track(self):
+        "Play the current track of the loaded playlist and prepare the following one (call with self.lock held)"
+        file = self.playlist.current()
+        start = 0 if self.positions is None else self.positions.start(playlist = self.playlist.path, file = file)
+        media_next, self.media_next = self.media_next, None
+        if media_next is not None and media_next[0] == file:
+            media = media_next[1]
         else:
-            # case correct track already playing -> we pause or resume
-            print("pause or resume playing track from where it was")
-            was_playing = self.player.is_playing()
-            self.player.pause()
-            time.sleep(0.2) # pause otherwise next step does not detect change
-            if not was_playing and not self.player.is_playing():
-                print("start replaying track from beginning")
-                # case no resume possible since track had never started 
-                # -> play
-                self.player.stop() # in case the same track had previously 
-                                   # played till end, it needs to be stopped 
-                                   # before playing
-                self.player.play()
-        self.update_volume(vol = self.volume)
+            if media_next is not None:
+                media_next[1].release()
+            media = self.instance_vlc.media_new(file)
+        if start > 0:
+            media.add_option(f"start-time={start:.1f}") # seeking before playing, so no sound is heard from the beginning
+        self.set_file(file = file)
+        self.update_volume(vol = self.volume, verbose = False)
+        self.player.stop()
+        self.set_media(media = media)
+        if self.media_current is not None:
+            self.media_current.release()
+        self.media_current = media
+        self.track_serial += 1
+        log.info("start playing new track %s (from %.0fs)", file, start)
+        if self.positions is not None:
+            self.positions.set(playlist = self.playlist.path, file = file, seconds = start)
+        self.player.play()
+        self.started()
+
+        # pre-buffering the following track, so that it starts without delay when this one ends
+        following = self.playlist.following()
+        if following is not None:
+            judsound_playlist.prefetch(following)
+            media = self.instance_vlc.media_new(following)
+            media.parse_with_options(vlc.MediaParseFlag.local, 0) # asynchronous
+            self.media_next = (following, media)
+
+    def save_position(self):
+        "Record the time reached in the music track loaded (call with self.lock held)"
+        if self.positions is None or self.playlist is None:
+            return
+        if self.player.get_state() in (vlc.State.Playing, vlc.State.Paused):
+            ms = self.player.get_time()
+            if ms is not None and ms >= 0:
+                self.positions.set(playlist = self.playlist.path, file = self.playlist.current(), seconds = ms / 1000)
+
+    def remember(self):
+        "Record the time reached in the music track loaded (called before each checkpoint of positions)"
+        with self.lock:
+            self.save_position()
+
+    def next_track(self, serial = None):
+        """Skip to the next track of the loaded playlist (nothing happens after the last track)
+
+        Keyword arguments:
+        serial -- the value of self.track_serial when the track to skip started (default = None: skip the current track)
+        """
+
+        with self.lock:
+            if self.playlist is None or (serial is not None and serial != self.track_serial):
+                return
+            if self.playlist.next() is None:
+                log.info("end of playlist")
+                if serial is not None and self.positions is not None:
+                    # the last track played till its end, so it is not resumed from its last checkpoint
+                    self.positions.set(playlist = self.playlist.path, file = self.playlist.current(), seconds = 0)
+                return
+            self.play_track()
+
+    def previous_track(self):
+        "Go back to the previous track of the loaded playlist (the first track is replayed)"
+        with self.lock:
+            if self.playlist is None:
+                return
+            self.playlist.previous()
+            self.play_track()
 
     def play_sound(self,
                    track_name,
                    vol_override = 0,
                    wait_till_completion = True,
-                   sleep = 0.5):
+                   sleep = 0.5,
+                   timeout = None):
         """Play an audio file fully with no pause/resume/stop possible
 
         This is the function called to speak the time and produce other system sound
@@ -89,42 +362,302 @@ class Player:
         vol_override -- an integer specifying the volume if the volume of the player should not be used (0 = no override)
         wait_till_completion -- a boolean indicating whether or not to wait till the sound has fully played
         sleep -- the time in sec before another sound can be played
+        timeout -- the maximum time in sec to wait for the sound to be fully played (default = None: no limit)
+
+        Return False if the sound was skipped (missing file or player interrupted).
         """
 
-        print("Play sound")
         file = self.tracks_dictionary[track_name]
-        print(f"play sound {file}")
+        log.debug("play sound %s", file)
+        judsound_log.metrics.count("sounds_played")
+        if file not in self.tracks_index or self.interrupted:
+            return False # missing files are already reported at startup
+        if self.engine is not None and self.engine.can_play(file = file):
+            # low latency path: the sound is mixed from memory into the output stream of the engine
+            if fader.active(self):
+                vol = self.volume_output # the fade sets the volume
+            else:
+                vol = vol_override if vol_override > 0 else self.volume
+            self.set_file(file = self.tracks_index[file])
+            done = self.engine.play(file = file, vol = self.scaled(vol = vol))
+            self.started()
+            if wait_till_completion:
+                done.wait(timeout = timeout)
+            return True
+        self.play_media(media = self.get_media(file = file),
+                        file = self.tracks_index[file],
+                        vol_override = vol_override,
+                        wait_till_completion = wait_till_completion,
+                        sleep = sleep,
+                        timeout = timeout)
+        return True
+
+    def play_file(self,
+                  path,
+                  vol_override = 0,
+                  wait_till_completion = True,
+                  sleep = 0.5,
+                  timeout = None):
+        """Play an audio file which is not one of the tracks of the player (e.g. a pre-rendered time announcement)
+
+        Keyword arguments:
+        path -- a string specifying the audio file to play (including its path)
+        (other arguments as for play_sound)
+        """
+
+        log.debug("play file %s", path)
+        judsound_log.metrics.count("sounds_played")
+        self.play_media(media = self.instance_vlc.media_new(path),
+                        file = path,
+                        vol_override = vol_override,
+                        wait_till_completion = wait_till_completion,
+                        sleep = sleep,
+                        timeout = timeout,
+                        transient = True)
+
+    def preroll(self, file, timeout = 1):
+        """Start an audio file silently to open the audio output before the first audible sound
+
+        The file is stopped as soon as it plays (the output is then open), not played till its end.
+
+        Keyword arguments:
+        file -- a string specifying the name of the file to play (as listed in self.tracks_files)
+        timeout -- the time in sec after which the file is stopped if it does not play
+        """
+
+        log.debug("silent pre-roll with %s", file)
+        self.player.stop()
+        self.done.clear()
+        self.playing.clear()
+        self.player.audio_set_volume(0)
+        self.set_media(media = self.get_media(file = file))
+        self.track_current = None
+        self.playlist = None
+        self.player.play()
+        if not self.playing.wait(timeout = timeout):
+            log.warning("silent pre-roll with %s did not play within %s s", file, timeout)
+        self.player.stop()
+        self.update_volume(vol = self.volume, verbose = False)
+
+    def get_media(self, file):
+        "Get the VLC media for a track from its file name (registering it to VLC on first use)"
+        if file not in self.tracks:
+            self.tracks[file] = self.instance_vlc.media_new(self.tracks_index[file])
+        return self.tracks[file]
+
+    def set_media(self, media, transient = False):
+        """Load a VLC media in the player
+
+        Keyword arguments:
+        media -- the VLC media to load
+        transient -- a boolean indicating whether the media is only played once (it is then released
+                     when the next media is loaded, see play_file)
+        """
+
+        self.player.set_media(media)
+        if self.media_transient is not None and self.media_transient is not media:
+            self.media_transient.release()
+        self.media_transient = media if transient else None
+
+    def play_media(self, media, file, vol_override, wait_till_completion, sleep, timeout, transient = False):
+        "Play a VLC media, created from a file (shared by play_sound and play_file)"
+        if self.interrupted:
+            if transient:
+                media.release()
+            return
+        self.set_file(file = file)
         if vol_override > 0:
             vol = vol_override
         else: 
             vol = self.volume
-        self.update_volume(vol = vol) # note that volume is not reset after but it should not be a problem
-        self.player.set_media(self.tracks[self.tracks_files.index(file)])
+        if not fader.active(self): # otherwise the fade sets the volume
+            self.update_volume(vol = vol) # note that volume is not reset after but it should not be a problem
+        self.player.stop() # so that events from a previous media cannot mark this one as done
+        self.done.clear()
+        self.set_media(media = media, transient = transient)
+        self.track_current = None
+        self.playlist = None
+        self.time_requested = time.monotonic()
         self.player.play()
+        self.started()
         if wait_till_completion:
-            self.wait_done()
+            self.wait_done(timeout = timeout)
         else:
             time.sleep(sleep)
 
-    def wait_done(self):
-        time.sleep(0.2)
-        while self.player.is_playing():
-            time.sleep(0.2)
+    def on_done(self, event):
+        "Signal that the current media has finished playing (called by VLC, so it must not call VLC itself)"
+        self.done.set()
+
+    def on_end(self, event):
+        "Signal that the current media has played till its end and go on with the playlist (called by VLC)"
+        self.on_done(event)
+        if self.playlist is not None:
+            # VLC must not be called from its own callbacks, so the next track is started from another thread
+            threading.Thread(target = self.next_track, kwargs = {"serial": self.track_serial}, daemon = True).start()
+
+    def on_playing(self, event):
+        "Signal that a media plays and measure the delay between the request of a sound and its playing (called by VLC)"
+        self.playing.set()
+        time_requested = self.time_requested
+        if time_requested is not None:
+            self.time_requested = None
+            judsound_log.metrics.observe("sound_trigger_latency", time.monotonic() - time_requested)
+
+    def wait_done(self, timeout = None):
+        """Wait till the current media has finished playing
+
+        Return False if the timeout (in sec) expired before the end of the media.
+        """
+        return self.done.wait(timeout = timeout)
 
     def update_volume(self, vol, verbose = True):
         "Update the volume of the player on the fly (does not change self.volume)"
         if verbose:
-            print(f"update volume (on the fly) to {vol}")
-        self.player.audio_set_volume(vol)
+            log.debug("update volume (on the fly) to %s", vol)
+        self.volume_output = vol
+        self.player.audio_set_volume(self.scaled(vol = vol))
+
+    def change_volume(self, vol, verbose = True, duration = 0):
+        """Change the baseline volume of the player (does change self.volume)
+
+        Keyword arguments:
+        vol -- an integer specifying the new volume
+        verbose -- a boolean indicating whether or not to log the change
+        duration -- the time in sec over which the volume changes progressively (0 = at once;
+                    while the player is fading, only the baseline changes and the fade goes on)
+        """
 
-    def change_volume(self, vol, verbose = True):
-        "Change the baseline volume of the player (does change self.volume)"
         if verbose:
-            print(f"change volume to {vol}")
+            log.debug("change volume to %s", vol)
         self.volume = vol
-        self.player.audio_set_volume(vol)
+        if duration > 0:
+            self.fade(vol = vol, duration = duration)
+        elif not fader.active(self):
+            self.update_volume(vol = vol, verbose = False)
+
+    def set_output_volume(self, vol):
+        "Set the volume of the output, including sounds played by the engine (called by the fader)"
+        self.volume_output = vol
+        self.player.audio_set_volume(self.scaled(vol = vol))
+        if self.engine is not None:
+            self.engine.set_gain(gain = self.scaled(vol = vol) / 100)
+
+    def set_file(self, file):
+        "Record the file being played, so that its loudness gain applies to the volumes set from now on"
+        self.gain_current = 0 if self.loudness is None else self.loudness.gain(file = file)
+
+    def scaled(self, vol):
+        "Apply the loudness gain of the file being played to a volume"
+        if self.loudness is None:
+            return vol
+        return self.loudness.scale(vol = vol, gain = self.gain_current)
+
+    def fade(self, vol, duration, curve = "linear", vol_from = None, then = None):
+        """Change the volume of the output progressively (see Fader.start) and return a threading.Event set at the end
+
+        Keyword arguments:
+        vol -- the volume at the end of the fade
+        duration -- the duration of the fade in sec
+        curve -- "linear" or "log"
+        vol_from -- the volume at the start of the fade (default = None: the current volume)
+        then -- a function called when the fade completes (default = None)
+        """
+
+        if vol_from is None:
+            vol_from = self.volume_output
+        return fader.start(player = self, vol_from = vol_from, vol_to = vol, duration = duration, curve = curve, then = then)
+
+    def cancel_fade(self):
+        "Stop fading the player, leaving the volume where it is"
+        fader.cancel(self)
+
+    def fade_out(self, duration):
+        "Fade the player out, then stop it and restore its baseline volume (at once if nothing plays)"
+        if duration <= 0 or not self.is_playing():
+            self.cancel_fade()
+            self.stop()
+            self.update_volume(vol = self.volume, verbose = False)
+            return
+        def stop():
+            self.stop()
+            self.update_volume(vol = self.volume, verbose = False)
+        self.fade(vol = 0, duration = duration, then = stop)
+
+    def is_playing(self):
+        "Check whether the player (or its sound engine) is playing"
+        return self.player.is_playing() or (self.engine is not None and self.engine.is_playing())
+
+    def is_active(self):
+        """Check whether the player is playing, or is about to start the next track of its playlist
+
+        At the end of a music track, the next one is started from another thread (see on_end), so
+        for a moment the player does not play although its playlist goes on.
+        """
+        with self.lock: # held by next_track while it starts the next track
+            if self.is_playing():
+                return True
+            return (self.playlist is not None and self.player.get_state() == vlc.State.Ended
+                    and self.playlist.following() is not None)
+
+    def release_output(self):
+        """Release the audio output while nothing plays (the box is idle)
+
+        A paused music track keeps the output of VLC open, so it is stopped (its position is
+        recorded, and the next play resumes from it). The output of the sound engine is closed
+        till the next sound. Return False if the player is playing (see is_active).
+        """
+        if self.is_active():
+            return False
+        if self.player.get_state() == vlc.State.Paused:
+            log.info("stop paused track to release the audio output")
+            self.stop()
+        if self.engine is not None:
+            return self.engine.suspend()
+        return True
+
+    def release(self):
+        "Stop the player and free its VLC resources (the player cannot be used afterwards)"
+        fader.cancel(self)
+        self.stop()
+        if self.engine is not None:
+            self.engine.close()
+        for media in self.tracks.values():
+            media.release()
+        if self.media_current is not None:
+            self.media_current.release()
+        if self.media_next is not None:
+            self.media_next[1].release()
+        if self.media_transient is not None:
+            self.media_transient.release()
+        self.player.release()
+        if self.owns_instance:
+            self.instance_vlc.release()
+
+    def mark(self):
+        "Start recording when the player first plays something (see time_first_started, used to measure latencies)"
+        self.time_first_started = None
+
+    def started(self):
+        "Record that the player started playing something"
+        self.time_started = time.monotonic()
+        if self.time_first_started is None:
+            self.time_first_started = self.time_started
+
+    def interrupt(self):
+        "Stop the sound being played and skip all following sounds till resume() is called (barge-in)"
+        self.interrupted = True
+        self.stop()
+
+    def resume(self):
+        "Allow sounds to be played again after interrupt()"
+        self.interrupted = False
 
     def stop(self):
-        "Stop the player"
-        print("stop playing track")
+        "Stop the player (the position reached in a music track is recorded first)"
+        log.debug("stop playing track")
+        self.remember()
         self.player.stop()
+        if self.engine is not None:
+            self.engine.stop()
+        self.done.set()
@@ -0,0 +1,342 @@
+#!/usr/bin/python3
+
+import os
+import struct
+import ctypes
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+
+def is_audio(file):
+    "Check whether a file name is one of an audio file that can be played"
+    return file.endswith('mp3') or file.endswith('wav')
+
+
+def prefetch(file):
+    "Ask the kernel to read an audio file into the page cache in the background (so it plays without waiting for the SD card)"
+    try:
+        fd = os.open(file, os.O_RDONLY)
+    except OSError as error:
+        log.info("cannot prefetch %s (%s)", file, error)
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    except (OSError, AttributeError):
+        pass # not supported: the track is read when played
+    finally:
+        os.close(fd)
+
+
+class Inotify:
+    "Define the class which watches directories for changes (using the inotify API of Linux through ctypes)"
+
+    mask = 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 # IN_CLOSE_WRITE, IN_MOVED_FROM/TO, IN_CREATE, IN_DELETE, IN_DELETE_SELF
+
+    def __init__(self, callback):
+        """Start watching (raise OSError if inotify is not available)
+
+        Keyword arguments:
+        callback -- a function called with the path of a directory whenever its content changes
+        """
+
+        self.libc = ctypes.CDLL(None, use_errno = True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.callback = callback
+        self.watches = {} # watch descriptor -> path
+        self.paths = set()
+        threading.Thread(target = self.run, daemon = True).start()
+
+    def add(self, path):
+        "Watch a directory (does nothing if already watched)"
+        if path in self.paths:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            log.warning("cannot watch %s (errno %s)", path, ctypes.get_errno())
+            return
+        self.watches[wd] = path
+        self.paths.add(path)
+
+    def run(self):
+        "Read events and report the directories that changed (run in its own thread)"
+        while True:
+            data = os.read(self.fd, 4096)
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                offset += struct.calcsize("iIII") + length
+                path = self.watches.get(wd)
+                if path is None:
+                    continue
+                if mask & 0x400: # IN_DELETE_SELF
+                    del self.watches[wd]
+                    self.paths.discard(path)
+                self.callback(path)
+
+
+class Playlist:
+    "Define the class which holds the audio files found in a folder (and its sub-folders), in sorted order"
+
+    def __init__(self, path, watcher = None):
+        """Initialize the playlist (the folder is only scanned on first use)
+
+        Keyword arguments:
+        path -- a string specifying the folder (or a single audio file)
+        watcher -- an object of class Inotify (default = None: directories are checked with stat on each use)
+        """
+
+        self.path = path
+        self.watcher = watcher
+        self.dirs = {} # directory -> (mtime, sorted audio files, sorted sub-directories)
+        self.files = []
+        self.position = 0 # index of the current file in self.files
+        self.stale = True # True if the folder must be checked for changes
+
+    def scan(self):
+        "Scan the directories which changed since the last scan (only parse those, not the whole tree)"
+        if os.path.isfile(self.path):
+            self.files = [self.path]
+            self.stale = False
+            return
+        current = self.files[self.position] if self.files else None
+        dirs = {}
+        stack = [self.path]
+        while stack:
+            directory = stack.pop()
+            try:
+                mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            scanned = self.dirs.get(directory)
+            if scanned is None or scanned[0] != mtime:
+                files, subdirs = [], []
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir():
+                            subdirs.append(entry.path)
+                        elif is_audio(entry.name):
+                            files.append(entry.path)
+                scanned = (mtime, sorted(files), sorted(subdirs))
+                if self.watcher is not None:
+                    self.watcher.add(directory)
+            dirs[directory] = scanned
+            stack.extend(scanned[2])
+        self.dirs = dirs
+        self.files = sorted(file for scanned in dirs.values() for file in scanned[1])
+        # keeping the current file if it still exists
+        self.position = self.files.index(current) if current in self.files else 0
+        self.stale = self.watcher is None # without watcher, changes can only be found by checking again
+
+    def refresh(self):
+        "Rescan if something may have changed"
+        if self.stale:
+            self.scan()
+
+    def current(self):
+        "Get the current file (None if the playlist is empty)"
+        self.refresh()
+        return self.files[self.position] if self.files else None
+
+    def following(self):
+        "Get the file after the current one (None if the current one is the last)"
+        self.refresh()
+        return self.files[self.position + 1] if self.position + 1 < len(self.files) else None
+
+    def next(self):
+        "Move to the next file and return it (None if the current one was the last)"
+        self.refresh()
+        if self.position + 1 >= len(self.files):
+            return None
+        self.position += 1
+        return self.files[self.position]
+
+    def previous(self):
+        "Move to the previous file and return it (the first file stays the first)"
+        self.refresh()
+        self.position = max(self.position - 1, 0)
+        return self.files[self.position] if self.files else None
+
+    def select(self, file):
+        "Make a file the current one (does nothing if the file is not in the playlist)"
+        self.refresh()
+        if file in self.files:
+            self.position = self.files.index(file)
+
+
+class Library:
+    "Define the class which maps each entry of a music directory (an audio file or a folder) to a playlist"
+
+    def __init__(self, path_music, watch = True):
+        """Initialize the library (folders are only scanned when first played)
+
+        Keyword arguments:
+        path_music -- a string specifying the path to the music directory
+        watch -- a boolean indicating whether or not to watch directories with inotify (if available)
+        """
+
+        self.path = os.path.normpath(path_music)
+        self.watcher = None
+        if watch:
+            try:
+                self.watcher = Inotify(callback = self.changed)
+                self.watcher.add(self.path)
+            except (OSError, AttributeError) as error:
+                log.info("inotify not available, directories are checked on use (%s)", error)
+        self.playlists = {} # entry path -> Playlist
+        self.entries = [] # sorted paths of the audio files and folders in the music directory
+        self.entries_mtime = None
+
+    def changed(self, directory):
+        "Mark the playlists containing a directory as stale (called by the watcher)"
+        if directory == self.path:
+            self.entries_mtime = None
+        for path, playlist in list(self.playlists.items()):
+            if directory == path or directory.startswith(path + os.sep):
+                playlist.stale = True
+
+    def playlist(self, index):
+        "Get the playlist of an entry from its index (None if there is no such entry)"
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.entries_mtime:
+            with os.scandir(self.path) as entries:
+                self.entries = sorted(entry.path for entry in entries
+                                      if entry.is_dir() or is_audio(entry.name))
+            self.entries_mtime = mtime
+        if index >= len(self.entries):
+            return None
+        path = self.entries[index]
+        if path not in self.playlists:
+            self.playlists[path] = Playlist(path = path, watcher = self.watcher)
+        return self.playlists[path]
+
+
+class Positions:
+    "Define the class which remembers the track and time reached in each playlist, across restarts"
+
+    def __init__(self, file_to_positions, interval = 30, compact_factor = 4):
+        """Load the saved positions
+
+        Positions are appended to a small log file in batches (at most once per interval),
+        and the log is rewritten with only the last position of each playlist when it grows too long.
+
+        Keyword arguments:
+        file_to_positions -- a string specifying the log file (including its path)
+        interval -- the time in sec between two checkpoints
+        compact_factor -- the log is compacted when it has more lines than compact_factor times the number of playlists
+        """
+
+        self.file_to_positions = file_to_positions
+        self.interval = interval
+        self.compact_factor = compact_factor
+        self.positions = {} # playlist path -> (file, time in sec)
+        self.pending = {} # positions changed since the last checkpoint
+        self.lines = 0 # number of lines in the log
+        self.sources = [] # functions called before each checkpoint to record the current positions
+        self.lock = threading.Lock()
+        self.lock_write = threading.Lock() # held by a checkpoint till it has written, as checkpoint is called from two threads
+        self.stopped = threading.Event()
+        self.active = threading.Event() # cleared while the box is idle (see suspend)
+        self.active.set()
+        self.thread = None
+        self.count_writes = 0
+        try:
+            with open(file_to_positions, "r") as file:
+                for line in file:
+                    fields = line.rstrip("\n").split("\t")
+                    if len(fields) != 3:
+                        continue # line torn by a power loss
+                    try:
+                        self.positions[fields[0]] = (fields[1], float(fields[2]))
+                    except ValueError:
+                        continue
+                    self.lines += 1
+        except FileNotFoundError:
+            pass
+        log.info("%s playlist positions loaded from %s", len(self.positions), file_to_positions)
+
+    def file(self, playlist):
+        "Get the file reached in a playlist (None if unknown)"
+        return self.positions.get(playlist, (None, 0))[0]
+
+    def start(self, playlist, file):
+        "Get the time in sec from which a file of a playlist should start (0 if it was not the one reached)"
+        saved_file, seconds = self.positions.get(playlist, (None, 0))
+        return seconds if saved_file == file else 0
+
+    def set(self, playlist, file, seconds):
+        "Record the file and time reached in a playlist (written at the next checkpoint)"
+        with self.lock:
+            if self.positions.get(playlist) != (file, seconds):
+                self.positions[playlist] = (file, seconds)
+                self.pending[playlist] = (file, seconds)
+
+    def checkpoint(self):
+        "Append the positions changed since the last checkpoint to the log (or compact it)"
+        for source in self.sources:
+            source()
+        with self.lock_write: # a compaction from older positions must not replace the log after a newer append
+            with self.lock:
+                if not self.pending:
+                    return
+                pending, self.pending = self.pending, {}
+                positions = dict(self.positions)
+            if self.lines + len(pending) > self.compact_factor * len(positions) + 16:
+                self.compact(positions = positions)
+                return
+            with open(self.file_to_positions, "a") as file:
+                for playlist, (track, seconds) in pending.items():
+                    file.write(f"{playlist}\t{track}\t{seconds:.1f}\n")
+                file.flush()
+                os.fsync(file.fileno())
+            self.lines += len(pending)
+            self.count_writes += 1
+
+    def compact(self, positions):
+        "Rewrite the log with only the last position of each playlist (atomically, called by checkpoint under lock_write)"
+        file_tmp = self.file_to_positions + ".tmp"
+        with open(file_tmp, "w") as file:
+            for playlist, (track, seconds) in sorted(positions.items()):
+                file.write(f"{playlist}\t{track}\t{seconds:.1f}\n")
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(file_tmp, self.file_to_positions)
+        self.lines = len(positions)
+        self.count_writes += 1
+        log.info("positions log compacted to %s lines", self.lines)
+
+    def run(self):
+        "Checkpoint at regular intervals till close() is called (run in its own thread, which sleeps while suspended)"
+        while True:
+            self.active.wait()
+            if self.stopped.wait(timeout = self.interval):
+                break
+            try:
+                self.checkpoint()
+            except OSError:
+                log.exception("cannot write positions to %s", self.file_to_positions)
+
+    def start_checkpoints(self):
+        "Start checkpointing in the background"
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def suspend(self):
+        "Write the last positions and stop checkpointing till wake() is called (nothing plays meanwhile)"
+        self.active.clear()
+        self.checkpoint()
+
+    def wake(self):
+        "Checkpoint at regular intervals again, after suspend"
+        self.active.set()
+
+    def close(self):
+        "Stop checkpointing and write the last positions"
+        self.stopped.set()
+        self.active.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.checkpoint()
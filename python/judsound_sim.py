@@ -0,0 +1,445 @@
+#!/usr/bin/python3
+
+"""Simulate the box without hardware (no GPIO, no VLC, no sound card)
+
+The box runs with gpiozero mock pins, a fake VLC (sounds only take time) and a virtual clock
+running faster than real time. It is driven by a trace of events, one per line:
+
+    <virtual seconds since start> <action> [argument]
+
+with the actions:
+    press <button>   short press of a top button (0-3) or of the mode button (mode)
+    hold <button>    long press of a top button (0-3) or of the mode button (mode)
+    rotate <steps>   turn the rotary encoder by a number of steps (negative = lower volume)
+    alarm <HHMM>     add an alarm (as if set with the buttons), optionally followed by the days
+                     on which it rings again (e.g. "alarm 0715 daily", "alarm 0715 mon,wed")
+    jump <seconds>   move the clock forward (or backward) without time passing
+    load <requests>  send requests to the control socket from 4 clients at once and report their latency
+    end              end the simulation
+
+At the end, alarm accuracy, input to sound latency and CPU usage are reported (latencies are in
+virtual time, so a lower speed gives more precise values).
+
+Usage: python3 judsound_sim.py [trace file] [--speed 600] [--start "2024-01-01 05:50"] [--verbose]
+"""
+
+import os
+import sys
+import time
+import logging
+import argparse
+import datetime
+import tempfile
+import threading
+
+## VIRTUAL CLOCK
+
+class VirtualTime:
+    "Define the class which replaces the module time, with a clock running speed times faster than real time"
+
+    CLOCK_BOOTTIME = 7 # value ignored by clock_gettime below
+
+    def __init__(self, start, speed):
+        """Initialize the clock
+
+        Keyword arguments:
+        start -- the timestamp at which the clock starts
+        speed -- a number specifying how much faster than real time the clock runs
+        """
+
+        self.speed = speed
+        self.origin_real = time.monotonic()
+        self.origin = start
+        self.offset = 0 # sum of all jumps
+
+    def monotonic(self):
+        return (time.monotonic() - self.origin_real) * self.speed
+
+    def clock_gettime(self, clock):
+        return self.monotonic()
+
+    def time(self):
+        return self.origin + self.offset + self.monotonic()
+
+    def localtime(self, secs = None):
+        return time.localtime(self.time() if secs is None else secs)
+
+    def strftime(self, format, t = None):
+        return time.strftime(format, self.localtime() if t is None else t)
+
+    def sleep(self, secs):
+        time.sleep(secs / self.speed)
+
+    def jump(self, secs):
+        "Move the clock without time passing"
+        self.offset += secs
+
+
+class VirtualThreading:
+    "Define the class which replaces the module threading, with timeouts in virtual time"
+
+    def __init__(self, clock):
+        self.Thread = threading.Thread
+        self.Lock = threading.Lock
+        class Event(threading.Event):
+            def wait(self, timeout = None):
+                return super().wait(timeout = None if timeout is None else max(timeout, 0) / clock.speed)
+        self.Event = Event
+
+## FAKE VLC
+
+class FakeVlc:
+    "Define the class which replaces the module vlc: media take time to play but produce no sound"
+
+    class State:
+        NothingSpecial, Opening, Buffering, Playing, Paused, Stopped, Ended, Error = range(8)
+
+    class EventType:
+        MediaPlayerPlaying, MediaPlayerEndReached, MediaPlayerEncounteredError = range(3)
+
+    class MediaParseFlag:
+        local, network, fetch_local, fetch_network, do_interact = 0, 1, 2, 4, 8
+
+    def __init__(self, clock, durations, duration_default = 1):
+        """Initialize the fake VLC
+
+        Keyword arguments:
+        clock -- an object of class VirtualTime
+        durations -- a dictionary giving the duration (in virtual sec) of media from their file name
+        duration_default -- the duration (in virtual sec) of other media
+        """
+
+        self.clock = clock
+        self.durations = durations
+        self.duration_default = duration_default
+
+    def Instance(self, *args):
+        return FakeInstance(vlc = self)
+
+
+
+class FakeInstance:
+
+    def __init__(self, vlc):
+        self.vlc = vlc
+
+    def media_player_new(self):
+        return FakeMediaPlayer(vlc = self.vlc)
+
+    def media_new(self, path):
+        return FakeMedia(path = path, duration = self.vlc.durations.get(os.path.basename(path), self.vlc.duration_default))
+
+    def release(self):
+        pass
+
+
+class FakeMedia:
+
+    def __init__(self, path, duration):
+        self.path = path
+        self.duration = duration
+        self.start = 0 # virtual sec from which the media starts (option start-time)
+
+    def add_option(self, option):
+        if option.startswith("start-time="):
+            self.start = float(option[len("start-time="):])
+
+    def get_mrl(self):
+        return "file://" + self.path
+
+    def parse_with_options(self, flags, timeout):
+        return 0
+
+    def release(self):
+        pass
+
+
+class FakeEventManager:
+
+    def __init__(self):
+        self.callbacks = {}
+
+    def event_attach(self, event_type, callback):
+        self.callbacks.setdefault(event_type, []).append(callback)
+
+    def send(self, event_type):
+        for callback in self.callbacks.get(event_type, []):
+            callback(event_type)
+
+
+class FakeMediaPlayer:
+
+    def __init__(self, vlc):
+        self.vlc = vlc
+        self.media = None
+        self.state = FakeVlc.State.NothingSpecial
+        self.remaining = 0 # virtual sec left to play
+        self.timer = None
+        self.events = FakeEventManager()
+        self.volume = 100
+
+    def event_manager(self):
+        return self.events
+
+    def set_media(self, media):
+        self.stop()
+        self.media = media
+
+    def get_media(self):
+        return self.media
+
+    def get_state(self):
+        return self.state
+
+    def is_playing(self):
+        return self.state == FakeVlc.State.Playing
+
+    def get_time(self):
+        if self.media is None:
+            return -1
+        remaining = self.remaining
+        if self.timer is not None:
+            remaining -= self.vlc.clock.monotonic() - self.time_started
+        return int(1000 * (self.media.duration - remaining))
+
+    def audio_set_volume(self, vol):
+        self.volume = vol
+
+    def start_timer(self):
+        self.time_started = self.vlc.clock.monotonic()
+        self.timer = threading.Timer(self.remaining / self.vlc.clock.speed, self.end)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+            self.remaining -= self.vlc.clock.monotonic() - self.time_started
+
+    def end(self):
+        self.timer = None
+        self.state = FakeVlc.State.Ended
+        self.events.send(FakeVlc.EventType.MediaPlayerEndReached)
+
+    def play(self):
+        if self.media is None or self.state == FakeVlc.State.Playing:
+            return
+        if self.state != FakeVlc.State.Paused:
+            self.remaining = self.media.duration - self.media.start
+        self.state = FakeVlc.State.Playing
+        self.events.send(FakeVlc.EventType.MediaPlayerPlaying)
+        self.start_timer()
+
+    def pause(self):
+        if self.state == FakeVlc.State.Playing:
+            self.cancel_timer()
+            self.state = FakeVlc.State.Paused
+        elif self.state == FakeVlc.State.Paused:
+            self.play()
+
+    def stop(self):
+        self.cancel_timer()
+        if self.media is not None:
+            self.state = FakeVlc.State.Stopped
+
+    def release(self):
+        self.stop()
+
+## SIMULATION
+
+tracks_system = {"start": "start.wav",
+                 "alarm": "alarm_mode.mp3",
+                 "player_night": "player_night_mode.wav",
+                 "player_day": "player_day_mode.wav",
+                 "alarm_sound": "start.wav",
+                 "alarm_preset_at": "alarm_preset_at.wav",
+                 "alarm_set": "alarm_set.mp3",
+                 "alarm_not_set": "alarm_not_set.wav",
+                 "alarm_setting": "alarm_setting.mp3",
+                 "alarm_none": "alarm_none.wav",
+                 "alarm_validation": "alarm_validation.mp3",
+                 "alarms_list": "alarms_list.wav",
+                 "alarms_deleted": "alarms_deleted.wav",
+                 "volume": "volume.wav"}
+
+tracks_music = ["track0.mp3", "track1.mp3", "track3.mp3"] + [f"track2/part{i}/chapter{j}.mp3" # a series of chapters
+                                                             for i in range(2) for j in range(3)]
+
+trace_default = """
+# a night and a morning: time told, music started and stopped, alarms set and ringing
+60 press mode
+120 press 0
+180 rotate 3
+240 rotate -5
+600 hold 0
+900 alarm 0630
+960 alarm 0645
+1000 alarm 0715 daily
+1200 hold mode
+1260 press 1
+1320 hold mode
+1380 hold mode
+3000 press 2
+5400 press mode
+7200 end
+"""
+
+
+class Simulation:
+    "Define the class which runs the box on simulated hardware"
+
+    def __init__(self, start, speed, path):
+        """Create the simulated box
+
+        Keyword arguments:
+        start -- the timestamp at which the virtual clock starts
+        speed -- a number specifying how much faster than real time the virtual clock runs
+        path -- a string specifying a directory where the audio files and alarms are created
+        """
+
+        self.clock = VirtualTime(start = start, speed = speed)
+
+        # fake audio files (only their names matter)
+        path_system_sound = os.path.join(path, "playlist_system")
+        path_music = os.path.join(path, "playlist")
+        for directory, files in ((path_system_sound, list(tracks_system.values()) + [f"{m:02d}.mp3" for m in range(60)]),
+                                 (path_music, tracks_music)):
+            os.makedirs(directory, exist_ok = True)
+            for file in files:
+                os.makedirs(os.path.dirname(os.path.join(directory, file)), exist_ok = True)
+                open(os.path.join(directory, file), "w").close()
+        file_to_alarms = os.path.join(path, "judsound_alarms")
+        open(file_to_alarms, "w").close()
+
+        # replacing hardware and time before the box modules are imported
+        sys.modules["vlc"] = FakeVlc(clock = self.clock, durations = {os.path.basename(file): 600 for file in tracks_music})
+        import gpiozero
+        from gpiozero.pins.mock import MockFactory
+        gpiozero.Device.pin_factory = MockFactory()
+        self.pin_factory = gpiozero.Device.pin_factory
+        import judsound_box, judsound_clock, judsound_player, judsound_playlist
+        for module in (judsound_box, judsound_clock, judsound_player, judsound_playlist):
+            module.time = self.clock
+            module.threading = VirtualThreading(clock = self.clock)
+
+        self.gpio_push_buttons = [11, 10, 22, 9]
+        self.gpio_button_rotary_push = 25
+        self.hold_time = 1
+        self.box = judsound_box.Box(
+            gpio_push_buttons = self.gpio_push_buttons,
+            gpio_button_rotary_push = self.gpio_button_rotary_push,
+            gpio_button_rotary_CLK = 7,
+            gpio_button_rotary_DT = 8,
+            gpio_button_rotary_max_steps = 20,
+            path_music_night = path_music,
+            path_music_day = path_music,
+            path_system_sound = path_system_sound,
+            file_to_alarms = file_to_alarms,
+            hold_time = self.hold_time,
+            tracks_system = dict(tracks_system),
+            file_to_positions = os.path.join(path, "judsound_positions"),
+            file_to_loudness = os.path.join(path, "judsound_loudness.json"),
+            path_control_socket = os.path.join(path, "judsound_control.sock"))
+
+    def pin(self, button):
+        "Get the mock pin of a button (0-3 or mode)"
+        if button == "mode":
+            return self.pin_factory.pin(self.gpio_button_rotary_push)
+        return self.pin_factory.pin(self.gpio_push_buttons[int(button)])
+
+    def push(self, button, duration):
+        "Push a button for a duration in real sec (gpiozero detects holds and bounces in real time)"
+        pin = self.pin(button)
+        pin.drive_low()
+        time.sleep(duration)
+        pin.drive_high()
+        time.sleep(0.15) # let bounce time expire
+
+    def apply(self, action, argument):
+        "Apply an event of the trace"
+        if action == "press":
+            self.push(argument, duration = 0.15)
+        elif action == "hold":
+            self.push(argument, duration = self.hold_time + 0.2)
+        elif action == "rotate":
+            # driving the encoder pins would be subject to the debouncing in real time
+            encoder = self.box.button_rotary_turn
+            for _ in range(abs(int(argument))):
+                encoder.steps = max(-encoder.max_steps, min(encoder.max_steps, encoder.steps + (1 if int(argument) > 0 else -1)))
+                self.box.change_volume()
+        elif action == "alarm":
+            import judsound_clock
+            self.box.clock.add_alarm(alarm = judsound_clock.Alarm.parse(argument))
+        elif action == "jump":
+            self.clock.jump(float(argument))
+            self.box.clock.alarms_changed.set() # wake up main loop so that it recomputes when to wake up
+        elif action == "load":
+            import asyncio, judsound_control
+            latencies, stats = asyncio.run(judsound_control.load_test(path_socket = self.box.path_control_socket,
+                                                                      count = int(argument)))
+            percentile = lambda fraction: 1000 * latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+            print(f"control load test: {len(latencies)} requests, client p50 {percentile(0.5):.1f} ms, "
+                  f"p99 {percentile(0.99):.1f} ms; server p50 {stats['p50']:.1f} ms, p99 {stats['p99']:.1f} ms "
+                  f"(budget {stats['budget']:.0f} ms)")
+        else:
+            raise ValueError("Unknown action: " + action)
+
+    def run(self, trace):
+        "Run the box through a trace (a list of lines) and return the CPU time used"
+        self.box.start()
+        thread_run = threading.Thread(target = self.box.run, daemon = True)
+        thread_run.start()
+        cpu_start = time.process_time()
+        for line in trace:
+            line = line.split("#")[0].split()
+            if not line:
+                continue
+            at = float(line[0])
+            delay = (at - self.clock.monotonic()) / self.clock.speed
+            if delay > 0:
+                time.sleep(delay)
+            if line[1] == "end":
+                break
+            self.apply(action = line[1], argument = " ".join(line[2:]) if len(line) > 2 else None)
+        time.sleep(0.5) # let the last actions complete
+        self.box.stop()
+        thread_run.join(timeout = 10)
+        return time.process_time() - cpu_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "Simulate the box without hardware")
+    parser.add_argument("trace", nargs = "?", help = "file with the events to simulate (default = built-in trace)")
+    parser.add_argument("--speed", type = float, default = 600, help = "speed of the virtual clock relative to real time")
+    parser.add_argument("--start", default = None, help = "start time of the virtual clock (default = today 05:50)")
+    parser.add_argument("--verbose", action = "store_true", help = "write all log messages to the console")
+    arguments = parser.parse_args()
+
+    if arguments.start is None:
+        start = datetime.datetime.combine(datetime.date.today(), datetime.time(5, 50)).timestamp()
+    else:
+        start = datetime.datetime.fromisoformat(arguments.start).timestamp()
+    if arguments.trace is None:
+        trace = trace_default.splitlines()
+    else:
+        with open(arguments.trace, "r") as file:
+            trace = file.readlines()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import judsound_log
+    judsound_log.setup(level = logging.DEBUG if arguments.verbose else logging.INFO,
+                       level_console = logging.DEBUG if arguments.verbose else logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as path:
+        simulation = Simulation(start = start, speed = arguments.speed, path = path)
+        cpu = simulation.run(trace = trace)
+        hours = simulation.clock.monotonic() / 3600
+        print(judsound_log.metrics.dump())
+        idle = simulation.box.idle_stats()
+        print(f"idle {idle['hours']:.2f} h, {idle['wakeups']} wake-ups ({idle['wakeups_per_hour']:.1f} per hour)")
+        print(f"simulated {hours:.2f} h, CPU {cpu:.2f} s ({cpu / max(hours, 1e-9):.2f} s per simulated hour)")
+
+
+if __name__ == "__main__":
+    main()
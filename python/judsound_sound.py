@@ -0,0 +1,546 @@
+#!/usr/bin/python3
+
+import os
+import sys
+import json
+import mmap
+import array
+import fcntl
+import shutil
+import struct
+import subprocess
+import threading
+import time
+import wave
+import logging
+import operator
+import warnings
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", DeprecationWarning)
+        import audioop # removed in Python 3.13, where the slower functions below are used
+except ImportError:
+    audioop = None
+
+log = logging.getLogger(__name__)
+
+rate = 22050 # sampling rate used for all decoded sounds (mono, 16 bits)
+
+
+def clip(samples):
+    "Get PCM samples (bytes) from a list of integers, clipped to 16 bits only if needed (without audioop)"
+    try:
+        return array.array("h", samples).tobytes()
+    except OverflowError:
+        return array.array("h", [max(-32768, min(32767, sample)) for sample in samples]).tobytes()
+
+
+def scale(fragment, gain):
+    "Multiply PCM samples (bytes) by a gain, clipping the result"
+    if audioop is not None:
+        return audioop.mul(fragment, 2, gain)
+    return clip([int(sample * gain) for sample in array.array("h", fragment)])
+
+
+def add(fragment, other):
+    "Add two fragments of PCM samples (bytes) of the same length, clipping the result"
+    if audioop is not None:
+        return audioop.add(fragment, other, 2)
+    return clip(list(map(operator.add, array.array("h", fragment), array.array("h", other))))
+
+
+def decode(file):
+    """Decode an audio file into PCM samples (mono, 16 bits, at the module sampling rate)
+
+    Wav files already in this format are read directly, other files are decoded with ffmpeg.
+
+    Keyword arguments:
+    file -- a string specifying the audio file to decode (including its path)
+    """
+
+    if file.endswith("wav"):
+        with wave.open(file, "rb") as file_wav:
+            if (file_wav.getnchannels(), file_wav.getsampwidth(), file_wav.getframerate()) == (1, 2, rate):
+                return array.array("h", file_wav.readframes(file_wav.getnframes()))
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise OSError(f"ffmpeg is required to decode {file}")
+    pcm = subprocess.run([ffmpeg, "-v", "quiet", "-i", file,
+                          "-f", "s16le", "-ac", "1", "-ar", str(rate), "-"],
+                         capture_output = True, check = True).stdout
+    return array.array("h", pcm)
+
+
+class Pack:
+    """Define the class which holds decoded sounds in a single file, memory-mapped (so that they are not decoded
+    at each start, and the pages are shared by all processes using the pack)
+
+    The file is made of a fixed header (magic, version, length of the index), an index in JSON giving for each
+    sound its samples and the version of its source file, then the PCM samples of all sounds (mono, 16 bits,
+    at the module sampling rate), starting on a page boundary. The pack is rebuilt when a source file changes.
+    """
+
+    magic = b"JSPK"
+    version = 1
+    header = struct.Struct("<4sHI") # magic, version, length of the index in bytes
+
+    def __init__(self, file_pack, path_sound, files):
+        """Map the pack, building it first if it is missing or out of date
+
+        Keyword arguments:
+        file_pack -- a string specifying the pack file (including its path)
+        path_sound -- a string specifying the path to the directory where the audio files are stored
+        files -- a list of file names of the sounds to put in the pack (files which cannot be decoded are left out)
+        """
+
+        self.file_pack = file_pack
+        self.path_sound = os.path.normpath(path_sound)
+        self.index = {} # file name -> [start, end (in samples, None if it cannot be decoded), mtime in ns, size]
+        self.samples = memoryview(b"").cast("h") # all sounds one after the other (mapped from the file)
+        self.mapping = None
+        self.count_builds = 0
+        self.open()
+        files = sorted(set(files))
+        if any(self.stale(file = file) for file in files):
+            self.build(files = files)
+            self.open()
+        self.clips = {file: (entry[0], entry[1]) # file name -> (start, end) in self.samples
+                      for file, entry in self.index.items() if entry[0] is not None}
+
+    def key(self, file):
+        "Get what identifies a version of a source file: [mtime in ns, size] (None if the file does not exist)"
+        try:
+            stat = os.stat(self.path_sound + '/' + file)
+        except OSError:
+            return None
+        return [stat.st_mtime_ns, stat.st_size]
+
+    def stale(self, file):
+        "Check whether a sound is missing from the pack, or was built from another version of its file"
+        entry = self.index.get(file)
+        key = self.key(file = file)
+        return key is not None and (entry is None or entry[2:] != key)
+
+    def open(self):
+        "Map the pack file (the pack is empty if the file is missing, from another version or corrupted)"
+        self.index = {}
+        try:
+            with open(self.file_pack, "rb") as file:
+                magic, version, length = self.header.unpack(file.read(self.header.size))
+                if (magic, version) != (self.magic, self.version):
+                    raise ValueError("not a sound pack of this version")
+                index = json.loads(file.read(length))
+                if (index["rate"], index["byteorder"]) != (rate, sys.byteorder):
+                    raise ValueError("sound pack made for another rate or byte order")
+                mapping = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, struct.error) as error:
+            log.warning("sound pack %s cannot be used, it is built again (%s)", self.file_pack, error)
+            return
+        offset = index["offset"]
+        self.samples = memoryview(mapping)[offset:offset + 2 * index["length"]].cast("h")
+        self.index = index["clips"]
+        self.mapping = mapping
+        log.info("sound pack %s mapped (%s sounds, %s kB)", self.file_pack, len(self.index), len(self.samples) * 2 // 1024)
+
+    def build(self, files):
+        """Write the pack with some sounds (and the other sounds of the current pack whose files still exist),
+        decoding only those which are new or changed
+
+        Keyword arguments:
+        files -- a list of file names of the sounds to put in the pack
+        """
+
+        time_start = time.monotonic()
+        index = {}
+        chunks = []
+        length = 0
+        decoded = 0
+        for file in sorted(set(files) | set(self.index)):
+            key = self.key(file = file)
+            if key is None:
+                continue
+            entry = self.index.get(file)
+            if entry is not None and entry[2:] == key:
+                samples = self.samples[entry[0]:entry[1]] if entry[0] is not None else None
+            else:
+                decoded += 1
+                try:
+                    samples = decode(self.path_sound + '/' + file)
+                except (OSError, EOFError, wave.Error, subprocess.CalledProcessError) as error:
+                    log.warning("sound pack cannot decode %s (%s)", file, error)
+                    samples = None
+            if samples is None:
+                index[file] = [None, None] + key # not decoded again till the file changes
+                continue
+            index[file] = [length, length + len(samples)] + key
+            chunks.append(samples)
+            length += len(samples)
+
+        # the samples start on a page boundary, after the header and the index
+        meta = {"rate": rate, "byteorder": sys.byteorder, "offset": 0, "length": length, "clips": index}
+        text = json.dumps(meta).encode()
+        offset = -(-(self.header.size + len(text) + 16) // mmap.PAGESIZE) * mmap.PAGESIZE # room for the offset digits
+        meta["offset"] = offset
+        text = json.dumps(meta).encode()
+        file_tmp = self.file_pack + ".tmp"
+        with open(file_tmp, "wb") as file:
+            file.write(self.header.pack(self.magic, self.version, len(text)))
+            file.write(text)
+            file.write(bytes(offset - self.header.size - len(text)))
+            for samples in chunks:
+                file.write(samples)
+            file.flush()
+            os.fsync(file.fileno())
+        del chunks # the chunks may be views of the previous mapping
+        self.samples = memoryview(b"").cast("h")
+        self.mapping = None
+        os.replace(file_tmp, self.file_pack)
+        self.count_builds += 1
+        log.info("sound pack %s built in %.2f s (%s sounds decoded, %s kept)",
+                 self.file_pack, time.monotonic() - time_start, decoded, len(index) - decoded)
+
+
+class SinkAlsa:
+    """Define the class which sends PCM samples to the sound card (through a persistent aplay process)
+
+    Samples waiting in the pipe to aplay are not played yet, so writes are paced against a clock
+    (as SinkFile does) to stay at most buffer_time plus one block ahead of the sound card, and the
+    pipe is shrunk to a page (a full default pipe would hold about 1.5 s of sound).
+    """
+
+    def __init__(self, device = None, buffer_time = 20000):
+        """Start the output stream
+
+        Keyword arguments:
+        device -- a string specifying the ALSA device (default = None: default device)
+        buffer_time -- an integer specifying the size of the ALSA buffer in microseconds (i.e. the latency)
+        """
+
+        self.command = ["aplay", "-q", "-t", "raw", "-f", "S16_LE", "-c", "1", "-r", str(rate),
+                        f"--buffer-time={buffer_time}"]
+        if device is not None:
+            self.command += ["-D", device]
+        self.lead = buffer_time / 1e6 + 0.01 # time in sec by which writes may be ahead of playback
+        self.open()
+
+    def open(self):
+        "Start the output stream (again, after close)"
+        self.process = subprocess.Popen(self.command, stdin = subprocess.PIPE)
+        try:
+            fcntl.fcntl(self.process.stdin.fileno(), fcntl.F_SETPIPE_SZ, mmap.PAGESIZE)
+        except (AttributeError, OSError) as error: # not Linux, or Python < 3.10
+            log.info("pipe to aplay not shrunk (%s)", error)
+        self.deadline = time.monotonic() # time at which the samples written so far are played
+
+    def write(self, data):
+        "Write PCM samples (blocks till they are due to be played in less than lead)"
+        self.process.stdin.write(data)
+        self.process.stdin.flush()
+        self.deadline = max(self.deadline, time.monotonic()) + len(data) / (2 * rate)
+        delay = self.deadline - self.lead - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def close(self):
+        "Stop the output stream"
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class SinkFile:
+    "Define the class which writes PCM samples to a raw file (or nowhere) in real time, for use without sound card"
+
+    def __init__(self, path = None):
+        """Open the output file
+
+        Keyword arguments:
+        path -- a string specifying the file to write (default = None: samples are discarded)
+        """
+
+        self.path = path
+        self.file = open(path, "wb") if path is not None else None
+        self.deadline = time.monotonic()
+
+    def open(self):
+        "Open the output file again, after close (samples are appended)"
+        if self.path is not None:
+            self.file = open(self.path, "ab")
+        self.deadline = time.monotonic()
+
+    def write(self, data):
+        "Write PCM samples (blocks for as long as they would take to be played)"
+        if self.file is not None:
+            self.file.write(data)
+        self.deadline = max(self.deadline, time.monotonic() - 0.1) + len(data) / (2 * rate)
+        delay = self.deadline - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def close(self):
+        "Close the output file"
+        if self.file is not None:
+            self.file.close()
+
+
+class Engine:
+    "Define the class which plays short sounds from memory by mixing them into a single persistent output stream"
+
+    block = rate // 100 # number of samples written at once (10 ms)
+    max_errors = 3 # number of writes failing in a row after which the engine gives up (sounds are then left to VLC)
+
+    def __init__(self, path_sound, files, sink, pack = None):
+        """Decode the sounds (or take them from a pack) and start the output stream
+
+        Keyword arguments:
+        path_sound -- a string specifying the path to the directory where the audio files are stored
+        files -- a list of file names to decode (files which cannot be decoded are left to VLC)
+        sink -- an object of class SinkAlsa or SinkFile (closed by suspend, opened again when a sound is played)
+        pack -- an object of class Pack holding the sounds already decoded, played from it without copy
+                (default = None: sounds are decoded at each start)
+        """
+
+        path_sound = os.path.normpath(path_sound)
+        self.store = array.array("h") # all decoded sounds one after the other
+        self.clips = {} # file name -> (start, end) in self.store
+        if pack is not None:
+            self.store = pack.samples
+            files = set(files)
+            self.clips = {file: clip for file, clip in pack.clips.items() if file in files}
+            files = ()
+        for file in sorted(set(file for file in files if file is not None)):
+            try:
+                samples = decode(path_sound + '/' + file)
+            except (OSError, EOFError, wave.Error, subprocess.CalledProcessError) as error:
+                log.warning("sound engine cannot decode %s (%s)", file, error)
+                continue
+            self.clips[file] = (len(self.store), len(self.store) + len(samples))
+            self.store.extend(samples)
+        log.info("sound engine loaded %s sounds (%s kB)", len(self.clips), len(self.store) * 2 // 1024)
+
+        self.voices = [] # sounds being played, as [position, end, gain, done]
+        self.lock = threading.Lock()
+        self.silence = bytes(2 * self.block)
+        self.sink = sink
+        self.sink_open = True
+        self.active = threading.Event() # cleared while the output stream is closed (see suspend)
+        self.active.set()
+        self.lock_sink = threading.Lock() # held while a block is written, so that the sink is not closed meanwhile
+        self.running = True
+        self.failed = False # set once the output stream cannot be written to anymore
+        self.thread = threading.Thread(target = self.run, daemon = True)
+        self.thread.start()
+
+    def play(self, file, vol):
+        """Start playing a sound and return a threading.Event set when it has been fully played
+
+        Keyword arguments:
+        file -- a string specifying the name of the file to play (must be in self.clips)
+        vol -- an integer specifying the volume (0-100, as for VLC)
+        """
+
+        start, end = self.clips[file]
+        done = threading.Event()
+        with self.lock:
+            if self.failed: # nothing mixes the sound anymore
+                done.set()
+                return done
+            self.voices.append([start, end, vol / 100, done])
+        if not self.active.is_set(): # checked after the sound is added, so that suspend cannot miss it
+            self.wake()
+        return done
+
+    def can_play(self, file):
+        "Check whether a sound can be played by the engine (False if it is not loaded or if the output has failed)"
+        return file in self.clips and not self.failed
+
+    def set_gain(self, gain):
+        "Change the gain of all sounds being played (used to fade them)"
+        with self.lock:
+            for voice in self.voices:
+                voice[2] = gain
+
+    def is_playing(self):
+        "Check whether a sound is being played"
+        return bool(self.voices)
+
+    def stop(self):
+        "Stop all sounds being played"
+        with self.lock:
+            voices, self.voices = self.voices, []
+        for voice in voices:
+            voice[3].set()
+
+    def suspend(self):
+        """Close the output stream, so that the sound card is released and the engine sleeps till the next sound
+
+        Return False if a sound is being played (the stream is then left open).
+        """
+        if self.voices:
+            return False
+        self.active.clear() # the loop stops writing before its next block
+        with self.lock_sink:
+            if self.voices: # a sound started meanwhile
+                self.active.set()
+                return False
+            if self.sink_open:
+                self.sink.close()
+                self.sink_open = False
+        log.info("sound engine suspended")
+        return True
+
+    def wake(self):
+        "Open the output stream again, after suspend (done by play, so that the first sound is not delayed further)"
+        with self.lock_sink:
+            if not self.sink_open:
+                self.sink.open()
+                self.sink_open = True
+                log.info("sound engine woken up")
+            self.active.set()
+
+    def mix(self):
+        "Mix the next block of all sounds being played (with bulk operations on the samples, see scale and add)"
+        with self.lock:
+            voices = list(self.voices)
+        mixed = self.silence
+        for voice in voices:
+            position, end, gain, done = voice
+            count = min(self.block, end - position)
+            fragment = scale(self.store[position:position + count].tobytes(), gain)
+            if count < self.block:
+                fragment += self.silence[2 * count:]
+            mixed = fragment if mixed is self.silence else add(mixed, fragment)
+            voice[0] = position + count
+            if voice[0] >= end:
+                with self.lock:
+                    self.voices = [other for other in self.voices if other is not voice]
+                done.set()
+        return mixed
+
+    def run(self):
+        """Write mixed blocks to the sink continuously (the sink paces the loop), except while suspended
+
+        If a write fails (e.g. aplay exits as the sound card is busy), the sounds being played are dropped
+        and the output stream is opened again; after max_errors failures in a row the engine is marked as
+        failed, so that the player leaves its sounds to VLC.
+        """
+        errors = 0
+        while self.running:
+            self.active.wait()
+            with self.lock_sink:
+                if not (self.sink_open and self.running): # suspended meanwhile
+                    continue
+                try:
+                    self.sink.write(self.mix())
+                    errors = 0
+                except OSError as error:
+                    errors += 1
+                    log.error("sound engine cannot write to its output (%s)", error)
+                    self.stop()
+                    self.reopen(give_up = errors >= self.max_errors)
+
+    def reopen(self, give_up):
+        "Close the output stream after an error, and open it again unless give_up (called by run)"
+        try:
+            self.sink.close()
+        except OSError:
+            pass
+        self.sink_open = False
+        if not give_up:
+            try:
+                self.sink.open()
+                self.sink_open = True
+                return
+            except OSError as error:
+                log.error("sound engine cannot open its output again (%s)", error)
+        log.error("sound engine disabled, sounds are played by VLC")
+        with self.lock:
+            self.failed = True
+        self.running = False
+        self.stop() # sounds started meanwhile
+
+    def close(self):
+        "Stop the output stream"
+        self.running = False
+        self.stop()
+        self.active.set() # so that the loop ends
+        self.thread.join()
+        if self.sink_open:
+            self.sink.close()
+            self.sink_open = False
+
+
+def rss():
+    "Get the resident memory of this process in kB, anonymous (RssAnon) and file-backed (RssFile) (empty if unknown)"
+    memory = {}
+    try:
+        with open("/proc/self/status", "r") as file:
+            for line in file:
+                name, _, value = line.partition(":")
+                if name in ("RssAnon", "RssFile"):
+                    memory[name] = int(value.split()[0])
+    except OSError:
+        pass
+    return memory
+
+
+def load(path_sound, files, file_pack = None):
+    """Load sounds as the engine does at startup, and read all their samples once (as if each was played)
+
+    Return the time in sec taken to load the sounds, and the resident memory afterwards (see rss).
+
+    Keyword arguments:
+    path_sound -- a string specifying the path to the directory where the audio files are stored
+    files -- a list of file names of the sounds
+    file_pack -- a string specifying the pack file (default = None: each file is decoded)
+    """
+
+    time_start = time.monotonic()
+    if file_pack is not None:
+        store = Pack(file_pack = file_pack, path_sound = path_sound, files = files).samples
+    else:
+        store = array.array("h")
+        for file in sorted(set(files)):
+            try:
+                store.extend(decode(os.path.normpath(path_sound) + '/' + file))
+            except (OSError, EOFError, wave.Error, subprocess.CalledProcessError):
+                continue
+    time_load = time.monotonic() - time_start
+    sum(store[::mmap.PAGESIZE // 2]) # one sample per page
+    return time_load, rss()
+
+
+def main():
+    "Build the pack of the system sounds, and compare loading it with decoding each file (in separate processes)"
+    import argparse
+    parser = argparse.ArgumentParser(description = "Build the pack of the system sounds (rebuilt only if a sound changed)")
+    parser.add_argument("path_sound", help = "directory of the system sounds")
+    parser.add_argument("file_pack", help = "pack file to build")
+    parser.add_argument("--benchmark", action = "store_true", help = "compare the startup time and memory with decoding each file")
+    parser.add_argument("--load", choices = ("files", "pack"), help = argparse.SUPPRESS) # run by --benchmark
+    arguments = parser.parse_args()
+    files = sorted(file for file in os.listdir(arguments.path_sound) if file.endswith("mp3") or file.endswith("wav"))
+
+    if arguments.load is not None:
+        time_load, memory = load(path_sound = arguments.path_sound, files = files,
+                                 file_pack = arguments.file_pack if arguments.load == "pack" else None)
+        print(json.dumps({"time": time_load, **memory}))
+        return
+
+    logging.basicConfig(level = logging.INFO, format = "%(message)s")
+    pack = Pack(file_pack = arguments.file_pack, path_sound = arguments.path_sound, files = files)
+    print(f"{arguments.file_pack}: {len(pack.clips)} sounds, {len(pack.samples) * 2 // 1024} kB "
+          f"({'built' if pack.count_builds else 'up to date'})")
+    if arguments.benchmark:
+        for mode in ("files", "pack"):
+            result = json.loads(subprocess.run([sys.executable, os.path.abspath(__file__), arguments.path_sound,
+                                                arguments.file_pack, "--load", mode],
+                                               capture_output = True, check = True, text = True).stdout)
+            print(f"{mode:5}: loaded in {1000 * result['time']:7.1f} ms, RSS anonymous {result.get('RssAnon', '?')} kB, "
+                  f"file-backed (shared) {result.get('RssFile', '?')} kB")
+
+
+if __name__ == "__main__":
+    main()
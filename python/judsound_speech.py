@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+
+import os
+import array
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import wave
+from collections import OrderedDict
+import logging
+import judsound_sound
+
+log = logging.getLogger(__name__)
+
+class SpeechCache:
+    "Define the class which pre-renders the announcement of a time (hours + minutes) into a single audio file"
+
+    def __init__(self, path_system_sound, tracks_dictionary, size = 32, path_cache = None, pack = None):
+        """Initialize the cache
+
+        Keyword arguments:
+        path_system_sound -- a string specifying the path to the directory where the audio files for clock and system sounds are stored
+        tracks_dictionary -- the dictionary for the system sounds (used to find the files for hours and minutes)
+        size -- an integer specifying how many announcements are kept (least recently used ones are removed first)
+        path_cache -- a string specifying the directory where announcements are stored
+                      (default = None: directory in memory, so the cache does not survive reboots)
+        pack -- an object of class judsound_sound.Pack holding the clips already decoded (default = None: clips are decoded)
+        """
+
+        self.path_system_sound = os.path.normpath(path_system_sound)
+        self.tracks_dictionary = tracks_dictionary
+        self.size = size
+        self.pack = pack
+
+        # decoding mp3 files requires ffmpeg, without it (or a pack) announcements are played clip by clip
+        self.ffmpeg = shutil.which("ffmpeg")
+        if self.ffmpeg is None and pack is None:
+            log.warning("ffmpeg not found: time announcements will not be cached")
+
+        if path_cache is None:
+            path_memory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            path_cache = os.path.join(path_memory, "judsound_speech")
+        self.path_cache = os.path.normpath(path_cache)
+        os.makedirs(self.path_cache, exist_ok = True)
+
+        # registering announcements rendered before a restart (oldest use first)
+        files_in_path_cache = [file for file in os.listdir(self.path_cache) if file.endswith(".wav")]
+        files_in_path_cache.sort(key = lambda file: os.path.getmtime(os.path.join(self.path_cache, file)))
+        self.files = OrderedDict((file[:-4], os.path.join(self.path_cache, file))
+                                 for file in files_in_path_cache)
+        self.evict()
+
+    def decode(self, track_name):
+        "Decode a system sound into PCM samples (copied from the pack if it holds the sound)"
+        file = self.tracks_dictionary[track_name]
+        if self.pack is not None and file in self.pack.clips:
+            start, end = self.pack.clips[file]
+            samples = array.array("h")
+            samples.frombytes(self.pack.samples[start:end].cast("B"))
+            return samples
+        return judsound_sound.decode(os.path.join(self.path_system_sound, file))
+
+    @staticmethod
+    def amplify(samples, gain):
+        "Multiply PCM samples by a gain (with clipping)"
+        if gain == 1:
+            return samples
+        return array.array("h", (max(-32768, min(32767, int(sample * gain))) for sample in samples))
+
+    def render(self, hours, minutes, gain_hours, file):
+        "Concatenate the clips needed to tell a time into a single wav file"
+        samples = self.amplify(self.decode(hours), gain_hours)
+        if minutes < "10":
+            samples.extend(self.decode("00")) # for "o" before min < 10.
+        samples.extend(self.decode(minutes))
+        file_tmp = file + ".tmp"
+        with wave.open(file_tmp, "wb") as file_wav:
+            file_wav.setnchannels(1)
+            file_wav.setsampwidth(2)
+            file_wav.setframerate(judsound_sound.rate)
+            file_wav.writeframes(samples.tobytes())
+        os.replace(file_tmp, file)
+
+    def version(self, hours, minutes):
+        "Get a short digest of the versions (mtime and size) of the clips telling a time, so that edited clips are rendered again"
+        names = [hours, "00", minutes] if minutes < "10" else [hours, minutes]
+        versions = []
+        for name in names:
+            file = self.tracks_dictionary.get(name)
+            try:
+                stat = os.stat(os.path.join(self.path_system_sound, file))
+                versions.append(f"{file}:{stat.st_mtime_ns}:{stat.st_size}")
+            except (OSError, TypeError): # missing clip (rendering reports it)
+                versions.append(f"{file}:")
+        return hashlib.sha1("|".join(versions).encode()).hexdigest()[:8]
+
+    def get(self, hours, minutes, gain_hours = 1):
+        """Get the path to the file telling a given time (rendering it if needed)
+
+        Return None if the announcement cannot be rendered.
+
+        Keyword arguments:
+        hours -- a string with the two digits of the hours
+        minutes -- a string with the two digits of the minutes
+        gain_hours -- a number specifying how much louder than the minutes to tell the hours
+        """
+        key = f"{hours}{minutes}_{round(gain_hours * 100)}_{self.version(hours = hours, minutes = minutes)}"
+        if key in self.files:
+            self.files.move_to_end(key)
+            os.utime(self.files[key]) # keep track of the order of use across restarts
+            return self.files[key]
+        if (self.ffmpeg is None and self.pack is None) or self.size < 1:
+            return None
+        file = os.path.join(self.path_cache, key + ".wav")
+        try:
+            self.render(hours = hours, minutes = minutes, gain_hours = gain_hours, file = file)
+        except (OSError, KeyError, EOFError, wave.Error, subprocess.CalledProcessError) as error:
+            log.warning("could not render announcement %s:%s (%s)", hours, minutes, error)
+            return None
+        self.files[key] = file
+        self.evict()
+        return file
+
+    def clear(self):
+        "Remove all announcements (e.g. when the clips they are made of change)"
+        size, self.size = self.size, 0
+        self.evict()
+        self.size = size
+
+    def evict(self):
+        "Remove the least recently used announcements beyond the size of the cache"
+        while len(self.files) > max(self.size, 0):
+            _, file = self.files.popitem(last = False)
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
@@ -1,62 +1,58 @@
 #!/usr/bin/python3
 
-import time
+import os
+import sys
+import signal
+import logging
 import warnings
+import threading
 import judsound_box
+import judsound_config
+import judsound_log
+import judsound_player
 
 ## PRELUDE
 
-print('*** Starting Judsound ***')
+# messages are kept in memory, only warnings and errors go to the log file
+# (send SIGUSR1 or connect to the socket to get metrics and recent messages)
+judsound_log.setup(level = logging.INFO,
+                   level_console = logging.WARNING,
+                   path_socket = "/tmp/judsound.sock")
+logging.captureWarnings(True)
+log = logging.getLogger("main")
+
+log.warning('*** Starting Judsound ***')
 warnings.filterwarnings('default', category = DeprecationWarning) # to show deprecation warnings in console
 
-time.sleep(10) # give some time for ALSA service to start (10s should be OK)
+# settings of the box (path given as argument, default = judsound.json next to this file)
+# (read before waiting for the sound card, so that an invalid file is reported at once)
+# (reloaded on SIGHUP, i.e. systemctl --user reload judsound, and whenever the file is written)
+file_config = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), "judsound.json")
+config = judsound_config.Config(file_config = file_config)
+
+# give some time for ALSA service to start (continue as soon as a sound card is listed)
+time_waited = judsound_player.wait_audio_ready(timeout = 30)
+if time_waited is None:
+    log.warning("No sound card found after 30s, starting anyway")
+else:
+    log.info("Sound card ready after %.2fs", time_waited)
 
-file_path = '/home/pi/judsound_alarms'
+file_path = config.settings["file_to_alarms"]
 try:
     open(file_path, 'x')
 except FileExistsError:
-    print(f"The file {file_path} already exists.")
+    log.info("The file %s already exists.", file_path)
 
 ## RUNNING THE PROGRAM
 
-judsound_box.Box(
-    gpio_push_buttons = [11, 10, 22, 9],
-    gpio_button_rotary_push = 25,
-    gpio_button_rotary_CLK = 7,
-    gpio_button_rotary_DT = 8,
-    gpio_button_rotary_max_steps = 20, #half of the effective number of steps
-    path_music_night = "/home/pi/playlist_night",
-    path_music_day = "/home/pi/playlist_day",
-    path_system_sound = "/home/pi/playlist_system",
-    file_to_alarms = "/home/pi/judsound_alarms",
-    possible_modes = ["player_night", "alarm", "player_day"],
-    vol_min = 10,
-    vol_max = 50,
-    vol_music_day = 30,
-    vol_music_night = 15,
-    vol_system_day = 35,
-    vol_system_night = 25,
-    vol_startup_msg = 50,
-    vol_alarm = 50,
-    vol_diff_hours = 1,
-    hold_time = 1,
-    night_day_h = 6,
-    day_night_h = 22,
-    tracks_system = {# welcome sound
-                     "start": "start.wav",
-                     # changing mode
-                     "alarm": "alarm_mode.mp3",
-                     "player_night": "player_night_mode.wav",
-                     "player_day": "player_day_mode.wav",
-                     # setting alarm
-                     "alarm_sound": "start.wav",
-                     "alarm_preset_at":"alarm_preset_at.wav",
-                     "alarm_set":"alarm_set.mp3",
-                     "alarm_not_set": "alarm_not_set.wav",
-                     "alarm_setting": "alarm_setting.mp3",
-                     "alarm_none": "alarm_none.wav",
-                     "alarm_validation": "alarm_validation.mp3",
-                     "alarms_list": "alarms_list.wav",
-                     "alarms_deleted":"alarms_deleted.wav",
-                     # volume feedback sound
-                     "volume":"water-droplet-2-165634_short.wav"})
+box = judsound_box.Box(**config.settings)
+config.watch(box = box)
+
+# stopping cleanly when systemd stops the service (or on Ctrl+C)
+signal.signal(signal.SIGTERM, lambda signum, frame: box.stop())
+signal.signal(signal.SIGINT, lambda signum, frame: box.stop())
+# reloading settings from another thread (the handler runs in the main loop, which may hold locks)
+signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target = config.reload, daemon = True).start())
+
+box.start()
+box.run()
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+"""Fixtures shared by the tests
+
+The box runs on gpiozero mock pins and on the fake VLC of the simulation (sounds take time but make no
+noise), in real time. Sounds play speed_sounds times faster than they would, so that tests are quick.
+"""
+
+import os
+import sys
+import time
+import threading
+import importlib.util
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import judsound_sim
+
+# real VLC is only used by the startup benchmark, run in its own process (see test_startup)
+have_vlc = importlib.util.find_spec("vlc") is not None
+speed_sounds = 100
+durations = {os.path.basename(file): 600 for file in judsound_sim.tracks_music} # music tracks last 6 s
+sys.modules["vlc"] = judsound_sim.FakeVlc(clock = judsound_sim.VirtualTime(start = time.time(), speed = speed_sounds),
+                                          durations = durations)
+
+import gpiozero
+from gpiozero.pins.mock import MockFactory
+
+
+def make_files(path):
+    """Create the (empty) audio files of the simulation in a directory
+
+    Return the paths of the system sounds and of the music.
+    """
+    path_system_sound = os.path.join(path, "playlist_system")
+    path_music = os.path.join(path, "playlist")
+    files_system = list(judsound_sim.tracks_system.values()) + [f"{m:02d}.mp3" for m in range(60)]
+    for directory, files in ((path_system_sound, files_system), (path_music, judsound_sim.tracks_music)):
+        for file in files:
+            os.makedirs(os.path.dirname(os.path.join(directory, file)), exist_ok = True)
+            open(os.path.join(directory, file), "w").close()
+    return path_system_sound, path_music
+
+
+class Rig:
+    "Define the class which runs a box on mock pins and presses its buttons"
+
+    gpio_push_buttons = [11, 10, 22, 9]
+    gpio_button_rotary_push = 25
+    hold_time = 0.4
+
+    def __init__(self, path, **settings):
+        """Create and start the box (settings override those of the rig)
+
+        Keyword arguments:
+        path -- a string specifying a directory where the audio files and alarms are created
+        settings -- arguments of judsound_box.Box
+        """
+
+        import judsound_box
+        path_system_sound, path_music = make_files(path)
+        self.file_to_alarms = os.path.join(path, "judsound_alarms")
+        self.pin_factory = gpiozero.Device.pin_factory
+        arguments = dict(gpio_push_buttons = self.gpio_push_buttons,
+                         gpio_button_rotary_push = self.gpio_button_rotary_push,
+                         gpio_button_rotary_CLK = 7,
+                         gpio_button_rotary_DT = 8,
+                         gpio_button_rotary_max_steps = 20,
+                         path_music_night = path_music,
+                         path_music_day = path_music,
+                         path_system_sound = path_system_sound,
+                         file_to_alarms = self.file_to_alarms,
+                         hold_time = self.hold_time,
+                         tracks_system = dict(judsound_sim.tracks_system),
+                         alarm_fade_in = 0,
+                         fade_time = 0,
+                         idle_time = None)
+        arguments.update(settings)
+        self.box = judsound_box.Box(**arguments)
+        self.box.start()
+        self.thread_run = threading.Thread(target = self.box.run, daemon = True)
+        self.thread_run.start()
+
+    def pin(self, button):
+        "Get the mock pin of a button (0-3 or mode)"
+        if button == "mode":
+            return self.pin_factory.pin(self.gpio_button_rotary_push)
+        return self.pin_factory.pin(self.gpio_push_buttons[button])
+
+    def push(self, button, duration):
+        "Push a button for a duration in sec, then wait for the actions it queued to complete"
+        pin = self.pin(button)
+        pin.drive_low()
+        time.sleep(duration)
+        pin.drive_high()
+        time.sleep(0.15) # let bounce time expire
+        self.settle()
+
+    def press(self, button):
+        "Press a button shortly (less than hold_time)"
+        self.push(button, duration = 0.15)
+
+    def hold(self, button):
+        "Hold a button (longer than hold_time)"
+        self.push(button, duration = self.hold_time + 0.2)
+
+    def settle(self, timeout = 10):
+        "Wait till the actions queued so far have run"
+        self.box.submit(lambda: None, from_input = False).result(timeout = timeout)
+
+    def close(self):
+        "Stop the box"
+        self.box.stop()
+        self.thread_run.join(timeout = 20)
+
+
+@pytest.fixture
+def pins():
+    "Use gpiozero mock pins (reset after the test)"
+    gpiozero.Device.pin_factory = MockFactory()
+    yield gpiozero.Device.pin_factory
+    gpiozero.Device.pin_factory.reset()
+
+
+@pytest.fixture
+def rig(pins, tmp_path):
+    "Get a running box on mock pins (stopped after the test)"
+    rig = Rig(path = str(tmp_path))
+    yield rig
+    rig.close()
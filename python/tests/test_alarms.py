@@ -0,0 +1,111 @@
+#!/usr/bin/python3
+
+"Tests of the alarms kept in memory, of when the alarms file is read and written, and of the occurrences of alarms"
+
+import os
+import datetime
+import time
+import pytest
+import judsound_clock
+
+
+def make_clock(path, lines = ()):
+    "Get a clock whose alarms file holds some lines (it plays no sound)"
+    file_to_alarms = os.path.join(path, "judsound_alarms")
+    with open(file_to_alarms, "w") as file:
+        file.writelines(line + "\n" for line in lines)
+    return judsound_clock.Clock(player_system = None, file_to_alarms = file_to_alarms)
+
+
+def test_file_read_once(tmp_path):
+    clock = make_clock(path = str(tmp_path), lines = ["0630", "0715 weekdays"])
+    clock.read_alarms()
+    for _ in range(1440): # a day of checks, each minute
+        clock.ring_alarm(update = True)
+    assert clock.count_reads == 1
+    assert clock.count_writes == 0
+    assert clock.alarms_text() == ["06:30", "07:15 weekdays"]
+
+
+def test_file_written_on_changes_only(tmp_path):
+    clock = make_clock(path = str(tmp_path), lines = ["0630"])
+    clock.add_alarm(alarm = [0, 7, 0, 0])
+    assert clock.count_writes == 1
+    clock.add_alarm(alarm = [0, 7, 0, 0]) # duplicate
+    clock.remove_alarm(alarm = [0, 8, 0, 0]) # not an alarm
+    assert clock.count_writes == 1
+    clock.remove_alarm(alarm = [0, 6, 3, 0])
+    assert clock.count_writes == 2
+    assert clock.count_reads == 1
+    with open(clock.file_to_alarms) as file:
+        assert file.read() == "0700\n"
+    assert os.listdir(os.path.dirname(clock.file_to_alarms)) == ["judsound_alarms"] # no temporary file left
+
+
+def test_file_edited_by_hand(tmp_path):
+    clock = make_clock(path = str(tmp_path), lines = ["0630"])
+    clock.read_alarms()
+    time.sleep(0.01) # so that the modification time differs
+    with open(clock.file_to_alarms, "a") as file:
+        file.write("0900 daily\nnot an alarm\n")
+    assert clock.read_alarms()
+    assert clock.count_reads == 2
+    assert clock.alarms_text() == ["06:30", "09:00 daily"] # invalid lines are skipped
+    assert not clock.read_alarms()
+    assert clock.count_reads == 2
+
+
+def timestamp(date, at = "00:00"):
+    "Get the timestamp of a local time (HH:MM) of a date (YYYY-MM-DD)"
+    return datetime.datetime.combine(datetime.date.fromisoformat(date), datetime.time.fromisoformat(at)).timestamp()
+
+
+def test_alarm_parse_and_text():
+    for text in ("0730", "0730 daily", "0730 weekdays", "0730 weekends", "0730 mon,wed,fri",
+                 "0730 weekdays skip=2024-12-24,2024-12-25"):
+        assert judsound_clock.Alarm.parse(text).text() == text
+    assert judsound_clock.Alarm.parse("07:30 fri,mon").text(separator = ":") == "07:30 mon,fri"
+    for text in ("", "2430", "0760", "730", "0730 someday"):
+        with pytest.raises(ValueError):
+            judsound_clock.Alarm.parse(text)
+
+
+def test_alarm_next_occurrence():
+    monday = "2024-12-23"
+    once = judsound_clock.Alarm.parse("0730")
+    assert once.next_occurrence(timestamp(monday, "07:00")) == timestamp(monday, "07:30")
+    assert once.next_occurrence(timestamp(monday, "07:30")) == timestamp("2024-12-24", "07:30") # strictly after
+    weekdays = judsound_clock.Alarm.parse("0730 weekdays")
+    assert weekdays.next_occurrence(timestamp("2024-12-27", "08:00")) == timestamp("2024-12-30", "07:30") # fri to mon
+    days = judsound_clock.Alarm.parse("0730 wed")
+    assert days.next_occurrence(timestamp("2024-12-25", "08:00")) == timestamp("2025-01-01", "07:30") # a week later
+    skipping = judsound_clock.Alarm.parse("0730 daily skip=2024-12-24,2024-12-25")
+    assert skipping.next_occurrence(timestamp(monday, "08:00")) == timestamp("2024-12-26", "07:30")
+    assert judsound_clock.Alarm.parse("0730 mon skip=2024-12-23").next_occurrence(timestamp("2024-12-22")) \
+        == timestamp("2024-12-30", "07:30")
+
+
+def test_alarm_skip_next_and_expire():
+    alarm = judsound_clock.Alarm.parse("0730 weekdays")
+    skipping = alarm.skip_next(timestamp("2024-12-23", "08:00"))
+    assert skipping.text() == "0730 weekdays skip=2024-12-24"
+    assert skipping.next_occurrence(timestamp("2024-12-23", "08:00")) == timestamp("2024-12-25", "07:30")
+    assert skipping.expire(timestamp("2024-12-24", "12:00")) == skipping # still today
+    assert skipping.expire(timestamp("2024-12-25")) == alarm
+
+
+def test_due_alarms_in_order(tmp_path):
+    "Hundreds of alarms come out of the index in the order they are due, recurring ones being put back"
+    lines = [f"{i // 60:02}{i % 60:02}" + (" daily" if i % 2 else "") for i in range(0, 1440, 4)]
+    clock = make_clock(path = str(tmp_path), lines = lines)
+    clock.read_alarms()
+    assert len(clock.index) == len(lines)
+    now = time.time() + 86400
+    due = clock.due_alarms(now)
+    assert len(due) == len(lines)
+    occurrences = [occurrence for occurrence, _ in due]
+    assert occurrences == sorted(occurrences)
+    assert all(occurrence <= now for occurrence in occurrences)
+    assert sorted(alarm.text() for _, _, alarm in clock.index) == sorted(line for line in lines if "daily" in line)
+    assert all(occurrence > now for occurrence, _, _ in clock.index)
+    assert clock.due_alarms(now) == []
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+"Tests of the press/hold/release handling of the buttons, driven by gpiozero callbacks (no busy loop)"
+
+import time
+
+
+def test_press_plays_and_pauses_playlist(rig):
+    rig.box.submit(rig.box.change_mode, mode = "player_night", speak = False)
+    player = rig.box.player_music_night
+    rig.press(1)
+    assert player.track_current == 1
+    assert player.is_playing()
+    rig.press(1)
+    assert not player.is_playing() # paused
+
+
+def test_hold_skips_track_without_release_action(rig):
+    rig.box.submit(rig.box.change_mode, mode = "player_night", speak = False)
+    player = rig.box.player_music_night
+    index = 2 # the folder of chapters (see judsound_sim.tracks_music)
+    rig.press(index)
+    file = player.playlist.current()
+    rig.hold(index)
+    assert player.playlist.current() != file # skipped to the next track
+    assert player.is_playing() # the release after the hold did not pause the music
+    rig.hold(index)
+    rig.hold((index + 1) % 4) # not the playlist playing: music stopped
+    assert not player.is_playing()
+
+
+def test_hold_mode_button_cycles_modes(rig):
+    rig.box.submit(rig.box.change_mode, mode = "player_night", speak = False)
+    rig.hold("mode")
+    assert rig.box.mode_current == "alarm"
+    rig.hold("mode")
+    assert rig.box.mode_current == "player_day"
+    rig.press("mode") # tells the time
+    assert rig.box.mode_current == "player_day"
+
+
+def test_alarm_setting(rig):
+    rig.box.submit(rig.box.change_mode, mode = "alarm", speak = False)
+    rig.press(0)
+    assert rig.box.mode_current == "alarm_setting"
+    assert rig.box.clock.alarm == [0, 0, 0, 0] # the release of the press entering the mode is ignored
+    rig.press(1)
+    rig.press(1)
+    for _ in range(3):
+        rig.press(2)
+    assert rig.box.clock.alarm == [0, 2, 3, 0]
+    rig.hold(3)
+    assert rig.box.mode_current == "alarm_validation"
+    assert rig.box.clock.alarm == [0, 2, 3, 0] # holding does not increment
+    rig.press(0)
+    assert rig.box.clock.alarms_text() == ["02:30"]
+    assert rig.box.mode_current in ("player_night", "player_day")
+
+
+def test_cpu_per_long_press(rig):
+    "Holding a button must not use CPU while gpiozero waits for hold_time (a busy loop would use it all)"
+    rig.box.submit(rig.box.change_mode, mode = "alarm_setting", speak = False)
+    rig.settle()
+    presses = 3
+    duration = 1.0
+    cpu_start = time.process_time()
+    for _ in range(presses):
+        rig.push(0, duration = duration)
+    cpu = (time.process_time() - cpu_start) / presses
+    assert cpu < 0.2 * duration, f"{cpu:.3f} s of CPU per long press of {duration} s"
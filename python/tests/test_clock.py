@@ -0,0 +1,56 @@
+#!/usr/bin/python3
+
+"Tests of the time of the day cached by the clock, with a micro-benchmark of its cost per event"
+
+import os
+import datetime
+import timeit
+import judsound_sim
+import judsound_clock
+
+
+class CountingTime:
+    "Define the class which replaces the module time in the clock, counting the conversions to local time"
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.count_localtime = 0
+
+    def __getattr__(self, name):
+        return getattr(self.clock, name)
+
+    def localtime(self, secs = None):
+        self.count_localtime += 1
+        return self.clock.localtime(secs)
+
+
+def make_clock(path):
+    "Get a clock (it plays no sound)"
+    return judsound_clock.Clock(player_system = None, file_to_alarms = os.path.join(path, "judsound_alarms"),
+                                night_day_h = 6, day_night_h = 22)
+
+
+def test_day_cached_till_boundary(monkeypatch, tmp_path):
+    start = datetime.datetime.combine(datetime.date.today(), datetime.time(21, 59, 59)).timestamp()
+    counting = CountingTime(clock = judsound_sim.VirtualTime(start = start, speed = 1))
+    monkeypatch.setattr(judsound_clock, "time", counting)
+    clock = make_clock(path = str(tmp_path))
+    assert clock.is_day()
+    for _ in range(1000):
+        clock.is_day()
+    assert counting.count_localtime == 1
+    counting.clock.jump(2) # 22:00:01
+    assert not clock.is_day()
+    assert counting.count_localtime == 2
+
+
+def test_cost_per_event(tmp_path):
+    "What a turn of the encoder asks the clock (is_day), and telling the time (one snapshot of the local time)"
+    clock = make_clock(path = str(tmp_path))
+    n = 10000
+    cost_is_day = timeit.timeit(clock.is_day, number = n) / n
+    cost_time = timeit.timeit(clock.time, number = n) / n
+    print(f"is_day: {1e6 * cost_is_day:.2f} us per event, time: {1e6 * cost_time:.2f} us per event")
+    assert cost_is_day < 20e-6
+    hours, minutes = clock.time()
+    assert len(hours) == len(minutes) == 2
@@ -0,0 +1,25 @@
+#!/usr/bin/python3
+
+"Tests of the control server, started and stopped with clients connected"
+
+import os
+import socket
+import logging
+import judsound_control
+
+
+def test_stop_with_client_connected(tmp_path, caplog):
+    "The server stops at once, without asyncio logging the cancellation of the client as an error"
+    server = judsound_control.Server(box = None, path_socket = os.path.join(str(tmp_path), "control.sock"))
+    server.start()
+    client = socket.socket(socket.AF_UNIX)
+    client.connect(server.path_socket)
+    client.sendall(b'{"id": 1, "cmd": "unknown"}\n')
+    assert b'"ok": false' in client.makefile("rb").readline()
+    with caplog.at_level(logging.ERROR):
+        server.stop()
+    assert not server.thread.is_alive()
+    assert not os.path.exists(server.path_socket)
+    assert client.recv(1) == b"" # disconnected by the server
+    assert not [record for record in caplog.records if record.levelno >= logging.ERROR]
+    client.close()
@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+
+"Tests of the positions reached in the playlists, checkpointed to a log from two threads"
+
+import os
+import threading
+import judsound_playlist
+
+
+def test_checkpoints_from_two_threads(tmp_path):
+    "Appends and compactions from the checkpoint thread and the dispatcher (suspend) leave the last positions"
+    file_to_positions = os.path.join(str(tmp_path), "judsound_positions")
+    positions = judsound_playlist.Positions(file_to_positions = file_to_positions, compact_factor = 1)
+    def checkpoints(playlist):
+        for i in range(300):
+            positions.set(playlist = playlist, file = f"{i}.mp3", seconds = i)
+            positions.checkpoint()
+    threads = [threading.Thread(target = checkpoints, args = (playlist,)) for playlist in ("day", "night")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    with open(file_to_positions) as file:
+        assert len(file.readlines()) == positions.lines
+    assert not os.path.exists(file_to_positions + ".tmp")
+    reloaded = judsound_playlist.Positions(file_to_positions = file_to_positions)
+    assert reloaded.positions == {"day": ("299.mp3", 299), "night": ("299.mp3", 299)}
+    assert reloaded.lines == positions.lines
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+"Tests of the scheduler of the main loop, on the virtual clock of the simulation"
+
+import os
+import time
+import datetime
+import threading
+import pytest
+import judsound_sim
+import judsound_clock
+
+
+@pytest.fixture
+def virtual(monkeypatch):
+    "Get a function giving a clock started at a time of today (HH:MM:SS), which the clock module then uses"
+    def start(at, speed):
+        clock = judsound_sim.VirtualTime(start = datetime.datetime.combine(datetime.date.today(),
+                                                                           datetime.time.fromisoformat(at)).timestamp(),
+                                         speed = speed)
+        monkeypatch.setattr(judsound_clock, "time", clock)
+        monkeypatch.setattr(judsound_clock, "threading", judsound_sim.VirtualThreading(clock = clock))
+        return clock
+    return start
+
+
+def make_scheduler(clock):
+    "Get the scheduler of a clock, the alarms it has just read being taken into account"
+    scheduler = judsound_clock.Scheduler(clock = clock)
+    clock.alarms_changed.clear() # set by the first read of the alarms, which rebuild() already followed
+    return scheduler
+
+
+def make_clock(path):
+    "Get a clock with an empty alarms file (it plays no sound)"
+    file_to_alarms = os.path.join(path, "judsound_alarms")
+    open(file_to_alarms, "w").close()
+    return judsound_clock.Clock(player_system = None, file_to_alarms = file_to_alarms, night_day_h = 6, day_night_h = 22)
+
+
+def test_wakes_up_at_alarm(virtual, tmp_path):
+    clock_virtual = virtual(at = "06:59:50", speed = 100)
+    clock = make_clock(path = str(tmp_path))
+    clock.add_alarm(alarm = [0, 7, 0, 0])
+    scheduler = make_scheduler(clock = clock)
+    assert scheduler.wait() == {"alarm"}
+    assert datetime.datetime.fromtimestamp(clock_virtual.time()).strftime("%H:%M") == "07:00"
+    assert clock_virtual.time() - clock.due_alarms(clock_virtual.time())[0][0] < 1
+
+
+def test_day_night_switches_every_day(virtual, tmp_path):
+    "Both switches of each day are due, without waking up in between (nor stopping after the first day)"
+    clock_virtual = virtual(at = "21:59:00", speed = 100000)
+    scheduler = make_scheduler(clock = make_clock(path = str(tmp_path)))
+    switches = []
+    wakeups = 0
+    while clock_virtual.monotonic() < 2 * 86400:
+        due = scheduler.wait()
+        wakeups += 1
+        if due:
+            assert due == {"day_night"}
+            switches.append(datetime.datetime.fromtimestamp(clock_virtual.time()).hour)
+    assert switches[:4] == [22, 6, 22, 6]
+    assert wakeups == len(switches)
+
+
+def test_wakes_up_early_when_alarms_change(tmp_path):
+    clock = make_clock(path = str(tmp_path))
+    scheduler = make_scheduler(clock = clock)
+    threading.Timer(0.1, clock.add_alarm, kwargs = {"alarm": [2, 3, 5, 9]}).start()
+    time_start = time.monotonic()
+    assert scheduler.wait() == set()
+    assert time.monotonic() - time_start < 2
+    assert any(kind == "alarm" for _, kind, _ in scheduler.events)
+
+
+def test_waits_with_nothing_scheduled(tmp_path):
+    scheduler = make_scheduler(clock = make_clock(path = str(tmp_path)))
+    scheduler.events = []
+    assert scheduler.wait(max_wait = 0.01) == set()
+
+
+def test_retry(virtual, tmp_path):
+    clock_virtual = virtual(at = "12:00:00", speed = 1000)
+    scheduler = make_scheduler(clock = make_clock(path = str(tmp_path)))
+    scheduler.retry_in(60)
+    time_start = clock_virtual.time()
+    assert scheduler.wait() == {"day_night"}
+    assert 60 <= clock_virtual.time() - time_start < 62
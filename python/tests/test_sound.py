@@ -0,0 +1,94 @@
+#!/usr/bin/python3
+
+"Tests of the sound engine, mixing sounds into a file sink (or a sink which fails)"
+
+import os
+import array
+import wave
+import pytest
+import judsound_sound
+
+
+@pytest.fixture(params = ["audioop", "python"])
+def mixing(request, monkeypatch):
+    "Mix with audioop, then with the functions used without it (Python 3.13)"
+    if request.param == "python":
+        monkeypatch.setattr(judsound_sound, "audioop", None)
+
+
+class SinkBroken(judsound_sound.SinkFile):
+    "Define the class of a sink whose writes fail, as when aplay exits"
+
+    def write(self, data):
+        raise BrokenPipeError("aplay exited")
+
+
+def make_engine(path, sounds, sink):
+    "Get an engine playing sounds given as {file name: list of samples}, written as wav files to path"
+    for file, samples in sounds.items():
+        with wave.open(os.path.join(path, file), "wb") as file_wav:
+            file_wav.setnchannels(1)
+            file_wav.setsampwidth(2)
+            file_wav.setframerate(judsound_sound.rate)
+            file_wav.writeframes(array.array("h", samples).tobytes())
+    return judsound_sound.Engine(path_sound = path, files = list(sounds), sink = sink)
+
+
+def test_write_error_disables_engine(tmp_path):
+    "Sounds being played are done when the output fails, and the engine then leaves its sounds to VLC"
+    engine = make_engine(path = str(tmp_path), sounds = {"a.wav": [1000] * judsound_sound.rate}, sink = SinkBroken())
+    assert engine.can_play(file = "a.wav")
+    done = engine.play(file = "a.wav", vol = 100)
+    assert done.wait(timeout = 2)
+    engine.thread.join(timeout = 2)
+    assert engine.failed
+    assert not engine.is_playing()
+    assert not engine.can_play(file = "a.wav")
+    assert engine.play(file = "a.wav", vol = 100).is_set()
+    engine.close()
+
+
+def played(engine, sounds):
+    """Play sounds given as [(file name, volume)] from the same block, and get the samples written to the sink
+    once they are all done (from the first sample which is not silent)"""
+    with engine.lock_sink: # no block is mixed till all sounds are started
+        dones = [engine.play(file = file, vol = vol) for file, vol in sounds]
+    for done in dones:
+        assert done.wait(timeout = 2)
+    engine.close()
+    with open(engine.sink.path, "rb") as file:
+        samples = array.array("h", file.read())
+    start = next(i for i, sample in enumerate(samples) if sample)
+    return samples[start:start + 2 * judsound_sound.Engine.block].tolist()
+
+
+def test_mix_two_sounds(mixing, tmp_path):
+    "Sounds are scaled by their volume and added, and are done when played (the shorter first)"
+    block = judsound_sound.Engine.block
+    engine = make_engine(path = str(tmp_path), sounds = {"a.wav": [1000] * (block + 7), "b.wav": [2000] * 5},
+                         sink = judsound_sound.SinkFile(path = str(tmp_path / "out.raw")))
+    assert played(engine = engine, sounds = [("a.wav", 50), ("b.wav", 50)]) \
+        == [1500] * 5 + [500] * (block + 2) + [0] * (block - 7)
+    assert not engine.is_playing()
+
+
+def test_mix_clips(mixing, tmp_path):
+    engine = make_engine(path = str(tmp_path), sounds = {"a.wav": [30000, -30000, 100], "b.wav": [30000, -30000, -200]},
+                         sink = judsound_sound.SinkFile(path = str(tmp_path / "out.raw")))
+    assert played(engine = engine, sounds = [("a.wav", 100), ("b.wav", 100)])[:4] == [32767, -32768, -100, 0]
+
+
+def test_suspend_and_wake(tmp_path):
+    "The output is closed while suspended, and opened again by the next sound (appended to the file)"
+    engine = make_engine(path = str(tmp_path), sounds = {"a.wav": [1000] * (judsound_sound.rate // 10)},
+                         sink = judsound_sound.SinkFile(path = str(tmp_path / "out.raw")))
+    assert engine.suspend()
+    assert not engine.sink_open and engine.sink.file.closed
+    done = engine.play(file = "a.wav", vol = 100)
+    assert engine.sink_open
+    assert not engine.suspend() # a sound is being played
+    assert done.wait(timeout = 2)
+    assert engine.suspend()
+    engine.close()
+    with open(engine.sink.path, "rb") as file:
+        assert array.array("h", file.read()).count(1000) == judsound_sound.rate // 10
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+"""Benchmark of the startup of the players: one VLC instance shared by all players, with media created on
+first use, against one instance per player with media created for all files at once (as before)
+
+Each mode is loaded in its own process, so that their memory can be compared. The test needs python-vlc;
+the benchmark can also be run by hand on the box, with its audio files:
+
+    python3 tests/test_startup.py <directory of system sounds> <directory of music>
+"""
+
+import os
+import sys
+import json
+import time
+import subprocess
+import pytest
+
+
+def load(mode, path_system_sound, path_music):
+    """Create the three players of the box in a mode ("shared" or "separate")
+
+    Return the time in sec taken to create them, and the resident memory afterwards (see judsound_sound.rss).
+    """
+
+    import judsound_player
+    import judsound_playlist
+    import judsound_sound
+    shared = mode == "shared"
+    time_start = time.monotonic()
+    files_system = sorted(file for file in os.listdir(path_system_sound) if judsound_playlist.is_audio(file))
+    player_system = judsound_player.Player(path_music = path_system_sound,
+                                           tracks_dictionary = {file: file for file in files_system},
+                                           prewarm = files_system[:2] if shared else files_system)
+    players = [player_system]
+    for _ in range(2): # day and night players
+        player = judsound_player.Player(path_music = path_music,
+                                        instance_vlc = player_system.instance_vlc if shared else None)
+        if not shared:
+            for path, _, files in os.walk(path_music):
+                for file in sorted(files):
+                    if judsound_playlist.is_audio(file):
+                        player.tracks[file] = player.instance_vlc.media_new(os.path.join(path, file))
+        players.append(player)
+    return time.monotonic() - time_start, judsound_sound.rss()
+
+
+def run(mode, path_system_sound, path_music):
+    "Load the players in a process of their own and get the time and memory it reports"
+    result = subprocess.run([sys.executable, os.path.abspath(__file__), path_system_sound, path_music, "--mode", mode],
+                            capture_output = True, check = True, text = True)
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def test_shared_instance_uses_less_memory(tmp_path):
+    import conftest # not imported when run as a script, as it replaces VLC by the fake of the simulation
+    if not conftest.have_vlc:
+        pytest.skip("python-vlc is not installed")
+    path_system_sound, path_music = conftest.make_files(path = str(tmp_path))
+    results = {mode: run(mode = mode, path_system_sound = path_system_sound, path_music = path_music)
+               for mode in ("separate", "shared")}
+    for mode, result in results.items():
+        print(f"{mode:8}: started in {1000 * result['time']:7.1f} ms, RSS {result.get('RssAnon', 0) + result.get('RssFile', 0)} kB")
+    rss = {mode: result.get("RssAnon", 0) + result.get("RssFile", 0) for mode, result in results.items()}
+    assert rss["shared"] < rss["separate"]
+
+
+def main():
+    "Compare the startup of both modes, or load one mode and print its time and memory as JSON (--mode)"
+    import argparse
+    parser = argparse.ArgumentParser(description = "Compare the startup time and memory of the players")
+    parser.add_argument("path_system_sound", help = "directory of the system sounds")
+    parser.add_argument("path_music", help = "directory of the music")
+    parser.add_argument("--mode", choices = ("separate", "shared"), help = argparse.SUPPRESS) # run by the comparison
+    arguments = parser.parse_args()
+    if arguments.mode is None:
+        for mode in ("separate", "shared"):
+            result = run(mode = mode, path_system_sound = arguments.path_system_sound, path_music = arguments.path_music)
+            print(f"{mode:8}: started in {1000 * result['time']:7.1f} ms, RSS anonymous {result.get('RssAnon', '?')} kB, "
+                  f"file-backed {result.get('RssFile', '?')} kB")
+        return
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    time_load, memory = load(mode = arguments.mode, path_system_sound = arguments.path_system_sound,
+                             path_music = arguments.path_music)
+    print(json.dumps({"time": time_load, **memory}))
+
+
+if __name__ == "__main__":
+    main()
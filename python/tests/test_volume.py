@@ -0,0 +1,34 @@
+#!/usr/bin/python3
+
+"Benchmark of the volume pipeline: a burst of steps of the rotary encoder, and the time till the volume settles"
+
+import time
+import threading
+
+
+def test_burst_of_steps_settles(rig):
+    "Steps are merged into a few updates, and the last one is applied within a few update intervals"
+    box = rig.box
+    encoder = box.button_rotary_turn
+    updates = []
+    settled = threading.Event()
+    target = box.volume_max
+    def listener(event, **data):
+        if event == "volume":
+            updates.append(data["volume"])
+            if box.player_system.volume == target:
+                settled.set()
+    box.listeners.append(listener)
+    steps = 2 * encoder.max_steps
+    encoder.steps = -encoder.max_steps
+    for _ in range(steps): # a fast turn to the maximum, as the encoder calls change_volume for each step
+        encoder.steps += 1
+        box.change_volume()
+        time.sleep(0.001)
+    time_last_step = time.monotonic()
+    assert settled.wait(timeout = 2)
+    time_settle = time.monotonic() - time_last_step
+    print(f"{steps} steps: {len(updates)} volume updates, settled {1000 * time_settle:.0f} ms after the last step")
+    assert box.volume_current() == target
+    assert len(updates) < steps / 4
+    assert time_settle < 5 * box.volume_update_interval + 0.1